@@ -0,0 +1,395 @@
+#!/usr/bin/python
+"""
+Micro-benchmarks for the slow bits of easyrunner.
+
+    ./benchmark.py                      # everything
+    ./benchmark.py discovery dispatch   # just these
+    ./benchmark.py --files 5000 --depth 4 --fanout 5 dispatch
+
+Discovery and dispatch run against a synthetic tree of test files, laid out
+like example_tests, with a fake test command whose runtime and output volume
+can be tuned. Results are printed as JSON, so runs can be saved and compared.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from easyrunner import EasyRunner, PatternMatcher
+
+
+# Sleeps, writes some output, and passes. The target file is the last
+# argument, and is echoed so the runner can tell the run got that far.
+FAKE_TEST = """
+import sys, time
+runtime, lines, target = float(sys.argv[1]), int(sys.argv[2]), sys.argv[3]
+line = 'x' * 72 + '\\n'
+out = sys.stdout
+for i in range(lines):
+    out.write(line)
+time.sleep(runtime)
+out.write('OK ' + target + '\\n')
+"""
+
+
+def legacy_evaluate(required_res, optional_res, file_path):
+    """The old per-pattern loop from EasyRunner.evaluate_candidate_file."""
+    for r in required_res:
+        if not r.search(file_path):
+            return False
+    if len(optional_res) == 0:
+        return True
+    for r in optional_res:
+        if r.search(file_path) is not None:
+            return True
+    return False
+
+
+def synthetic_paths(count, seed=0):
+    """Returns a list of fake, test-suite-looking file paths."""
+    rnd = random.Random(seed)
+    words = [
+        'app', 'lib', 'modules', 'performance', 'table', 'dimensions',
+        'admin', 'users', 'report', 'billing', 'search', 'widgets', 'api'
+    ]
+    extensions = ['.py', '.php', '.feature', '.js', '.yml', '.txt']
+    paths = []
+    for i in range(count):
+        parts = [rnd.choice(words) for j in range(rnd.randint(2, 6))]
+        name = '_'.join(rnd.choice(words) for j in range(2))
+        paths.append('/src/{0}/{1}_{2}{3}'.format(
+            '/'.join(parts), name, i, rnd.choice(extensions)))
+    return paths
+
+
+def synthetic_tree(root, file_count, depth=3, fanout=4, seed=0):
+    """
+    Fills root with a tree of test-looking files, like example_tests: folders
+    `depth` levels deep with `fanout` subfolders each, and file_count files
+    spread over all of them. Every other file is a test. Returns the number
+    of test files.
+    """
+    rnd = random.Random(seed)
+    words = ['feature', 'tests', 'wonder', 'buried', 'admin', 'billing']
+    folders = [root]
+    level = [root]
+    for d in range(depth):
+        next_level = []
+        for folder in level:
+            for i in range(fanout):
+                path = os.path.join(
+                    folder, '{0}_{1}'.format(rnd.choice(words), i))
+                os.mkdir(path)
+                next_level.append(path)
+        folders.extend(next_level)
+        level = next_level
+
+    test_count = 0
+    for i in range(file_count):
+        folder = folders[i % len(folders)]
+        if i % 2 == 0:
+            name = '{0}_tests_{1}.py'.format(rnd.choice(words), i)
+            test_count += 1
+        else:
+            name = 'helper_{0}.txt'.format(i)
+        with open(os.path.join(folder, name), 'w') as f:
+            f.write('# {0}\n'.format(i))
+    return test_count
+
+
+def fake_test_command(work_dir, runtime=0.0, lines=0):
+    """
+    Writes the fake test script to work_dir and returns the command that runs
+    it; the target file goes on the end.
+    """
+    script = os.path.join(work_dir, 'fake_test.py')
+    with open(script, 'w') as f:
+        f.write(FAKE_TEST)
+    return '"{0}" "{1}" {2} {3}'.format(sys.executable, script, runtime, lines)
+
+
+class BenchRunner(EasyRunner):
+    """
+    A runner that keeps its state in a scratch folder and passes any file
+    whose output got to the end.
+    """
+    title = 'Bench Runner'
+
+    def __init__(self, work_dir, command='true'):
+        super(BenchRunner, self).__init__()
+        self.work_dir = work_dir
+        self.set_command(command)
+        # These are shared class attributes on EasyRunner.
+        self.search_paths = set()
+        self.file_required_res = set()
+        self.file_optional_res = set()
+        self.command_prefixes = set()
+        self.command_suffixes = set()
+        self.durations = {}
+        self.test_log = {
+            'files': {},
+            'passes': 0,
+            'failures': 0,
+            'failed_tests': []
+        }
+
+    def get_state_save_path(self):
+        return os.path.join(self.work_dir, '.bench_runner_state')
+
+    def update_log(self, target_file, output):
+        if 'OK ' + target_file in output:
+            self.log_pass()
+        else:
+            self.log_failure(target_file)
+
+
+class Quiet(object):
+    """Sends stdout to /dev/null for the duration of a with block."""
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        self.devnull = open(os.devnull, 'w')
+        sys.stdout = self.devnull
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        sys.stdout = self.stdout
+        self.devnull.close()
+        return False
+
+
+def measured(func, *args):
+    """
+    Calls func, and returns its result, its wall time in seconds and the peak
+    memory Python allocated during the call (None without tracemalloc).
+    """
+    if tracemalloc is not None:
+        tracemalloc.start()
+    start = time.time()
+    try:
+        with Quiet():
+            result = func(*args)
+        elapsed = time.time() - start
+        peak = None
+        if tracemalloc is not None:
+            peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        if tracemalloc is not None:
+            tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def max_rss():
+    """Returns this process' peak resident memory in bytes, if known."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def best_of(repeat, func, *args):
+    """Returns (result, fastest time in seconds) over several calls."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+
+def bench_matcher(path_count=200000, optional_count=20, repeat=3):
+    """
+    Times the compiled PatternMatcher against the old per-pattern loop over
+    the same paths, and makes sure they agree.
+    """
+    paths = synthetic_paths(path_count)
+    required_res = set([re.compile(r'\.feature$', re.I)])
+    optional_res = set(
+        re.compile('dimension{0}'.format(i), re.I)
+        for i in range(optional_count - 1)
+    )
+    optional_res.add(re.compile('billing', re.I))
+
+    expected, legacy_seconds = best_of(repeat, lambda: [
+        p for p in paths if legacy_evaluate(required_res, optional_res, p)
+    ])
+
+    matcher = PatternMatcher(required_res, optional_res)
+    matches, compiled_seconds = best_of(repeat, matcher.filter, paths)
+
+    if matches != expected:
+        raise AssertionError('PatternMatcher disagrees with the old loop')
+
+    return {
+        'paths': path_count,
+        'optional_patterns': len(optional_res),
+        'matches': len(matches),
+        'legacy_seconds': round(legacy_seconds, 4),
+        'compiled_seconds': round(compiled_seconds, 4),
+        'speedup': round(legacy_seconds / max(compiled_seconds, 1e-9), 1)
+    }
+
+
+def bench_discovery(file_count=20000, depth=3, fanout=4, repeat=3):
+    """
+    Times find_target_files over a synthetic tree: once with a cold discovery
+    index, then the best of a few runs with a warm one.
+    """
+    work_dir = tempfile.mkdtemp(prefix='easyrunner_bench_')
+    try:
+        tree = os.path.join(work_dir, 'tree')
+        os.mkdir(tree)
+        test_count = synthetic_tree(tree, file_count, depth, fanout)
+
+        def find():
+            runner = BenchRunner(work_dir)
+            runner.add_search_path(tree)
+            runner.add_required_pattern(r'_tests_\d+\.py$')
+            runner.quiet_search = True
+            return runner.find_target_files()
+
+        targets, cold_seconds, cold_peak = measured(find)
+        if len(targets) != test_count:
+            raise AssertionError('Found {0} of {1} test files'.format(
+                len(targets), test_count))
+
+        warm_seconds = None
+        warm_peak = None
+        for i in range(repeat):
+            targets, elapsed, peak = measured(find)
+            if warm_seconds is None or elapsed < warm_seconds:
+                warm_seconds, warm_peak = elapsed, peak
+
+        return {
+            'files': file_count,
+            'depth': depth,
+            'fanout': fanout,
+            'test_files': test_count,
+            'cold_seconds': round(cold_seconds, 4),
+            'warm_seconds': round(warm_seconds, 4),
+            'cold_files_per_second': round(file_count / cold_seconds),
+            'warm_files_per_second': round(file_count / warm_seconds),
+            'cold_peak_bytes': cold_peak,
+            'warm_peak_bytes': warm_peak
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def bench_dispatch(file_count=200, runtime=0.0, lines=0, jobs=(1, 4),
+                   engines=('threads',)):
+    """
+    Runs a fake test for each of file_count files, sequentially and in
+    parallel, and works out the runner's overhead per file: how much longer
+    the run took than starting the same commands directly would have,
+    divided by the number of files.
+    """
+    work_dir = tempfile.mkdtemp(prefix='easyrunner_bench_')
+    try:
+        command = fake_test_command(work_dir, runtime, lines)
+        targets = ['target_{0}'.format(i) for i in range(file_count)]
+
+        # What the commands cost on their own, one after another.
+        sample = targets[:min(20, file_count)]
+        start = time.time()
+        with open(os.devnull, 'w') as devnull:
+            for t in sample:
+                subprocess.call(shlex.split(command) + [t], stdout=devnull)
+        direct_seconds = (time.time() - start) / len(sample)
+
+        results = []
+        for engine in engines:
+            for job_count in jobs:
+                runner = BenchRunner(work_dir, command)
+                runner.set_jobs(job_count)
+                runner.set_engine(engine)
+                runner.history_loaded = True
+                runner.target_files = list(targets)
+                result, elapsed, peak = measured(runner.run_tests)
+
+                ideal = direct_seconds * file_count / job_count
+                results.append({
+                    'engine': engine,
+                    'jobs': job_count,
+                    'seconds': round(elapsed, 4),
+                    'files_per_second': round(file_count / elapsed, 1),
+                    'overhead_ms_per_file': round(
+                        (elapsed - ideal) * 1000 / file_count, 3),
+                    'passes': runner.test_log['passes'],
+                    'peak_bytes': peak
+                })
+        return {
+            'files': file_count,
+            'runtime': runtime,
+            'lines': lines,
+            'direct_ms_per_file': round(direct_seconds * 1000, 3),
+            'runs': results
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+BENCHMARKS = ['matcher', 'discovery', 'dispatch']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks easyrunner.')
+    # Checked below rather than with choices, which argparse also applies
+    # to the empty list that means all of them.
+    parser.add_argument('benchmarks', nargs='*',
+                        help='which ones to run: {0} (default: all)'.format(
+                            ', '.join(BENCHMARKS)))
+    parser.add_argument('--files', type=int, default=20000,
+                        help='files in the synthetic tree')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument('--dispatch-files', type=int, default=200,
+                        help='fake tests to dispatch')
+    parser.add_argument('--runtime', type=float, default=0.0,
+                        help='seconds each fake test sleeps')
+    parser.add_argument('--lines', type=int, default=0,
+                        help='lines of output each fake test writes')
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--engines', nargs='+', default=['threads'],
+                        choices=['threads', 'async'])
+    args = parser.parse_args(argv)
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: {0}'.format(name))
+    benchmarks = args.benchmarks or BENCHMARKS
+
+    results = {'python': sys.version.split()[0]}
+    if 'matcher' in benchmarks:
+        results['matcher'] = bench_matcher()
+    if 'discovery' in benchmarks:
+        results['discovery'] = bench_discovery(
+            args.files, args.depth, args.fanout)
+    if 'dispatch' in benchmarks:
+        results['dispatch'] = bench_dispatch(
+            args.dispatch_files, args.runtime, args.lines, args.jobs,
+            args.engines)
+    results['max_rss_bytes'] = max_rss()
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
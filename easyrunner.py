@@ -1,10 +1,65 @@
 import os
 import sys
+import ast
 import datetime
 import subprocess as sub
 import re
 import pickle
 import logging
+import signal
+import time
+import threading
+import multiprocessing
+import fnmatch
+import glob
+import io
+import tempfile
+import json
+import hashlib
+import select
+import shutil
+import struct
+import shlex
+import socket
+import sqlite3
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+try:
+    from shlex import quote as shell_quote
+except ImportError:
+    from pipes import quote as shell_quote
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Each test process gets its own process group, so that it and everything it
+# starts can be killed together. start_new_session does that in the child
+# without running any Python there, which keeps the fast spawn paths open
+# (vfork, posix_spawn); Python 2 only has preexec_fn.
+if sys.version_info[0] >= 3:
+    NEW_SESSION = {'start_new_session': True}
+else:
+    NEW_SESSION = {'preexec_fn': getattr(os, 'setsid', None)}
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -15,407 +70,3969 @@ LOGHANDLER.setLevel(logging.DEBUG)
 logger.addHandler(LOGHANDLER)
 
 
-class EasyRunner(object):
+class DiscoveryIndex(object):
     """
-    Abstract parent class. This must be subclassed for each type of test
-    in order to provide the specifics such as pass/fail regexes and witty
-    titles.
+    A cache of the directory listings under each search path, so repeat
+    searches don't have to list the whole tree again.
 
-    Note that this class is doing too much. If I actually end up using this
-    on another project, perhaps I'll break it up.
-    """
+    For every directory we keep its mtime along with its subfolders and files.
+    A directory's mtime changes whenever an entry is added, removed or renamed
+    in it, so on a refresh we only need to stat each directory and list the
+    ones that changed. (Every directory still gets a stat, since a change deep
+    in the tree doesn't touch the mtimes of its parents.)
 
-    title = 'EasyRunner'
-    command = None
-    command_preps = set()
-    command_path = None
-    command_prefixes = set()
-    command_suffixes = set()
-    search_paths = set()
-    file_optional_res = set()
-    file_required_res = set()
-    target_files = []
-    use_all_files = False
-    start_time = None
+    Subfolders matching one of the exclude globs are pruned: they're never
+    stat'ed, listed or walked. The globs are checked against both the folder
+    name and its path relative to the search path.
 
-    cli_args = None
-    config_parts = []
+    The tree is scanned with a handful of threads pulling directories off a
+    shared queue. Listing a directory releases the GIL, so this mostly helps
+    on network filesystems, where each listing is a round trip.
+    """
 
-    verbose = False
+    version = 2
 
-    pass_count_re = None
-    fail_count_re = None
-    test_log = {
-        'files': {},
-        'passes': 0,
-        'failures': 0,
-        'failed_tests': []
-    }
+    # Directory mtimes may only have one-second resolution, so a listing taken
+    # within this many seconds of a change isn't trusted on the next refresh.
+    mtime_slack = 2
 
-    clr = {
-        'HEADER': '\033[95m',
-        'BLUE': '\033[94m',
-        'GREEN': '\033[92m',
-        'WARN': '\033[93m',
-        'FAIL': '\033[91m',
-        'ENDC': '\033[0m'
-    }
+    def __init__(self, path, exclude_globs=None, threads=1):
+        self.path = path
+        self.exclude_globs = set(exclude_globs or [])
+        self.threads = max(1, threads)
+        self.trees = {}
 
-    def __init__(self):
-        self.set_command_path(os.getcwd())
+    def load(self):
+        """Loads the pickled index. A missing or stale file is ignored."""
+        try:
+            with open(self.path, 'rb') as f:
+                saved = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            saved = None
+        if isinstance(saved, dict) and saved.get('version') == self.version:
+            self.trees = saved['trees']
+        else:
+            self.trees = {}
 
-    def set_cli_args(self, args):
-        """Accepts the command line arguments for the current invocation."""
-        # Not sure why I don't just grab them in __init__(). Maybe I had a
-        # reason? Maybe they shouldn't be processed until whatever is
-        # instantiating the runner does some setup work.
-        # Revisit this.
-        self.cli_args = args
-        self.process_cli_args()
+    def save(self):
+        """Pickles the index next to the runner's saved state."""
+        saved = {'version': self.version, 'trees': self.trees}
+        try:
+            with open(self.path, 'wb') as f:
+                pickle.dump(saved, f, pickle.HIGHEST_PROTOCOL)
+        except IOError as e:
+            logger.warning('Could not save discovery index: {0}'.format(e))
 
-    def set_title(self, title):
+    def walk(self, search_path):
         """
-        Sets the title. This has no impact on anything but the header that's
-        printed on execution. This allows each subclass to distinguish
-        itself.
+        Yields (root, subfolders, files) for each directory under the search
+        path, top-down like os.walk, leaving out the pruned subfolders.
+        Directories that haven't changed since the last walk aren't listed
+        again.
         """
-        self.title = title
+        cached_tree = self.trees.get(search_path, {})
+        listings = self._scan(search_path, cached_tree)
 
-    def set_command(self, command):
-        """
-        Sets the command that runs the tests. python, nosetests, bin/behat,
-        whatever.
-        """
-        self.command = command
+        now = time.time()
+        tree = {}
+        for root, (mtime, subfolders, files, links) in listings.items():
+            if mtime is not None and now - mtime < self.mtime_slack:
+                mtime = None
+            tree[root] = (mtime, subfolders, files, links)
+        self.trees[search_path] = tree
+        if search_path not in listings:
+            return
 
-    def set_command_path(self, path):
+        stack = [search_path]
+        while stack:
+            root = stack.pop()
+            mtime, subfolders, files, links = listings[root]
+            walked = [d for d in subfolders
+                      if os.path.join(root, d) in listings]
+            yield root, walked, files
+            for d in reversed(walked):
+                stack.append(os.path.join(root, d))
+
+    def _scan(self, search_path, cached_tree):
+        """Returns the listing of every walked directory, keyed by path."""
+        listings = {}
+        if self._scan_dir(search_path, search_path, cached_tree,
+                          listings) is None:
+            return listings
+
+        if self.threads == 1:
+            stack = [search_path]
+            while stack:
+                root = stack.pop()
+                stack.extend(self._scan_dir(
+                    search_path, root, cached_tree, listings) or [])
+            return listings
+
+        work = queue.Queue()
+
+        def scan_worker():
+            while True:
+                root = work.get()
+                try:
+                    if root is None:
+                        return
+                    for sub_path in self._scan_dir(
+                            search_path, root, cached_tree, listings) or []:
+                        work.put(sub_path)
+                finally:
+                    work.task_done()
+
+        # The search path itself has been scanned above. Seed the queue with
+        # its children.
+        for sub_path in self._children(search_path, listings):
+            work.put(sub_path)
+
+        workers = []
+        for i in range(self.threads):
+            worker = threading.Thread(target=scan_worker)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        # Subfolders are queued before their parent is marked done, so this
+        # only returns once the whole tree has been scanned.
+        work.join()
+        for worker in workers:
+            work.put(None)
+        for worker in workers:
+            worker.join()
+        return listings
+
+    def _scan_dir(self, search_path, root, cached_tree, listings):
         """
-        Sets the path from which the test-runner command should be executed.
+        Stats a directory, lists it if it changed, and returns the subfolders
+        that should be scanned next. Returns None if it can't be read.
         """
-        if os.path.isdir(path):
-            self.command_path = path
+        mtime = self._stat_mtime(root)
+        if mtime is None:
+            return None
+
+        cached = cached_tree.get(root)
+        if cached is not None and cached[0] == mtime:
+            listing = (mtime,) + tuple(cached[1:])
         else:
-            print(self.bad("Bad command path provided: {}".format(path)))
-            self.quit()
+            listing = self._list(root)
+            if listing is None:
+                return None
+            listing = (mtime,) + listing
 
-    def add_search_path(self, path):
-        """Adds a path in which to go a test searchin'."""
-        if path[0] == '~':
-            path = os.path.expanduser(path)
-        if os.path.exists(path):
-            self.search_paths.add(path)
+        # A single dict assignment is atomic, so the scan threads can share
+        # the listings without a lock.
+        listings[root] = listing
+        return self._children(root, listings, search_path)
 
-    def add_optional_pattern(self, pattern):
+    def _children(self, root, listings, search_path=None):
+        mtime, subfolders, files, links = listings[root]
+        if search_path is None:
+            search_path = root
+        children = []
+        for d in subfolders:
+            # Like os.walk, don't descend into symlinked directories.
+            if d in links:
+                continue
+            sub_path = os.path.join(root, d)
+            if not self.is_excluded(search_path, sub_path):
+                children.append(sub_path)
+        return children
+
+    def is_excluded(self, search_path, dir_path):
+        """Returns True if the directory matches one of the exclude globs."""
+        name = os.path.basename(dir_path)
+        rel_path = os.path.relpath(dir_path, search_path)
+        for pattern in self.exclude_globs:
+            if (fnmatch.fnmatch(name, pattern) or
+                    fnmatch.fnmatch(rel_path, pattern)):
+                return True
+        return False
+
+    def _list(self, root):
+        """Returns (subfolders, files, symlinked subfolders) for a folder."""
+        subfolders = []
+        files = []
+        links = set()
+        try:
+            if scandir is not None:
+                for entry in scandir(root):
+                    if entry.is_dir():
+                        subfolders.append(entry.name)
+                        if entry.is_symlink():
+                            links.add(entry.name)
+                    else:
+                        files.append(entry.name)
+            else:
+                for name in os.listdir(root):
+                    path = os.path.join(root, name)
+                    if os.path.isdir(path):
+                        subfolders.append(name)
+                        if os.path.islink(path):
+                            links.add(name)
+                    else:
+                        files.append(name)
+        except OSError:
+            return None
+        return subfolders, files, links
+
+    def _stat_mtime(self, root):
+        try:
+            return os.stat(root).st_mtime
+        except OSError:
+            return None
+
+
+class ImportGraph(object):
+    """
+    What each Python file imports, found by parsing it (nothing is run), for
+    working out which test files a change can affect.
+
+    The imports of each file are cached by its mtime and size in a pickle
+    next to the runner's state, so only files that changed since the last
+    time are parsed again. Which files the imports resolve to isn't cached;
+    that's just a few stats per import.
+
+    Imports are resolved the way Python would find them in the project:
+    relative imports against the importing file's package, and absolute ones
+    against the importing file's own folder (like sys.path[0], or Python 2's
+    implicit relative imports) and then the given roots. Imports that don't
+    resolve to a file under those (the standard library, installed packages)
+    are left out of the graph.
+    """
+
+    version = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.resolved = {}
+
+    def load(self):
+        """Loads the pickled imports. A missing or stale file is ignored."""
+        try:
+            with open(self.path, 'rb') as f:
+                saved = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            saved = None
+        if isinstance(saved, dict) and saved.get('version') == self.version:
+            self.files = saved['files']
+        else:
+            self.files = {}
+
+    def save(self):
+        """Pickles the imports next to the runner's saved state."""
+        saved = {'version': self.version, 'files': self.files}
+        try:
+            with open(self.path, 'wb') as f:
+                pickle.dump(saved, f, pickle.HIGHEST_PROTOCOL)
+        except IOError as e:
+            logger.warning('Could not save import graph: {0}'.format(e))
+
+    def imports(self, file_path):
         """
-        Adds an *optional* regular expression. A test file must match at least
-        one of these to be included.
+        Returns a file's imports as (module, level, names) tuples: the
+        module as written, how many dots it had, and for `from ... import`
+        the names imported (any of which may be submodules).
         """
-        self.file_optional_res.add(re.compile(pattern, re.I))
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return []
+        key = (st.st_mtime, st.st_size)
+        cached = self.files.get(file_path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
 
-    def add_required_pattern(self, pattern):
+        imports = []
+        try:
+            with open(file_path, 'rb') as f:
+                tree = ast.parse(f.read(), file_path)
+        except (IOError, SyntaxError, ValueError, TypeError):
+            tree = None
+        if tree is not None:
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Import):
+                    for alias in node.names:
+                        imports.append((alias.name, 0, ()))
+                elif isinstance(node, ast.ImportFrom):
+                    imports.append((
+                        node.module or '',
+                        node.level or 0,
+                        tuple(a.name for a in node.names if a.name != '*')
+                    ))
+        self.files[file_path] = (key, imports)
+        return imports
+
+    def dependencies(self, file_path, roots, exists):
         """
-        Adds a *required* regular expression. If a test file does not match this,
-        it is excluded.
+        Returns the files a file imports directly. exists(path) says whether
+        a path counts as a file, so deleted modules can still be found.
         """
-        self.file_required_res.add(re.compile(pattern, re.I))
+        folder = os.path.dirname(file_path)
+        found = set()
+        for module, level, names in self.imports(file_path):
+            if level > 0:
+                base = folder
+                for i in range(level - 1):
+                    base = os.path.dirname(base)
+                bases = [base]
+            else:
+                bases = [folder] + list(roots)
 
-    def add_prefix(self, prefix):
+            parts = module.split('.') if module else []
+            stems = [parts[:i] for i in range(1, len(parts) + 1)]
+            stems.extend(parts + [name] for name in names)
+            for stem in stems:
+                for base in bases:
+                    path = self.resolve(base, stem, exists)
+                    if path is not None:
+                        found.add(path)
+                        break
+        return found
+
+    def resolve(self, base, stem, exists):
+        """Returns the module or package file for a dotted name, or None."""
+        key = (base, tuple(stem))
+        if key not in self.resolved:
+            path = os.path.join(base, *stem)
+            self.resolved[key] = None
+            for candidate in [path + '.py', os.path.join(path, '__init__.py')]:
+                if exists(candidate):
+                    self.resolved[key] = candidate
+                    break
+        return self.resolved[key]
+
+    def impacted(self, target_files, changed_files, roots):
         """
-        Adds a command option/prefix. This will be included in the shell command
-        string after the command itself, but before the test file path.
+        Returns the target files that are among the changed files, or import
+        one of them, however indirectly. They're returned in the order given.
+        Paths are compared with symlinks resolved, since git reports real
+        paths.
         """
-        self.command_prefixes.add(prefix)
+        changed = set(os.path.realpath(p) for p in changed_files)
+        roots = [os.path.realpath(r) for r in roots]
 
-    def add_suffix(self, suffix):
+        def exists(path):
+            return path in changed or os.path.isfile(path)
+
+        edges = {}
+        pending = [os.path.realpath(t) for t in target_files]
+        while pending:
+            file_path = pending.pop()
+            if file_path in edges:
+                continue
+            edges[file_path] = self.dependencies(file_path, roots, exists)
+            pending.extend(edges[file_path])
+
+        imported_by = {}
+        for file_path, deps in edges.items():
+            for dep in deps:
+                imported_by.setdefault(dep, set()).add(file_path)
+
+        impacted = set(changed & set(edges))
+        pending = list(impacted)
+        while pending:
+            for importer in imported_by.get(pending.pop(), ()):
+                if importer not in impacted:
+                    impacted.add(importer)
+                    pending.append(importer)
+        return [t for t in target_files if os.path.realpath(t) in impacted]
+
+
+class PatternMatcher(object):
+    """
+    Decides which candidate files match the search patterns, the same way
+    EasyRunner.evaluate_candidate_file always has: a file must match every
+    required pattern and, unless --all was passed, at least one optional
+    pattern.
+
+    Most search patterns are plain words, and those don't need a regex at
+    all. The path is lowercased once and they're checked as substrings: the
+    required ones one by one and the optional ones as a single alternation.
+    The remaining optional patterns are compiled into one more alternation.
+    Required regexes are still checked one by one, but only after the
+    literal text they can't match without (e.g. '.py' for '\\.py$') has been
+    found in the path, which throws out most of a big tree at almost no cost.
+
+    All of this relies on lowercasing lining up with re.I, which only holds
+    for ASCII. (Under re.I, 'k' also matches the Kelvin sign, for instance.)
+    Non-ASCII paths are checked against the original regexes.
+    """
+
+    def __init__(self, required_res, optional_res, use_all_files=False):
+        required_res = list(required_res)
+        optional_res = list(optional_res)
+        self.required_res = required_res
+        self.check_optional = not use_all_files and len(optional_res) > 0
+
+        # Required patterns: substrings that must all be present, plus the
+        # regexes that a substring alone can't settle.
+        self.required_literals = []
+        self.required_regexes = []
+        for r in required_res:
+            text = self.plain_text(r)
+            if text is not None:
+                self.required_literals.append(text)
+                continue
+            hint = self.literal(r)
+            if hint:
+                self.required_literals.append(hint)
+            self.required_regexes.append(r)
+
+        # Optional patterns: one alternation for the plain-text ones (run
+        # over the lowercased path) and one for the rest.
+        texts = []
+        regexes = []
+        hints = []
+        for r in optional_res:
+            text = self.plain_text(r)
+            if text is not None:
+                texts.append(text)
+            else:
+                regexes.append(r)
+                hints.append(self.literal(r))
+
+        self.optional_text_re = None
+        if texts:
+            self.optional_text_re = re.compile(
+                '|'.join(re.escape(t) for t in texts))
+        self.optional_re, self.optional_extra = self.combine(regexes)
+        self.optional_hint_re = None
+        if regexes and all(hints):
+            self.optional_hint_re = re.compile(
+                '|'.join(re.escape(h) for h in hints))
+        self.optional_any_re, self.optional_any_extra = self.combine(
+            optional_res)
+
+    def match(self, file_path):
+        """Returns True if the file path matches the patterns."""
+        return len(self.filter([file_path])) == 1
+
+    def filter(self, file_paths):
         """
-        Adds a command suffix. This will be appended to the command shell
-        command after the test file path.
+        Returns the file paths that match, keeping their order. Each check
+        runs over the whole batch before the next one, so the cheap checks
+        shrink the batch before the expensive ones see it.
         """
-        self.command_suffixes.add(suffix)
+        is_ascii = self.is_ascii
+        if not all(is_ascii(f) for f in file_paths):
+            return [f for f in file_paths if self.match_slowly(f)]
 
-    def set_verbose(self, verbose):
-        """Sets verbosity mode."""
-        self.verbose = bool(verbose)
+        batch = [(f, f.lower()) for f in file_paths]
+        for text in self.required_literals:
+            batch = [fl for fl in batch if text in fl[1]]
+        for r in self.required_regexes:
+            search = r.search
+            batch = [fl for fl in batch if search(fl[0]) is not None]
 
-    def time_passed(self):
-        """Returns how much time has passed since the tests began."""
-        diff = datetime.datetime.now() - self.start_time
-        # Since we want this for user feedback, we'll let the timedelta
-        # stringify itself.
-        return str(diff).split('.')[0]
+        if not self.check_optional:
+            return [f for f, lowered in batch]
 
-    def log_failure(self, target):
-        """Log that a test has failed."""
+        text_search = self.optional_text_search()
+        hint_search = self.optional_hint_search()
+        regex_search = self.optional_regex_search()
+        return [
+            f for f, lowered in batch
+            if text_search(lowered) or (
+                hint_search(lowered) and regex_search(f))
+        ]
 
-        # Obviously we don't need the separate count field if it's always going
-        # to match the number of test files that have failed. However, I
-        # think the plan was to let them diverge under certain circumstances.
-        # Need to revisit this.
-        self.test_log['failures'] += 1
+    def optional_text_search(self):
+        if self.optional_text_re is None:
+            return lambda lowered: False
+        return self.optional_text_re.search
 
-        # A set would be cleaner here, but I like keeping the failures
-        # in order. It makes the progressive tally more readable.
-        if target not in self.test_log['failed_tests']:
-            self.test_log['failed_tests'].append(target)
+    def optional_hint_search(self):
+        if self.optional_hint_re is None:
+            return lambda lowered: True
+        return self.optional_hint_re.search
 
-    def log_pass(self):
+    def optional_regex_search(self):
+        optional_re = self.optional_re
+        optional_extra = self.optional_extra
+        if optional_re is not None and len(optional_extra) == 0:
+            return optional_re.search
+
+        def search(file_path):
+            if optional_re is not None and optional_re.search(file_path):
+                return True
+            for r in optional_extra:
+                if r.search(file_path) is not None:
+                    return True
+            return False
+        return search
+
+    def match_slowly(self, file_path):
+        """Checks the file path against the original regexes."""
+        for r in self.required_res:
+            if r.search(file_path) is None:
+                return False
+        if not self.check_optional:
+            return True
+        if self.optional_any_re is not None:
+            if self.optional_any_re.search(file_path) is not None:
+                return True
+        for r in self.optional_any_extra:
+            if r.search(file_path) is not None:
+                return True
+        return False
+
+    @staticmethod
+    def is_ascii(file_path):
+        try:
+            return file_path.isascii()
+        except AttributeError:
+            # Python 2 str paths are bytes, which re.I only folds as ASCII.
+            return not isinstance(file_path, unicode)
+
+    @classmethod
+    def parse(cls, regex):
+        """Returns the parsed regex, or None if it can't be parsed."""
+        try:
+            return sre_parse.parse(regex.pattern, regex.flags)
+        except Exception:
+            return None
+
+    @classmethod
+    def plain_text(cls, regex):
         """
-        Log that a test has passed. This is all we save for now, since we
-        want additional details only for tests that failed.
+        Returns the regex's text, lowercased, if it's nothing but plain ASCII
+        text and case-insensitive. Otherwise returns None.
         """
-        self.test_log['passes'] += 1
+        if not regex.flags & re.I:
+            return None
+        parsed = cls.parse(regex)
+        if parsed is None or len(parsed) == 0:
+            return None
+        text = ''
+        for op, av in parsed:
+            if op != sre_parse.LITERAL or av >= 128:
+                return None
+            text += chr(av)
+        return text.lower()
 
-    def strip_ansi(self, text):
+    @classmethod
+    def literal(cls, regex):
         """
-        Remove ansi codes from text (such as text from the console).
+        Returns the longest run of plain ASCII text that every match of the
+        regex must contain, lowercased, or None if there isn't one.
         """
+        parsed = cls.parse(regex)
+        if parsed is None:
+            return None
 
-        # Some test runners don't let you disable colored output.
-        # <cough>PHPUnit</cough>
-        # https://github.com/sebastianbergmann/phpunit/issues/516
+        longest = ''
+        current = ''
+        for op, av in parsed:
+            if op == sre_parse.LITERAL and av < 128:
+                current += chr(av)
+                continue
+            if op == sre_parse.BRANCH:
+                return None
+            longest = max(longest, current, key=len)
+            current = ''
+        longest = max(longest, current, key=len)
+        return longest.lower() or None
 
-        return re.sub(r'\033\[[0-9;]+m|\[2K', '', text)
+    @classmethod
+    def combine(cls, regexes):
+        """
+        Combines the regexes into one alternation. Returns (combined regex or
+        None, list of regexes that have to be checked on their own).
+        """
+        combinable = []
+        extra = []
+        for r in regexes:
+            if cls.combinable(r):
+                combinable.append(r)
+            else:
+                extra.append(r)
 
-    def run(self):
-        """Starts the tests a runnin'."""
-        self.print_title()
+        if len(combinable) == 0:
+            return None, extra
 
-        # If no search string, try to resume state from the prior run
-        if len(self.cli_args) == 1:
-            self.resume_state()
-        else:
-            self.validate()
-            self.target_files = self.find_target_files()
+        flags = set(r.flags for r in combinable)
+        if len(flags) > 1:
+            return None, list(regexes)
 
-            if len(self.target_files) == 0:
-                print(self.bad('No matches found.'))
-                self.quit()
+        pattern = '|'.join('(?:{0})'.format(r.pattern) for r in combinable)
+        try:
+            return re.compile(pattern, flags.pop()), extra
+        except re.error:
+            return None, list(regexes)
 
-            self.print_test_scope()
-            self.prompt_user()
+    @classmethod
+    def combinable(cls, regex):
+        # Numbered backreferences would point at the wrong group once the
+        # patterns are joined, and named ones might collide.
+        if regex.groups == 0:
+            return True
+        return not re.search(r'\\[1-9]|\(\?P=|\(\?\(', regex.pattern)
 
-    def print_title(self):
-        """
-        Wipes the /usr directory.
 
-        Just kidding. Prints the title.
-        """
-        print(self.header('\n----- ' + self.title + ' -----\n'))
+class OutputSpool(object):
+    """
+    Collects a test file's output on disk instead of in memory. Test output
+    (Selenium logs in particular) can run to hundreds of megabytes, and all
+    we really need in memory is the end of it, where the summary lives.
 
-    def print_test_scope(self):
-        """Prints the target files and related parameters (verbosity, etc.)"""
-        print(self.status('Target Files:'))
-        count = 1
-        for f in self.target_files:
-            number_prefix = "[{0}]".format(count)
-            head, tail = os.path.split(self.get_path_rel_to_command_path(f))
-            print("\t{0}: {1}".format(
-                number_prefix,
-                (head + '/' + self.warn(tail))
-            ))
-            count += 1
+    In quiet mode the child process writes straight into the spool file, so
+    its output never passes through Python at all.
+    """
 
-        if self.verbose:
-            if 'silent' not in self.config_parts:
-                self.config_parts.append('silent')
-            try:
-                self.config_parts.remove('verbose')
-            except ValueError:
-                pass
-        else:
-            if 'verbose' not in self.config_parts:
-                self.config_parts.append('verbose')
-            try:
-                self.config_parts.remove('silent')
-            except ValueError:
-                pass
+    # How much of the end of the output tail() reads back.
+    tail_bytes = 64 * 1024
 
-        colored_config_parts = [self.good(cp) for cp in self.config_parts]
-        config_str = '[ ' + ' | '.join(colored_config_parts) + ' ]'
-        print('{0}'.format(config_str))
+    def __init__(self, spool_dir, target_file):
+        name = re.sub(r'[^\w.-]+', '_', os.path.basename(target_file))
+        fd, self.path = tempfile.mkstemp(
+            prefix=name + '.', suffix='.log', dir=spool_dir)
+        self.file = os.fdopen(fd, 'w')
 
-    def print_commands(self):
-        """Print available command-prompt commands."""
-        command_sets = [
-            ('Enter', 'Run the listed test files'),
+    def write(self, text):
+        self.file.write(text)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def tail(self):
+        """Returns the end of the output, starting on a line boundary."""
+        self.close()
+        with io.open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - self.tail_bytes))
+            data = f.read()
+        text = data.decode('utf-8', 'replace')
+        if size > self.tail_bytes and '\n' in text:
+            text = text.split('\n', 1)[1]
+        return text
+
+    def lines(self):
+        """Yields the whole output a line at a time."""
+        self.close()
+        with io.open(self.path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                yield line
+
+    def copy_to(self, stream):
+        """Writes the whole output to a stream, a chunk at a time."""
+        self.close()
+        with io.open(self.path, 'r', encoding='utf-8', errors='replace') as f:
+            while True:
+                chunk = f.read(self.tail_bytes)
+                if not chunk:
+                    break
+                stream.write(chunk)
+        stream.flush()
+
+    def discard(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class ResultsDB(object):
+    """
+    A SQLite database holding the outcome of every target file in every run,
+    along with each runner's saved state (the last selection, verbosity and
+    so on).
+
+    The results table is append-only. Reading the whole history back every
+    time would get slow as it grows, so a small file_stats table is kept up
+    to date alongside it with what scheduling needs for each file: its
+    smoothed duration, latest outcome and run counts.
+
+    A file that's retried gets a result for each attempt, but its runs and
+    failures only count first attempts. A first attempt that failed and
+    then passed on a retry counts as a flake.
+
+    Several runners (or workers) can write at once. The database is in WAL
+    mode, so readers don't block writers, and writes wait their turn for up
+    to `timeout` seconds.
+    """
+
+    timeout = 30
+
+    schema = [
+        """CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            runner TEXT NOT NULL,
+            started REAL NOT NULL,
+            finished REAL,
+            jobs INTEGER,
+            host TEXT,
+            pid INTEGER
+        )""",
+        """CREATE TABLE IF NOT EXISTS results (
+            id INTEGER PRIMARY KEY,
+            run_id INTEGER NOT NULL,
+            runner TEXT NOT NULL,
+            target TEXT NOT NULL,
+            outcome TEXT NOT NULL,
+            duration REAL,
+            exit_code INTEGER,
+            finished REAL NOT NULL,
+            peak_rss INTEGER,
+            cpu_seconds REAL,
+            read_bytes INTEGER,
+            write_bytes INTEGER,
+            attempt INTEGER
+        )""",
+        """CREATE INDEX IF NOT EXISTS results_by_target
+            ON results (runner, target, id)""",
+        """CREATE INDEX IF NOT EXISTS results_by_run
+            ON results (run_id)""",
+        """CREATE TABLE IF NOT EXISTS file_stats (
+            runner TEXT NOT NULL,
+            target TEXT NOT NULL,
+            duration REAL,
+            last_outcome TEXT,
+            last_result_id INTEGER,
+            runs INTEGER NOT NULL DEFAULT 0,
+            failures INTEGER NOT NULL DEFAULT 0,
+            flakes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (runner, target)
+        )""",
+        """CREATE TABLE IF NOT EXISTS state (
+            runner TEXT PRIMARY KEY,
+            saved REAL NOT NULL,
+            data TEXT NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS result_cache (
+            runner TEXT NOT NULL,
+            key TEXT NOT NULL,
+            target TEXT NOT NULL,
+            stored REAL NOT NULL,
+            used REAL NOT NULL,
+            PRIMARY KEY (runner, key)
+        )""",
+        """CREATE INDEX IF NOT EXISTS result_cache_by_use
+            ON result_cache (used)""",
+    ]
+
+    # Columns added since the tables were first created, which databases
+    # made before then need to have added.
+    added_columns = [
+        ('results', 'peak_rss', 'INTEGER'),
+        ('results', 'cpu_seconds', 'REAL'),
+        ('results', 'read_bytes', 'INTEGER'),
+        ('results', 'write_bytes', 'INTEGER'),
+        ('results', 'attempt', 'INTEGER'),
+        ('file_stats', 'flakes', 'INTEGER NOT NULL DEFAULT 0'),
+    ]
+
+    resource_keys = ('peak_rss', 'cpu_seconds', 'read_bytes', 'write_bytes')
+
+    def __init__(self, path, runner):
+        self.path = path
+        self.runner = runner
+        self.conn = sqlite3.connect(path, timeout=self.timeout)
+        # We manage transactions ourselves (see write()).
+        self.conn.isolation_level = None
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.write() as cursor:
+            for statement in self.schema:
+                cursor.execute(statement)
+            for table, column, column_type in self.added_columns:
+                existing = [
+                    row[1] for row in
+                    cursor.execute('PRAGMA table_info({0})'.format(table))
+                ]
+                if column not in existing:
+                    cursor.execute('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(
+                        table, column, column_type))
+
+    def write(self):
+        """
+        Returns a context manager for a write transaction. It takes the write
+        lock up front (BEGIN IMMEDIATE), so read-then-write updates like the
+        one in record_result can't interleave with another writer's.
+        """
+        return _Transaction(self.conn)
+
+    def close(self):
+        self.conn.close()
+
+    def load_state(self):
+        """Returns the runner's saved state dict, or None."""
+        row = self.conn.execute(
+            'SELECT data FROM state WHERE runner = ?', (self.runner,)
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def save_state(self, state):
+        """Saves the runner's state dict. Sets are saved as lists."""
+        data = json.dumps(
+            state, default=lambda o: sorted(o) if isinstance(o, set) else o)
+        with self.write() as cursor:
+            cursor.execute(
+                'INSERT OR REPLACE INTO state (runner, saved, data) '
+                'VALUES (?, ?, ?)',
+                (self.runner, time.time(), data)
+            )
+
+    def start_run(self, jobs):
+        """Records the start of a run and returns its id."""
+        with self.write() as cursor:
+            cursor.execute(
+                'INSERT INTO runs (runner, started, jobs, host, pid) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (self.runner, time.time(), jobs, socket.gethostname(),
+                 os.getpid())
+            )
+            return cursor.lastrowid
+
+    def finish_run(self, run_id):
+        with self.write() as cursor:
+            cursor.execute(
+                'UPDATE runs SET finished = ? WHERE id = ?',
+                (time.time(), run_id)
+            )
+
+    def record_result(self, run_id, target, outcome, duration, exit_code,
+                      resources=None, attempt=1):
+        """
+        Appends a target file's result and folds it into the file's stats.
+        The stored duration is smoothed the same way as
+        EasyRunner.record_duration. Resources is the file's usage as measured
+        by ResourceSampler, if it was sampled. Attempt counts from 1; later
+        ones are retries within the same run.
+        """
+        first = 1 if attempt == 1 else 0
+        failure = 1 if outcome != 'passed' and first else 0
+        flake = 1 if outcome == 'passed' and not first else 0
+        resources = resources or {}
+        with self.write() as cursor:
+            cursor.execute(
+                'INSERT INTO results (run_id, runner, target, outcome, '
+                'duration, exit_code, finished, peak_rss, cpu_seconds, '
+                'read_bytes, write_bytes, attempt) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (run_id, self.runner, target, outcome, duration, exit_code,
+                 time.time()) +
+                tuple(resources.get(key) for key in self.resource_keys) +
+                (attempt,)
+            )
+            result_id = cursor.lastrowid
+            cursor.execute(
+                'UPDATE file_stats SET '
+                'duration = CASE WHEN ? IS NULL THEN duration '
+                '  WHEN duration IS NULL THEN ? '
+                '  ELSE (duration + ?) / 2.0 END, '
+                'last_outcome = ?, last_result_id = ?, '
+                'runs = runs + ?, failures = failures + ?, '
+                'flakes = flakes + ? '
+                'WHERE runner = ? AND target = ?',
+                (duration, duration, duration, outcome, result_id, first,
+                 failure, flake, self.runner, target)
+            )
+            if cursor.rowcount == 0:
+                cursor.execute(
+                    'INSERT INTO file_stats (runner, target, duration, '
+                    'last_outcome, last_result_id, runs, failures, flakes) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (self.runner, target, duration, outcome, result_id,
+                     first, failure, flake)
+                )
+
+    def durations(self):
+        """Returns {target: smoothed duration} for files with a timing."""
+        return dict(self.conn.execute(
+            'SELECT target, duration FROM file_stats '
+            'WHERE runner = ? AND duration IS NOT NULL', (self.runner,)
+        ))
+
+    def failed_files(self):
+        """Returns the files whose latest result wasn't a pass, in order."""
+        return [row[0] for row in self.conn.execute(
+            'SELECT target FROM file_stats '
+            'WHERE runner = ? AND last_outcome != ? '
+            'ORDER BY last_result_id', (self.runner, 'passed')
+        )]
+
+    def flake_rates(self):
+        """
+        Returns {target: flakes per run} for the files that have ever
+        passed on a retry.
+        """
+        return dict(self.conn.execute(
+            'SELECT target, flakes * 1.0 / MAX(runs, 1) FROM file_stats '
+            'WHERE runner = ? AND flakes > 0', (self.runner,)
+        ))
+
+    def cached_passes(self, keys):
+        """
+        Returns which of the cache keys have a pass cached, and marks them
+        as just used.
+        """
+        keys = list(keys)
+        found = set()
+        # SQLite only takes so many parameters at once.
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            found.update(row[0] for row in self.conn.execute(
+                'SELECT key FROM result_cache WHERE runner = ? AND key IN '
+                '({0})'.format(', '.join('?' * len(chunk))),
+                [self.runner] + chunk
+            ))
+        if found:
+            with self.write() as cursor:
+                cursor.executemany(
+                    'UPDATE result_cache SET used = ? '
+                    'WHERE runner = ? AND key = ?',
+                    [(time.time(), self.runner, k) for k in found]
+                )
+        return found
+
+    def cache_pass(self, key, target, limit):
+        """
+        Caches a pass under the key, then evicts the least recently used
+        entries (of any runner) beyond the limit.
+        """
+        now = time.time()
+        with self.write() as cursor:
+            cursor.execute(
+                'INSERT OR REPLACE INTO result_cache '
+                '(runner, key, target, stored, used) VALUES (?, ?, ?, ?, ?)',
+                (self.runner, key, target, now, now)
+            )
+            cursor.execute(
+                'DELETE FROM result_cache WHERE rowid IN ('
+                'SELECT rowid FROM result_cache '
+                'ORDER BY used DESC LIMIT -1 OFFSET ?)', (limit,)
+            )
+
+    def uncache(self, key):
+        """Drops a cached pass, if there is one."""
+        with self.write() as cursor:
+            cursor.execute(
+                'DELETE FROM result_cache WHERE runner = ? AND key = ?',
+                (self.runner, key)
+            )
+
+    def file_history(self, target, limit=20):
+        """
+        Returns a file's most recent results, newest first, as dicts with the
+        run id, attempt, outcome, duration, exit code and finish time.
+        """
+        rows = self.conn.execute(
+            'SELECT run_id, COALESCE(attempt, 1), outcome, duration, '
+            'exit_code, finished '
+            'FROM results WHERE runner = ? AND target = ? '
+            'ORDER BY id DESC LIMIT ?', (self.runner, target, limit)
+        )
+        keys = ('run_id', 'attempt', 'outcome', 'duration', 'exit_code',
+                'finished')
+        return [dict(zip(keys, row)) for row in rows]
+
+    def heaviest_files(self, limit=10):
+        """
+        Returns the files with the highest peak memory use on record, as
+        (target, peak RSS in bytes, average CPU seconds) tuples.
+        """
+        return list(self.conn.execute(
+            'SELECT target, MAX(peak_rss), AVG(cpu_seconds) FROM results '
+            'WHERE runner = ? AND peak_rss IS NOT NULL '
+            'GROUP BY target ORDER BY MAX(peak_rss) DESC LIMIT ?',
+            (self.runner, limit)
+        ))
+
+
+class _Transaction(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.cursor = self.conn.cursor()
+        self.cursor.execute('BEGIN IMMEDIATE')
+        return self.cursor
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.cursor.execute('COMMIT')
+        else:
+            self.cursor.execute('ROLLBACK')
+        self.cursor.close()
+
+
+class Watchdog(threading.Thread):
+    """
+    Keeps an eye on the running test processes and kills any that run past
+    the per-file timeout, along with everything else once the whole run has
+    gone past the global timeout.
+
+    Killing a test process means killing its whole process group (see
+    EasyRunner.kill_process_group), so a hung browser goes down with the
+    test runner that started it.
+    """
+
+    interval = 0.25
+
+    def __init__(self, runner):
+        super(Watchdog, self).__init__()
+        self.daemon = True
+        self.runner = runner
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.check()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+    def check(self):
+        runner = self.runner
+        now = time.time()
+
+        if (runner.global_timeout is not None and
+                not runner.global_timed_out and
+                now - runner.run_started > runner.global_timeout):
+            runner.global_timed_out = True
+
+        for target_file, p in list(runner.running.items()):
+            if target_file in runner.timed_out:
+                continue
+            started = runner.started_at.get(target_file)
+            timeout = runner.get_timeout(target_file)
+            overdue = (
+                runner.global_timed_out or (
+                    timeout is not None and started is not None and
+                    now - started > timeout)
+            )
+            if overdue:
+                runner.timed_out.add(target_file)
+                runner.kill_process_group(p)
+
+
+class ResourceSampler(threading.Thread):
+    """
+    Samples what each running test file uses: peak memory (RSS), CPU time and
+    bytes read from and written to storage.
+
+    A test file's usage is that of every process in its process group (each
+    test process gets its own; see EasyRunner.start_test_process), which
+    covers the test runner and any browsers it started. The figures come
+    from /proc, so this only works on Linux. Processes that start and exit
+    between two samples are missed, so CPU time and I/O are lower bounds.
+    """
+
+    interval = 0.5
+
+    def __init__(self, runner):
+        super(ResourceSampler, self).__init__()
+        self.daemon = True
+        self.runner = runner
+        self.stopped = threading.Event()
+        self.usage = {}
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self.clock_ticks = float(os.sysconf('SC_CLK_TCK'))
+
+    @classmethod
+    def available(cls):
+        return os.path.isfile('/proc/self/stat')
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+    def sample(self):
+        groups = dict(
+            (p.pid, target_file)
+            for target_file, p in list(self.runner.running.items())
+        )
+        if len(groups) == 0:
+            return
+
+        rss = {}
+        for name in os.listdir('/proc'):
+            if not name.isdigit():
+                continue
+            stat = self.read_stat(name)
+            if stat is None or stat['pgrp'] not in groups:
+                continue
+            target_file = groups[stat['pgrp']]
+            usage = self.usage.setdefault(
+                target_file, {'peak_rss': 0, 'pids': {}})
+            read_bytes, write_bytes = self.read_io(name)
+            # CPU time and I/O only ever go up, so a process's latest
+            # figures are its totals so far.
+            usage['pids'][name] = (stat['cpu'], read_bytes, write_bytes)
+            rss[target_file] = rss.get(target_file, 0) + stat['rss']
+
+        for target_file, total in rss.items():
+            usage = self.usage[target_file]
+            usage['peak_rss'] = max(usage['peak_rss'], total)
+
+    def read_stat(self, pid):
+        try:
+            with open('/proc/{0}/stat'.format(pid)) as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        # The command name is in parentheses and may contain spaces.
+        fields = data[data.rfind(')') + 2:].split()
+        try:
+            return {
+                'pgrp': int(fields[2]),
+                'cpu': (int(fields[11]) + int(fields[12])) / self.clock_ticks,
+                'rss': int(fields[21]) * self.page_size
+            }
+        except (IndexError, ValueError):
+            return None
+
+    def read_io(self, pid):
+        read_bytes = write_bytes = 0
+        try:
+            with open('/proc/{0}/io'.format(pid)) as f:
+                for line in f:
+                    key, value = line.split(':')
+                    if key == 'read_bytes':
+                        read_bytes = int(value)
+                    elif key == 'write_bytes':
+                        write_bytes = int(value)
+        except (IOError, OSError, ValueError):
+            pass
+        return read_bytes, write_bytes
+
+    def finish(self, target_file):
+        """
+        Returns a finished target file's usage as a dict (peak_rss,
+        cpu_seconds, read_bytes, write_bytes), or None if it was never
+        sampled.
+        """
+        usage = self.usage.pop(target_file, None)
+        if usage is None:
+            return None
+        totals = list(usage['pids'].values())
+        return {
+            'peak_rss': usage['peak_rss'],
+            'cpu_seconds': round(sum(t[0] for t in totals), 2),
+            'read_bytes': sum(t[1] for t in totals),
+            'write_bytes': sum(t[2] for t in totals)
+        }
+
+
+class PhaseProfiler(object):
+    """
+    Adds up the time spent in each phase of a run: discovery (and the
+    pattern matching within it), spawning test processes, the test processes
+    themselves, parsing their output, recording results and printing the
+    tally.
+
+    Everything but the test processes is the runner's own overhead. A
+    disabled profiler times nothing, so the phases can be marked everywhere
+    without costing anything when --profile isn't on.
+    """
+
+    # In the order they're reported. Matching happens within discovery.
+    phases = [
+        ('discovery', 'Discovery'),
+        ('matching', '  pattern matching'),
+        ('spawn', 'Process spawn'),
+        ('child', 'Test processes'),
+        ('parsing', 'Output parsing'),
+        ('recording', 'Recording results'),
+        ('rendering', 'Tally rendering'),
+    ]
+    overhead_phases = ['discovery', 'spawn', 'parsing', 'recording',
+                       'rendering']
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.seconds = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.null_phase = _NullPhase()
+
+    def phase(self, name):
+        """Returns a context manager that times a phase."""
+        if not self.enabled:
+            return self.null_phase
+        return _TimedPhase(self, name)
+
+    def add(self, name, seconds):
+        """Adds time to a phase. Output parsing runs on several threads."""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def get_profile(self, wall_seconds, jobs=1):
+        """
+        Returns the breakdown as a dict: each phase's seconds and count, the
+        run's wall time, and the runner's overhead. Overhead is the sum of
+        the runner's own phases, which happen on the main thread one at a
+        time (output parsing aside), next to the wall time of a run of this
+        many jobs.
+        """
+        phases = {}
+        for name, label in self.phases:
+            phases[name] = {
+                'seconds': round(self.seconds.get(name, 0.0), 4),
+                'count': self.counts.get(name, 0)
+            }
+        overhead = sum(self.seconds.get(name, 0.0)
+                       for name in self.overhead_phases)
+        return {
+            'phases': phases,
+            'wall_seconds': round(wall_seconds, 4),
+            'jobs': jobs,
+            'overhead_seconds': round(overhead, 4),
+            'overhead_fraction': round(overhead / wall_seconds, 4)
+            if wall_seconds > 0 else 0.0
+        }
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class _TimedPhase(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add(self.name, time.time() - self.started)
+        return False
+
+
+class Dashboard(threading.Thread):
+    """
+    A status display at the bottom of the terminal, redrawn in place at most
+    every `interval` seconds: the tally, a progress bar with an ETA, the
+    files running right now and the latest failures.
+
+    While it's up, stdout goes through it (see DashboardStream). Anything
+    printed first wipes the display, so regular output scrolls by above it,
+    and the display is drawn again on the next tick.
+    """
+
+    interval = 0.2
+    recent_failures = 5
+
+    def __init__(self, runner):
+        super(Dashboard, self).__init__()
+        self.daemon = True
+        self.runner = runner
+        self.stopped = threading.Event()
+        self.lock = threading.RLock()
+        self.stream = DashboardStream(self, sys.stdout)
+        self.drawn_lines = 0
+        self.dirty = True
+        self.last_drawn = 0
+
+    @classmethod
+    def available(cls):
+        isatty = getattr(sys.stdout, 'isatty', None)
+        return bool(isatty and isatty()) and os.environ.get('TERM') != 'dumb'
+
+    def start(self):
+        sys.stdout = self.stream
+        super(Dashboard, self).start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            # Redraw when something finished, and every second for the
+            # clocks.
+            if self.dirty or time.time() - self.last_drawn >= 1:
+                self.draw()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        with self.lock:
+            self.erase()
+            sys.stdout = self.stream.stream
+
+    def update(self):
+        """Asks for a redraw on the next tick."""
+        self.dirty = True
+
+    def erase(self):
+        if self.drawn_lines:
+            # The cursor is at the end of the display's last line. Go to
+            # the start of its first line, then clear down.
+            self.stream.stream.write(
+                '\r\033[{0}A\033[J'.format(self.drawn_lines - 1)
+                if self.drawn_lines > 1 else '\r\033[J')
+            self.drawn_lines = 0
+
+    def draw(self):
+        with self.lock:
+            if not self.stream.at_line_start:
+                return
+            try:
+                lines = self.runner.dashboard_lines()
+            except RuntimeError:
+                # A dict changed size under us; catch it next time.
+                return
+            width = self.width()
+            lines = [self.fit(line, width) for line in lines]
+            self.erase()
+            self.stream.stream.write('\n'.join(lines))
+            self.stream.stream.flush()
+            self.drawn_lines = len(lines)
+            self.dirty = False
+            self.last_drawn = time.time()
+
+    def width(self):
+        try:
+            return shutil.get_terminal_size().columns
+        except (AttributeError, ValueError, OSError):
+            return 80
+
+    def fit(self, line, width):
+        """
+        Cuts a line down to the terminal's width, so it can't wrap and throw
+        off the count of lines to erase. Color codes take up no room.
+        """
+        out = []
+        visible = 0
+        for part in re.split(r'(\033\[[0-9;]*m)', line):
+            if part.startswith('\033['):
+                out.append(part)
+                continue
+            part = part[:max(0, width - 1 - visible)]
+            visible += len(part)
+            out.append(part)
+        return ''.join(out) + '\033[0m'
+
+
+class DashboardStream(object):
+    """Stands in for stdout while a Dashboard is up."""
+
+    def __init__(self, dashboard, stream):
+        self.dashboard = dashboard
+        self.stream = stream
+        self.at_line_start = True
+
+    def write(self, text):
+        if not text:
+            return
+        with self.dashboard.lock:
+            self.dashboard.erase()
+            self.stream.write(text)
+            self.at_line_start = text.endswith('\n')
+            self.dashboard.dirty = True
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class MessageSocket(object):
+    """
+    A TCP connection between a coordinator and a worker, carrying JSON
+    messages one per line. Any thread may send; one thread reads.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        """
+        Sends a message. Returns False if the connection is gone, which the
+        reading end will find out about too.
+        """
+        data = (json.dumps(message) + '\n').encode('utf-8')
+        with self.lock:
+            try:
+                self.sock.sendall(data)
+                return True
+            except socket.error:
+                return False
+
+    def messages(self):
+        """Yields the messages received until the connection closes."""
+        f = self.sock.makefile('rb')
+        try:
+            for line in iter(f.readline, b''):
+                try:
+                    yield json.loads(line.decode('utf-8'))
+                except ValueError:
+                    return
+        except (socket.error, IOError):
+            return
+        finally:
+            f.close()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+class RemoteWorker(MessageSocket):
+    """
+    The coordinator's end of a connection from a worker. While the worker
+    runs a target file, this stands in for the file's test process in
+    EasyRunner.running, so the dashboard and the watchdog treat it like
+    any other.
+    """
+
+    pid = None
+
+    def __init__(self, sock, address):
+        super(RemoteWorker, self).__init__(sock)
+        self.name = '{0}:{1}'.format(address[0], address[1])
+        self.target_file = None
+
+
+class Coordinator(threading.Thread):
+    """
+    Listens for workers and passes on what they say to the main thread
+    through the events queue, as (kind, worker, message) tuples, where kind
+    is 'joined', 'result' or 'left'. The main thread does the actual
+    coordinating (see EasyRunner.run_test_files_remote).
+    """
+
+    def __init__(self, address):
+        super(Coordinator, self).__init__()
+        self.daemon = True
+        self.events = queue.Queue()
+        self.workers = []
+        self.stopped = threading.Event()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(address)
+        self.server.listen(16)
+        # So that stop() doesn't have to wait on accept().
+        self.server.settimeout(0.25)
+        self.address = self.server.getsockname()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                sock, address = self.server.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            sock.settimeout(None)
+            worker = RemoteWorker(sock, address)
+            self.workers.append(worker)
+            reader = threading.Thread(target=self.read, args=(worker,))
+            reader.daemon = True
+            reader.start()
+        self.server.close()
+
+    def read(self, worker):
+        for message in worker.messages():
+            if message.get('op') == 'hello':
+                worker.name = message.get('name', worker.name)
+                self.events.put(('joined', worker, message))
+            elif message.get('op') == 'result':
+                self.events.put(('result', worker, message))
+        self.events.put(('left', worker, None))
+
+    def stop(self):
+        """Tells every worker the run is over and stops listening."""
+        self.stopped.set()
+        for worker in self.workers:
+            worker.send({'op': 'done'})
+            worker.close()
+
+
+class PollingWatcher(object):
+    """
+    Watches the search paths for changed files by comparing modification
+    times every `interval` seconds. This works everywhere, but each check
+    stats the whole tree; InotifyWatcher is used instead where it can be.
+    Excluded folders (see DiscoveryIndex) aren't watched.
+    """
+
+    interval = 1.0
+
+    def __init__(self, search_paths, exclude_globs=None):
+        self.search_paths = list(search_paths)
+        self.index = DiscoveryIndex(None, exclude_globs)
+        self.mtimes = self.scan()
+
+    def folders(self, search_path, top=None):
+        """Yields the folders under top that aren't excluded."""
+        for root, subfolders, files in os.walk(top or search_path):
+            subfolders[:] = [
+                d for d in subfolders
+                if not self.index.is_excluded(
+                    search_path, os.path.join(root, d))
+            ]
+            yield root, files
+
+    def scan(self):
+        mtimes = {}
+        for search_path in self.search_paths:
+            for root, files in self.folders(search_path):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        mtimes[path] = os.stat(path).st_mtime
+                    except OSError:
+                        pass
+        return mtimes
+
+    def poll(self):
+        """Returns the files added, changed or removed since the last check."""
+        mtimes = self.scan()
+        changed = set(
+            p for p in set(mtimes) | set(self.mtimes)
+            if mtimes.get(p) != self.mtimes.get(p)
+        )
+        self.mtimes = mtimes
+        return changed
+
+    def wait(self, debounce):
+        """
+        Blocks until files change, then until they've stopped changing for
+        `debounce` seconds, and returns the paths that changed.
+        """
+        changed = set()
+        while not changed:
+            time.sleep(self.interval)
+            changed = self.poll()
+        while True:
+            time.sleep(debounce)
+            more = self.poll()
+            if not more:
+                return changed
+            changed |= more
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(PollingWatcher):
+    """
+    Watches the search paths with Linux's inotify, so nothing is checked
+    until the kernel says something changed. Every folder gets a watch of
+    its own, including folders created later.
+
+    If the kernel's event queue overflows, wait() returns None: some changes
+    were lost, so anything could have changed.
+    """
+
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+
+    mask = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_CREATE | IN_DELETE)
+    event = struct.Struct('iIII')
+    libc = None
+
+    @classmethod
+    def available(cls):
+        if cls.libc is None and ctypes is not None:
+            try:
+                libc = ctypes.CDLL(
+                    ctypes.util.find_library('c') or 'libc.so.6',
+                    use_errno=True)
+                libc.inotify_init1
+                cls.libc = libc
+            except (OSError, AttributeError):
+                cls.libc = False
+        return bool(cls.libc)
+
+    def __init__(self, search_paths, exclude_globs=None):
+        self.search_paths = list(search_paths)
+        self.index = DiscoveryIndex(None, exclude_globs)
+        self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+        for search_path in self.search_paths:
+            self.add_watches(search_path, search_path)
+
+    def add_watches(self, search_path, top):
+        """
+        Watches top and the folders in it, and returns the files already
+        there (a new folder may have been filled before it was watched).
+        """
+        found = set()
+        for root, files in self.folders(search_path, top):
+            wd = self.libc.inotify_add_watch(
+                self.fd, root.encode(sys.getfilesystemencoding()), self.mask)
+            if wd >= 0:
+                self.watches[wd] = (search_path, root)
+            found.update(os.path.join(root, name) for name in files)
+        return found
+
+    def read_events(self, timeout):
+        """
+        Returns the paths in the events that arrive within timeout seconds,
+        or None if the event queue overflowed.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        data = os.read(self.fd, 64 * 1024)
+        changed = set()
+        overflowed = False
+        offset = 0
+        while offset + self.event.size <= len(data):
+            wd, mask, cookie, length = self.event.unpack_from(data, offset)
+            offset += self.event.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                overflowed = True
+                continue
+            if wd not in self.watches:
+                continue
+            search_path, root = self.watches[wd]
+            path = os.path.join(
+                root, name.decode(sys.getfilesystemencoding(), 'replace'))
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO) and \
+                        not self.index.is_excluded(search_path, path):
+                    changed |= self.add_watches(search_path, path)
+                continue
+            changed.add(path)
+        return None if overflowed else changed
+
+    def wait(self, debounce):
+        changed = set()
+        while changed is not None and not changed:
+            changed = self.read_events(None)
+        while True:
+            more = self.read_events(debounce)
+            if more is None:
+                changed = None
+            elif not more:
+                return changed
+            elif changed is not None:
+                changed |= more
+
+    def close(self):
+        os.close(self.fd)
+
+
+class EasyRunner(object):
+    """
+    Abstract parent class. This must be subclassed for each type of test
+    in order to provide the specifics such as pass/fail regexes and witty
+    titles.
+
+    Note that this class is doing too much. If I actually end up using this
+    on another project, perhaps I'll break it up.
+    """
+
+    title = 'EasyRunner'
+    command = None
+    command_preps = set()
+    command_path = None
+    command_prefixes = set()
+    command_suffixes = set()
+    search_paths = set()
+    file_optional_res = set()
+    file_required_res = set()
+    target_files = []
+    use_all_files = False
+    use_index = True
+    exclude_globs = set([
+        '.git', '.hg', '.svn', 'node_modules', 'vendor', '__pycache__'
+    ])
+    walk_threads = 4
+    quiet_search = False
+    start_time = None
+
+    cli_args = None
+    cli_value_args = set([
+        '-sp', '-cp', '-op', '-j', '--jobs', '-x', '--exclude',
+        '--walk-threads', '--engine', '--shard', '--shard-timings',
+        '--timeout',
+        '--global-timeout', '--batch', '--preload', '--changed-since',
+        '--cache-input', '--retries', '--serve', '--worker'
+    ])
+    # These pick the runner (see __main__) and aren't search patterns.
+    cli_runner_args = set(['--behat', '--nose'])
+    config_parts = []
+
+    verbose = False
+    jobs = 1
+    engine = 'threads'
+    running = {}
+    started_at = None
+    exit_codes = {}
+    durations = {}
+    results_db = None
+    run_id = None
+    failed_files = []
+    history_loaded = False
+    rerun_failed = False
+    failures_first = False
+    retries = 0
+    pending = []
+    attempts = {}
+    flaky = []
+    flake_rates = {}
+    shard = None
+    shard_timings_file = '.easyrunner_timings.json'
+    save_timings = False
+    serve_address = None
+    worker_address = None
+    worker_connect_timeout = 60
+    # How long after the global timeout's kills to wait for workers to
+    # answer before giving up on them.
+    worker_grace = 5
+    timeout = None
+    global_timeout = None
+    kill_grace = 5
+    timed_out = set()
+    global_timed_out = False
+    run_started = None
+    sample_resources = False
+    sampler = None
+    # Set this if the command needs a shell (pipes, &&, variables and so on).
+    # Otherwise it's run directly, which is quicker and leaves paths alone.
+    shell = False
+    batchable = False
+    batch_size = None
+    batch_seconds = 30
+    max_batch_size = 100
+    batches = {}
+    splittable = False
+    split_files = False
+    splits = {}
+    split_of = {}
+    part_results = {}
+    traces_imports = False
+    changed_since = None
+    use_cache = False
+    no_cache = False
+    cache_inputs = []
+    cache_size = 5000
+    cache_keys = {}
+    cached = set()
+    watch = False
+    watch_debounce = 0.3
+    use_dashboard = None
+    dashboard = None
+    early_failures = None
+    forkable = False
+    use_fork_server = False
+    preload_modules = []
+    fork_server = None
+    profiler = None
+    spools = {}
+    spool_dir = None
+    # How many of a failed file's last lines of output stay in the test log.
+    # The rest is in the file's spool.
+    excerpt_lines = 20
+    parse_output_lines = False
+    output_states = {}
+
+    pass_count_re = None
+    fail_count_re = None
+    test_log = {
+        'files': {},
+        'passes': 0,
+        'failures': 0,
+        'failed_tests': []
+    }
+
+    clr = {
+        'HEADER': '\033[95m',
+        'BLUE': '\033[94m',
+        'GREEN': '\033[92m',
+        'WARN': '\033[93m',
+        'FAIL': '\033[91m',
+        'ENDC': '\033[0m'
+    }
+
+    def __init__(self):
+        self.set_command_path(os.getcwd())
+        # Per runner, so that runners in the same process (workers, tests)
+        # keep to themselves.
+        self.started_at = {}
+        self.early_failures = []
+        self.profiler = PhaseProfiler()
+        self.file_optional_res = set(self.file_optional_res)
+        self.file_required_res = set(self.file_required_res)
+        self.exclude_globs = set(self.exclude_globs)
+
+    def set_cli_args(self, args):
+        """Accepts the command line arguments for the current invocation."""
+        # Not sure why I don't just grab them in __init__(). Maybe I had a
+        # reason? Maybe they shouldn't be processed until whatever is
+        # instantiating the runner does some setup work.
+        # Revisit this.
+        self.cli_args = args
+        self.process_cli_args()
+
+    def set_title(self, title):
+        """
+        Sets the title. This has no impact on anything but the header that's
+        printed on execution. This allows each subclass to distinguish
+        itself.
+        """
+        self.title = title
+
+    def set_command(self, command):
+        """
+        Sets the command that runs the tests. python, nosetests, bin/behat,
+        whatever.
+        """
+        self.command = command
+
+    def set_command_path(self, path):
+        """
+        Sets the path from which the test-runner command should be executed.
+        """
+        if os.path.isdir(path):
+            self.command_path = path
+        else:
+            print(self.bad("Bad command path provided: {}".format(path)))
+            self.quit()
+
+    def add_search_path(self, path):
+        """Adds a path in which to go a test searchin'."""
+        if path[0] == '~':
+            path = os.path.expanduser(path)
+        if os.path.exists(path):
+            self.search_paths.add(path)
+
+    def add_optional_pattern(self, pattern):
+        """
+        Adds an *optional* regular expression. A test file must match at least
+        one of these to be included.
+        """
+        self.file_optional_res.add(re.compile(pattern, re.I))
+
+    def add_required_pattern(self, pattern):
+        """
+        Adds a *required* regular expression. If a test file does not match this,
+        it is excluded.
+        """
+        self.file_required_res.add(re.compile(pattern, re.I))
+
+    def add_exclude_glob(self, pattern):
+        """
+        Adds a glob for folders that shouldn't be searched, like 'build' or
+        'tests/fixtures'. Matching folders are skipped along with everything
+        in them.
+        """
+        self.exclude_globs.add(pattern)
+
+    def add_prefix(self, prefix):
+        """
+        Adds a command option/prefix. This will be included in the command
+        after the command itself, but before the test file path. It's split
+        into arguments like a shell would, so '--config "my file"' works.
+        """
+        self.command_prefixes.add(prefix)
+
+    def add_suffix(self, suffix):
+        """
+        Adds a command suffix. This will be appended to the command after the
+        test file path, split into arguments like a prefix.
+        """
+        self.command_suffixes.add(suffix)
+
+    def set_verbose(self, verbose):
+        """Sets verbosity mode."""
+        self.verbose = bool(verbose)
+
+    def set_jobs(self, jobs):
+        """
+        Sets how many test files may run at once. Accepts a number or 'auto',
+        which means one job per CPU.
+        """
+        if jobs == 'auto':
+            jobs = multiprocessing.cpu_count()
+        try:
+            jobs = int(jobs)
+        except (TypeError, ValueError):
+            print(self.bad('Bad job count: {0}'.format(jobs)))
+            self.quit()
+        self.jobs = max(1, jobs)
+
+    def set_walk_threads(self, threads):
+        """Sets how many threads walk the folders when finding test files."""
+        try:
+            threads = int(threads)
+        except (TypeError, ValueError):
+            print(self.bad('Bad walk thread count: {0}'.format(threads)))
+            self.quit()
+        self.walk_threads = max(1, threads)
+
+    def set_engine(self, engine):
+        """
+        Sets what runs the test processes: 'threads' (the default) or 'async'.
+        """
+        if engine not in ('threads', 'async'):
+            print(self.bad('Unknown engine: {0}'.format(engine)))
+            self.quit()
+        self.engine = engine
+
+    def set_retries(self, retries):
+        """
+        Sets how many more times a failed target file is run before it
+        counts as failed.
+        """
+        try:
+            retries = int(retries)
+        except (TypeError, ValueError):
+            print(self.bad('Bad retry count: {0}'.format(retries)))
+            self.quit()
+        self.retries = max(0, retries)
+
+    def set_shard(self, shard):
+        """
+        Sets which slice of the target files this machine runs, given as
+        'i/N': the i-th of N shards, counting from 1.
+        """
+        try:
+            index, count = [int(part) for part in shard.split('/')]
+        except ValueError:
+            index, count = 0, 0
+        if count < 1 or index < 1 or index > count:
+            print(self.bad('Bad shard (expected i/N): {0}'.format(shard)))
+            self.quit()
+        self.shard = (index, count)
+
+    def set_serve_address(self, address):
+        """
+        Makes this runner a coordinator, handing its target files out to
+        workers that connect to the given 'host:port' (or just 'port', on
+        localhost).
+        """
+        self.serve_address = self.parse_address(address, '127.0.0.1')
+
+    def set_worker_address(self, address):
+        """
+        Makes this runner a worker for the coordinator at 'host:port': it
+        runs whatever target files it's sent instead of finding its own.
+        """
+        self.worker_address = self.parse_address(address)
+
+    def parse_address(self, address, default_host=None):
+        """Parses 'host:port' (or 'port') into a (host, port) tuple."""
+        host, colon, port = str(address).rpartition(':')
+        if not colon:
+            host = default_host
+        try:
+            port = int(port)
+        except ValueError:
+            port = -1
+        if not host or not 0 <= port < 65536:
+            print(self.bad('Bad address (expected host:port): {0}'.format(
+                address)))
+            self.quit()
+        return (host, port)
+
+    def set_batch_size(self, size):
+        """
+        Sets how many target files to pass to each run of the test command:
+        a number, or 'auto' to size batches by their files' expected
+        durations. Only runners whose command takes several files at once
+        (batchable) can do this.
+        """
+        if not self.batchable:
+            print(self.warn('{0} runs one file at a time; ignoring --batch.'
+                            .format(self.title)))
+            return
+        if size != 'auto':
+            try:
+                size = int(size)
+            except (TypeError, ValueError):
+                size = 0
+            if size < 1:
+                print(self.bad('Bad batch size: {0}'.format(size)))
+                self.quit()
+        self.batch_size = size
+
+    def set_fork_server(self, use_fork_server, preload_modules=None):
+        """
+        Turns the fork server on or off (see easyrunner_forkserver), and adds
+        any modules it should import before forking. Only runners that run
+        Python test files directly (forkable) can use it.
+        """
+        if use_fork_server and not self.forkable:
+            print(self.warn('{0} can\'t use a fork server; ignoring it.'
+                            .format(self.title)))
+            return
+        self.use_fork_server = bool(use_fork_server)
+        if preload_modules:
+            self.preload_modules = self.preload_modules + [
+                m for m in preload_modules if m not in self.preload_modules]
+
+    def set_split(self, split_files):
+        """
+        Turns on running each target file in parts (see split_target_files),
+        for runners that know how to split their files (splittable).
+        """
+        if split_files and not self.splittable:
+            print(self.warn('{0} can\'t split its files; ignoring it.'
+                            .format(self.title)))
+            return
+        self.split_files = bool(split_files)
+
+    def set_changed_since(self, ref):
+        """
+        Narrows the target files down to those affected by what changed
+        since a git ref (see select_impacted_files). Only runners for Python
+        test files (traces_imports) can do this.
+        """
+        if not self.traces_imports:
+            print(self.warn('{0} can\'t trace imports; ignoring '
+                            '--changed-since.'.format(self.title)))
+            return
+        self.changed_since = ref
+
+    def set_timeout(self, seconds):
+        """
+        Sets how many seconds a single target file may run before it's killed
+        and logged as timed out.
+        """
+        self.timeout = self.parse_seconds(seconds)
+
+    def set_global_timeout(self, seconds):
+        """
+        Sets how many seconds the whole run may take. Once that's up, the
+        running files are killed and logged as timed out, and the rest are
+        skipped.
+        """
+        self.global_timeout = self.parse_seconds(seconds)
+
+    def get_timeout(self, target_file):
+        """
+        Returns how many seconds a target file may run, or None. A batch gets
+        the per-file timeout for each of its files.
+        """
+        if self.timeout is None:
+            return None
+        return self.timeout * len(self.batches.get(target_file, [target_file]))
+
+    def parse_seconds(self, seconds):
+        try:
+            seconds = float(seconds)
+        except (TypeError, ValueError):
+            seconds = 0
+        if seconds <= 0:
+            print(self.bad('Bad timeout: {0}'.format(seconds)))
+            self.quit()
+        return seconds
+
+    def time_passed(self):
+        """Returns how much time has passed since the tests began."""
+        diff = datetime.datetime.now() - self.start_time
+        # Since we want this for user feedback, we'll let the timedelta
+        # stringify itself.
+        return str(diff).split('.')[0]
+
+    def log_failure(self, target):
+        """Log that a test has failed."""
+
+        # Obviously we don't need the separate count field if it's always going
+        # to match the number of test files that have failed. However, I
+        # think the plan was to let them diverge under certain circumstances.
+        # Need to revisit this.
+        self.test_log['failures'] += 1
+
+        # A set would be cleaner here, but I like keeping the failures
+        # in order. It makes the progressive tally more readable.
+        if target not in self.test_log['failed_tests']:
+            self.test_log['failed_tests'].append(target)
+
+    def log_pass(self):
+        """
+        Log that a test has passed. This is all we save for now, since we
+        want additional details only for tests that failed.
+        """
+        self.test_log['passes'] += 1
+
+    def strip_ansi(self, text):
+        """
+        Remove ansi codes from text (such as text from the console).
+        """
+
+        # Some test runners don't let you disable colored output.
+        # <cough>PHPUnit</cough>
+        # https://github.com/sebastianbergmann/phpunit/issues/516
+
+        return re.sub(r'\033\[[0-9;]+m|\[2K', '', text)
+
+    def run(self):
+        """Starts the tests a runnin'."""
+        self.print_title()
+
+        # A worker runs whatever the coordinator sends it.
+        if self.worker_address is not None:
+            self.target_files = []
+            self.run_tests()
+            return
+
+        # If no search string, try to resume state from the prior run
+        if len(self.cli_args) == 1:
+            self.resume_state()
+        elif self.rerun_failed:
+            self.resume_failed()
+        else:
+            self.validate()
+            with self.profiler.phase('discovery'):
+                target_files = self.find_target_files()
+                if self.save_timings:
+                    self.save_shard_timings(target_files)
+                if self.changed_since is not None:
+                    target_files = self.select_impacted_files(target_files)
+                self.target_files = self.shard_target_files(target_files)
+
+            if len(self.target_files) == 0:
+                print(self.bad('No matches found.'))
+                self.quit()
+
+            self.print_test_scope()
+            self.prompt_user()
+
+    def print_title(self):
+        """
+        Wipes the /usr directory.
+
+        Just kidding. Prints the title.
+        """
+        print(self.header('\n----- ' + self.title + ' -----\n'))
+
+    def print_test_scope(self):
+        """Prints the target files and related parameters (verbosity, etc.)"""
+        print(self.status('Target Files:'))
+        count = 1
+        for f in self.target_files:
+            number_prefix = "[{0}]".format(count)
+            head, tail = os.path.split(self.get_path_rel_to_command_path(f))
+            print("\t{0}: {1}".format(
+                number_prefix,
+                (head + '/' + self.warn(tail))
+            ))
+            count += 1
+
+        if self.verbose:
+            if 'silent' not in self.config_parts:
+                self.config_parts.append('silent')
+            try:
+                self.config_parts.remove('verbose')
+            except ValueError:
+                pass
+        else:
+            if 'verbose' not in self.config_parts:
+                self.config_parts.append('verbose')
+            try:
+                self.config_parts.remove('silent')
+            except ValueError:
+                pass
+
+        colored_config_parts = [self.good(cp) for cp in self.config_parts]
+        config_str = '[ ' + ' | '.join(colored_config_parts) + ' ]'
+        print('{0}'.format(config_str))
+
+    def print_commands(self):
+        """Print available command-prompt commands."""
+        command_sets = [
+            ('Enter', 'Run the listed test files'),
             ('#, #, #-#', 'Limit to specified file numbers'),
             ('v', 'Toggle verbosity'),
             ('q | ^C', 'Quit')
         ]
 
-        max_command_len = 0
-        for command_set in command_sets:
-            if len(command_set[0]) > max_command_len:
-                max_command_len = len(command_set[0])
+        max_command_len = 0
+        for command_set in command_sets:
+            if len(command_set[0]) > max_command_len:
+                max_command_len = len(command_set[0])
+
+        max_command_len += 5
+        for command_set in command_sets:
+            command_ = command_set[0]
+            c_len = len(command_)
+            print('{0}{1}{2}'.format(
+                command_,
+                ' '.join('' for i in range(max_command_len - c_len)),
+                command_set[1]
+            ))
+
+    def prompt_user(self):
+        """Prompts the user and deals with the response."""
+        try:
+            print
+            c = raw_input(self.status('Command [? for options]: '))
+        except KeyboardInterrupt:
+            self.quit()
+        c = c.lower()
+        if c == '?':
+            self.print_test_scope()
+            self.print_commands()
+            self.prompt_user()
+            return
+        elif c == 'v':
+            self.verbose = not self.verbose
+            print
+            self.print_test_scope()
+            self.prompt_user()
+            return
+        elif c in ['n', 'q']:
+            self.quit()
+
+        # Handle number input, including spans
+        numbers = set()
+        parts = [part.strip() for part in c.split(',')]
+
+        for part in parts:
+            if '-' in part:
+                span_parts = part.split('-')
+                start = int(span_parts[0])
+                end = int(span_parts[1])
+                for i in range(start, end + 1):
+                    numbers.add(i)
+                continue
+            try:
+                num = int(part)
+                if num < 1 or num > len(self.target_files):
+                    print(self.bad((
+                        'That number is not in the list! Try again.\n')))
+                    return self.prompt_user()
+                    numbers.add(num)
+            except ValueError:
+                pass
+
+        if len(numbers) > 0:
+            self.target_files = [self.target_files[i-1] for i in numbers]
+            self.print_test_scope()
+            self.prompt_user()
+            return
+
+        self.save_state()
+        self.run_tests()
+        if self.watch:
+            self.watch_target_files()
+
+    def prompt_resume_state(self):
+        """Prompts the user to resume prior state."""
+        try:
+            print
+            c = raw_input(
+                self.status("Hit anything but 'q' to re-run last batch: ")
+            )
+        except KeyboardInterrupt:
+            self.quit()
+        c = c.lower()
+        if c in ['q', 'n']:
+            self.quit()
+        self.run_tests()
+        if self.watch:
+            self.watch_target_files()
+
+    def get_state_save_path(self):
+        """
+        Gets the path of the old pickled state. Only the discovery index and
+        results database paths are built from it now, and load_state falls
+        back to reading it.
+        """
+        filename = '.{0}_state'.format(
+            ('_'.join(self.title.split())).lower()
+        )
+        script_path = os.path.split(os.path.realpath(__file__))[0]
+        return os.path.join(script_path, filename)
+
+    def get_index_save_path(self):
+        """Gets the path at which to save the discovery index."""
+        return self.get_state_save_path()[:-len('_state')] + '_index'
+
+    def get_imports_save_path(self):
+        """Gets the path at which to save the import graph."""
+        return self.get_state_save_path()[:-len('_state')] + '_imports'
+
+    def get_results_db_path(self):
+        """
+        Gets the path of the results database. It's shared by every runner
+        that saves its state in the same place.
+        """
+        return os.path.join(
+            os.path.dirname(self.get_state_save_path()),
+            '.easyrunner_results.db'
+        )
+
+    def get_results_db(self):
+        """Opens the results database the first time it's needed."""
+        if self.__dict__.get('results_db') is None:
+            self.results_db = ResultsDB(self.get_results_db_path(), self.title)
+        return self.results_db
+
+    def load_state(self):
+        """Tries to fetch the saved state from the results database."""
+        state_obj = self.get_results_db().load_state()
+        if state_obj is not None:
+            return state_obj
+
+        # Fall back to the state pickled by older versions.
+        try:
+            with open(self.get_state_save_path(), 'rb') as f:
+                return pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return False
+
+    def save_state(self):
+        """Saves the runner's state."""
+        state = {
+            'files': self.target_files,
+            'verbose': self.verbose,
+            'jobs': self.jobs,
+            'engine': self.engine,
+            'batch': self.batch_size,
+            'fork_server': self.use_fork_server,
+            'preload': self.preload_modules,
+            'watch': self.watch,
+            'cache': self.use_cache,
+            'cache_inputs': self.cache_inputs,
+            'retries': self.retries,
+            'serve': self.serve_address,
+            'split': self.split_files
+        }
+        child_state = self.get_state()
+        for key in child_state:
+            state[key] = child_state[key]
+        self.get_results_db().save_state(state)
+
+    def load_history(self):
+        """
+        Loads the per-file timing history, flake rates and the files that
+        failed last time they ran from the results database. This only
+        happens once per run, so anything recorded since isn't clobbered.
+        """
+        if self.history_loaded:
+            return
+        results_db = self.get_results_db()
+        self.durations = results_db.durations()
+        self.failed_files = results_db.failed_files()
+        self.flake_rates = results_db.flake_rates()
+        self.history_loaded = True
+
+    def record_outcome(self, target_file):
+        """
+        Keeps failed_files up to date after a target file has run: it's added
+        if it failed and dropped if it passed. Files that didn't run this
+        time keep whatever outcome they had.
+        """
+        failed = target_file in self.test_log['failed_tests']
+        if failed and target_file not in self.failed_files:
+            self.failed_files.append(target_file)
+        elif not failed and target_file in self.failed_files:
+            self.failed_files.remove(target_file)
 
-        max_command_len += 5
-        for command_set in command_sets:
-            command_ = command_set[0]
-            c_len = len(command_)
-            print('{0}{1}{2}'.format(
-                command_,
-                ' '.join('' for i in range(max_command_len - c_len)),
-                command_set[1]
+    def record_result(self, target_file, duration, resources=None):
+        """Appends a target file's result to the results database."""
+        if self.run_id is None:
+            return
+        if target_file in self.timed_out:
+            outcome = 'timed out'
+        elif target_file in self.test_log['failed_tests']:
+            outcome = 'failed'
+        else:
+            outcome = 'passed'
+        exit_code = self.exit_codes.pop(target_file, None)
+        results_db = self.get_results_db()
+        results_db.record_result(
+            self.run_id,
+            target_file,
+            outcome,
+            duration,
+            exit_code,
+            resources,
+            self.attempts.get(target_file, 1)
+        )
+
+        # Only a clean exit counts, since not every runner parses its output
+        # for failures.
+        key = self.cache_keys.pop(target_file, None)
+        if key is not None:
+            if outcome == 'passed' and exit_code == 0:
+                results_db.cache_pass(key, target_file, self.cache_size)
+            else:
+                results_db.uncache(key)
+
+    def resources_str(self, resources):
+        """Formats a target file's sampled resource usage for printing."""
+        return '[peak {0:.0f} MB | cpu {1:.1f}s | read {2:.1f} MB | ' \
+            'written {3:.1f} MB]'.format(
+                resources['peak_rss'] / 1048576.0,
+                resources['cpu_seconds'],
+                resources['read_bytes'] / 1048576.0,
+                resources['write_bytes'] / 1048576.0
+            )
+
+    def print_heaviest_files(self, limit=5):
+        """Prints the files with the highest peak memory use on record."""
+        heaviest = self.get_results_db().heaviest_files(limit)
+        if len(heaviest) == 0:
+            return
+        print(self.header('\nHeaviest Files (peak RSS, average CPU)'))
+        for target_file, peak_rss, cpu_seconds in heaviest:
+            print('\t{0:>6.0f} MB {1:>8.1f}s  {2}'.format(
+                peak_rss / 1048576.0,
+                cpu_seconds or 0,
+                self.get_path_rel_to_command_path(target_file)
             ))
 
-    def prompt_user(self):
-        """Prompts the user and deals with the response."""
+    def put_failures_first(self, target_files):
+        """Moves the files that failed last time to the front."""
+        failed = set(self.failed_files)
+        return (
+            [t for t in target_files if t in failed] +
+            [t for t in target_files if t not in failed]
+        )
+
+    def put_flaky_first(self, target_files):
+        """
+        Moves the files known to be flaky to the front, so that if they fail
+        their retries don't hold up the end of the run.
+        """
+        return (
+            [t for t in target_files if t in self.flake_rates] +
+            [t for t in target_files if t not in self.flake_rates]
+        )
+
+    def retry_failed(self, target_file, duration=None):
+        """
+        Queues a target file that just failed to run again, if it has
+        retries left. Its failure is taken back out of the test log, so only
+        the last attempt counts. Returns whether it was queued.
+        """
+        attempt = self.attempts.get(target_file, 1)
+        if target_file not in self.test_log['failed_tests'] or \
+                attempt > self.retries or self.global_timed_out:
+            return False
+        self.attempts[target_file] = attempt + 1
+        self.unlog_file(target_file)
+        self.pending.append(target_file)
+
+        parts = [self.warn('[RETRYING]'),
+                 self.get_path_rel_to_command_path(target_file)]
+        if duration is not None:
+            parts.append(self.status('{0:.1f}s'.format(duration)))
+        parts.append('(attempt {0} of {1})'.format(
+            attempt + 1, self.retries + 1))
+        print(' '.join(parts))
+        return True
+
+    def unlog_file(self, target_file):
+        """Takes a target file's outcome back out of the test log."""
+        if target_file in self.test_log['failed_tests']:
+            self.test_log['failed_tests'].remove(target_file)
+            self.test_log['failures'] -= 1
+        elif target_file in self.test_log['files']:
+            self.test_log['passes'] -= 1
+        self.test_log['files'].pop(target_file, None)
+        self.timed_out.discard(target_file)
+        if target_file in self.early_failures:
+            self.early_failures.remove(target_file)
+
+    def note_flaky(self, target_file):
+        """Notes a target file that passed on a retry."""
+        if self.attempts.get(target_file, 1) > 1 and \
+                target_file not in self.test_log['failed_tests']:
+            self.flaky.append(target_file)
+
+    def record_duration(self, target_file, seconds):
+        """
+        Records how long a target file took. This is smoothed against the
+        prior timing so one unusually slow (or fast) run doesn't throw off
+        the next schedule too badly.
+        """
+        prior = self.durations.get(target_file)
+        if prior is None:
+            self.durations[target_file] = seconds
+        else:
+            self.durations[target_file] = (prior + seconds) / 2.0
+
+    def expected_duration(self, target_file, default=None):
+        """Returns the expected duration of a target file, in seconds."""
+        return self.durations.get(target_file, default)
+
+    def shard_target_files(self, target_files):
+        """
+        Returns the target files in this machine's shard.
+
+        Files are handed out longest first, each to the shard with the least
+        expected work so far, so the shards should all take about as long.
+        Every machine works this out on its own and has to arrive at the same
+        split, so the timings come from the shared timings file (see
+        save_shard_timings) rather than this machine's own history, which
+        drifts from the others' as soon as they've run. Without the file the
+        files are split evenly by count. Files are compared by their path
+        relative to the command path, so checkouts can live in different
+        places.
+        """
+        if self.shard is None:
+            return target_files
+        index, count = self.shard
+
+        timings = self.load_shard_timings()
+        paths = dict(
+            (t, self.get_path_rel_to_command_path(t)) for t in target_files)
+        known = sorted(timings[p] for p in paths.values() if p in timings)
+        default = known[len(known) // 2] if known else 1.0
+
+        def expected(t):
+            return timings.get(paths[t], default)
+
+        loads = [0.0] * count
+        mine = set()
+        for t in sorted(target_files, key=lambda t: (-expected(t), paths[t])):
+            lightest = loads.index(min(loads))
+            loads[lightest] += expected(t)
+            if lightest == index - 1:
+                mine.add(t)
+
+        return [t for t in target_files if t in mine]
+
+    def get_shard_timings_path(self):
+        """
+        Gets the path of the timings file shards are balanced on. By default
+        it's in the command path, so it can be committed with the tests.
+        """
+        return os.path.join(self.command_path, self.shard_timings_file)
+
+    def load_shard_timings(self):
+        """
+        Returns {path relative to the command path: seconds} from the
+        timings file, or {} if there isn't one.
+        """
         try:
-            print
-            c = raw_input(self.status('Command [? for options]: '))
+            with open(self.get_shard_timings_path()) as f:
+                timings = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(timings, dict):
+            return {}
+        return dict(
+            (path, float(seconds)) for path, seconds in timings.items()
+            if isinstance(seconds, (int, float))
+        )
+
+    def save_shard_timings(self, target_files):
+        """
+        Writes the target files' recorded durations to the timings file, for
+        every machine to balance its shard on.
+        """
+        self.load_history()
+        timings = dict(
+            (self.get_path_rel_to_command_path(t), round(self.durations[t], 3))
+            for t in target_files if t in self.durations
+        )
+        path = self.get_shard_timings_path()
+        with open(path, 'w') as f:
+            json.dump(timings, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(self.status('Saved the timings of {0} files to {1}'.format(
+            len(timings), path)))
+
+    def schedule_target_files(self, target_files):
+        """
+        Returns the target files in the order they should be dispatched:
+        longest first, according to the timing history. Files without any
+        history are assumed to take the median time of those with one.
+
+        Starting the long ones first keeps a slow file from being picked up
+        last and holding up the end of a parallel run.
+        """
+        known = sorted(
+            self.durations[t] for t in target_files if t in self.durations
+        )
+        if len(known) == 0:
+            return list(target_files)
+
+        default = known[len(known) // 2]
+        # sorted() is stable, so ties keep their discovery order.
+        return sorted(
+            target_files,
+            key=lambda t: self.expected_duration(t, default),
+            reverse=True
+        )
+
+    def make_batches(self, target_files):
+        """
+        Groups the target files into batches, each run by a single test
+        process, and returns what to run: a name for each batch, and the
+        files that ended up on their own. Files stay in the order given.
+
+        With a fixed batch size, files are simply taken that many at a time.
+        With 'auto', a batch takes files until its expected duration would
+        go over batch_seconds (files without any history are assumed to take
+        the median time), but never more than max_batch_size files, and
+        batches are kept short enough that every job gets some.
+        """
+        if self.batch_size == 'auto':
+            known = sorted(
+                self.durations[t] for t in target_files
+                if t in self.durations)
+            default = known[len(known) // 2] if known else 1.0
+            total = sum(self.expected_duration(t, default)
+                        for t in target_files)
+            budget = min(self.batch_seconds, total / self.jobs)
+            limit = self.max_batch_size
+        else:
+            default = budget = None
+            limit = self.batch_size
+
+        groups = []
+        group = []
+        load = 0.0
+        for t in target_files:
+            expected = 0.0
+            if budget is not None:
+                expected = self.expected_duration(t, default)
+            if group and (len(group) >= limit or
+                          (budget is not None and load + expected > budget)):
+                groups.append(group)
+                group = []
+                load = 0.0
+            group.append(t)
+            load += expected
+        if group:
+            groups.append(group)
+
+        self.batches = {}
+        batched = []
+        for group in groups:
+            if len(group) == 1:
+                batched.append(group[0])
+                continue
+            name = 'batch {0} ({1} files)'.format(
+                len(self.batches) + 1, len(group))
+            self.batches[name] = group
+            batched.append(name)
+        return batched
+
+    def split_target_files(self, target_files):
+        """
+        Replaces each target file that get_file_parts splits up with its
+        parts, to be run on their own, so that one long file can be spread
+        over all the jobs. The parts keep their file's place in the order,
+        and are each expected to take an even share of its time. Each file
+        is logged once all of its parts are done (see log_part_result).
+        """
+        units = []
+        for target_file in target_files:
+            parts = self.get_file_parts(target_file)
+            if len(parts) < 2:
+                units.append(target_file)
+                continue
+            self.splits[target_file] = parts
+            expected = self.expected_duration(target_file)
+            for part in parts:
+                self.split_of[part] = target_file
+                if expected is not None:
+                    self.durations[part] = expected / len(parts)
+            units.extend(parts)
+        return units
+
+    def get_file_parts(self, target_file):
+        """
+        Override me to list the parts a target file can be run in, as
+        arguments the test command accepts in place of the file.
+        """
+        return [target_file]
+
+    def join_part_outputs(self, target_file, outputs):
+        """
+        Override me to combine what was logged for each part of a split file
+        into what's logged for the file. By default it's put together in
+        order.
+        """
+        if all(isinstance(o, list) for o in outputs):
+            return [line for o in outputs for line in o]
+        return ''.join(
+            ''.join(o) if isinstance(o, list) else o for o in outputs)
+
+    def get_cache_key(self, target_file, inputs_digest):
+        """
+        Returns the key a target file's pass is cached under: a hash of the
+        file's contents, the command that runs it, and the contents of the
+        declared input files. None if the file can't be read.
+        """
+        file_digest = self.file_digest(target_file)
+        if file_digest is None:
+            return None
+        # The prefixes and suffixes are sorted, since the order of a set
+        # changes from one process to the next.
+        command = [self.command] + sorted(self.command_prefixes) + [
+            target_file] + sorted(self.command_suffixes)
+        key = hashlib.sha1()
+        for part in [file_digest] + command + [inputs_digest]:
+            key.update(part.encode('utf-8'))
+            key.update(b'\0')
+        return key.hexdigest()
+
+    def get_inputs_digest(self):
+        """
+        Returns a hash of the files matching the cache_inputs globs (config
+        files, fixtures and so on), relative to the command path.
+        """
+        paths = set()
+        for pattern in self.cache_inputs:
+            pattern = os.path.join(self.command_path, pattern)
+            try:
+                paths.update(glob.glob(pattern, recursive=True))
+            except TypeError:
+                paths.update(glob.glob(pattern))
+        digest = hashlib.sha1()
+        for path in sorted(paths):
+            if os.path.isfile(path):
+                digest.update('{0}\0{1}\0'.format(
+                    path, self.file_digest(path)).encode('utf-8'))
+        return digest.hexdigest()
+
+    def skip_cached_files(self, target_files):
+        """
+        Logs the target files that have a cached pass as passed, without
+        running them, and returns the rest. With no_cache set nothing is
+        skipped, but passes are still cached.
+        """
+        inputs_digest = self.get_inputs_digest()
+        for t in target_files:
+            key = self.get_cache_key(t, inputs_digest)
+            if key is not None:
+                self.cache_keys[t] = key
+        if self.no_cache:
+            return target_files
+
+        hits = self.get_results_db().cached_passes(
+            set(self.cache_keys.values()))
+        remaining = []
+        for t in target_files:
+            if self.cache_keys.get(t) not in hits:
+                remaining.append(t)
+                continue
+            del self.cache_keys[t]
+            self.cached.add(t)
+            self.test_log['files'][t] = ['cached']
+            self.log_pass()
+            self.report_file_done(t)
+        return remaining
+
+    def get_changed_files(self, ref):
+        """
+        Returns the absolute paths of the files that differ from a git ref:
+        committed since, changed in the working tree, or untracked.
+        """
+        cwd = self.command_path
+        try:
+            top = sub.check_output(
+                ['git', 'rev-parse', '--show-toplevel'],
+                cwd=cwd, universal_newlines=True).strip()
+            names = sub.check_output(
+                ['git', 'diff', '--name-only', ref, '--'],
+                cwd=top, universal_newlines=True).splitlines()
+            names += sub.check_output(
+                ['git', 'ls-files', '--others', '--exclude-standard'],
+                cwd=top, universal_newlines=True).splitlines()
+        except (OSError, sub.CalledProcessError) as e:
+            print(self.bad('Could not get the changes since {0}: {1}'.format(
+                ref, e)))
+            self.quit()
+        return [os.path.join(top, name) for name in names if name]
+
+    def select_impacted_files(self, target_files):
+        """
+        Returns the target files that import (however indirectly) a module
+        changed since the changed_since ref, or were changed themselves.
+        """
+        changed = self.get_changed_files(self.changed_since)
+        roots = [self.command_path] + sorted(self.search_paths) + [
+            p for p in os.environ.get('PYTHONPATH', '').split(os.pathsep)
+            if p
+        ]
+        graph = ImportGraph(self.get_imports_save_path())
+        graph.load()
+        impacted = graph.impacted(target_files, changed, roots)
+        graph.save()
+        print(self.status('{0} of {1} target files affected by changes '
+                          'since {2}.'.format(len(impacted), len(target_files),
+                                              self.changed_since)))
+        return impacted
+
+    def make_watcher(self):
+        """
+        Returns a watcher for the search paths: inotify if it's there,
+        polling if not.
+        """
+        search_paths = self.search_paths or set([self.command_path])
+        if InotifyWatcher.available():
+            try:
+                return InotifyWatcher(search_paths, self.exclude_globs)
+            except OSError as e:
+                print(self.warn('Can\'t use inotify ({0}); polling '
+                                'instead.'.format(e)))
+        return PollingWatcher(search_paths, self.exclude_globs)
+
+    def watch_target_files(self):
+        """
+        Keeps watching the search paths after the run and reruns the target
+        files whose contents change, along with new files that match the
+        search patterns. Changes are collected until things have been quiet
+        for watch_debounce seconds, so saving a handful of files reruns them
+        together. ^C stops watching.
+        """
+        watcher = self.make_watcher()
+        digests = dict((t, self.file_digest(t)) for t in self.target_files)
+        try:
+            while True:
+                print(self.status('\nWatching for changes (^C to stop)...'))
+                target_files = []
+                while not target_files:
+                    changed = watcher.wait(self.watch_debounce)
+                    target_files = self.changed_target_files(changed, digests)
+                self.target_files = target_files
+                self.test_log = {
+                    'files': {},
+                    'passes': 0,
+                    'failures': 0,
+                    'failed_tests': []
+                }
+                self.run_tests()
         except KeyboardInterrupt:
+            watcher.close()
             self.quit()
-        c = c.lower()
-        if c == '?':
-            self.print_test_scope()
-            self.print_commands()
-            self.prompt_user()
+
+    def changed_target_files(self, changed, digests):
+        """
+        Returns the target files among the changed paths whose contents
+        really did change, updating their digests. None means anything might
+        have changed, so every target file is checked.
+        """
+        if changed is None:
+            changed = set(digests)
+        new_files = [p for p in changed if p not in digests]
+        candidates = [p for p in changed if p in digests]
+        candidates.extend(self.filter_candidate_files(new_files))
+
+        target_files = []
+        for path in sorted(candidates):
+            digest = self.file_digest(path)
+            if digest is None:
+                digests.pop(path, None)
+            elif digest != digests.get(path):
+                digests[path] = digest
+                target_files.append(path)
+        return target_files
+
+    def file_digest(self, path):
+        """Returns a hash of a file's contents, or None if it's gone."""
+        digest = hashlib.sha1()
+        try:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+        except (IOError, OSError):
+            return None
+        return digest.hexdigest()
+
+    def get_state(self):
+        """
+        Override me and return a dict of stuff to save in the state. It's
+        saved as JSON, except that sets become lists.
+        """
+        return {}
+
+    def apply_state(self, state_obj):
+        """
+        Override me to rehydrate the saved state dict.
+        """
+        pass
+
+    def run_tests(self):
+        """Run all target test files."""
+        if self.command_path:
+            os.chdir(self.command_path)
+
+        self.load_history()
+        # The coordinator records what its workers run.
+        self.run_id = None
+        if self.worker_address is None:
+            self.run_id = self.get_results_db().start_run(self.jobs)
+        self.spool_dir = tempfile.mkdtemp(prefix='easyrunner_')
+        self.spools = {}
+        self.output_states = {}
+        self.exit_codes = {}
+        self.timed_out = set()
+        self.global_timed_out = False
+        self.running = {}
+        self.started_at = {}
+        self.batches = {}
+        self.splits = {}
+        self.split_of = {}
+        self.part_results = {}
+        self.cache_keys = {}
+        self.cached = set()
+        self.attempts = {}
+        self.flaky = []
+        self.start_time = datetime.datetime.now()
+        self.run_started = time.time()
+
+        watchdog = None
+        if self.timeout is not None or self.global_timeout is not None:
+            watchdog = Watchdog(self)
+            watchdog.start()
+
+        self.sampler = None
+        if self.sample_resources:
+            if ResourceSampler.available():
+                self.sampler = ResourceSampler(self)
+                self.sampler.start()
+            else:
+                print(self.warn('Resource sampling needs /proc; skipping it.'))
+
+        serving = self.serve_address is not None
+        parallel = (self.jobs > 1 or serving) and len(self.target_files) > 1
+        target_files = self.target_files
+        if parallel:
+            target_files = self.schedule_target_files(target_files)
+        if self.retries > 0:
+            target_files = self.put_flaky_first(target_files)
+        if self.failures_first:
+            target_files = self.put_failures_first(target_files)
+        if self.use_cache:
+            target_files = self.skip_cached_files(target_files)
+        if self.split_files:
+            target_files = self.split_target_files(target_files)
+            parallel = (self.jobs > 1 or serving) and len(target_files) > 1
+        if self.batch_size is not None and not serving:
+            target_files = self.make_batches(target_files)
+            parallel = self.jobs > 1 and len(target_files) > 1
+
+        self.start_dashboard(len(target_files))
+        if not serving:
+            self.start_fork_server()
+        if serving:
+            self.run_test_files_remote(target_files)
+        elif self.worker_address is not None:
+            self.run_remote_worker()
+        elif self.engine == 'async':
+            self.run_test_files_async(target_files)
+        elif parallel:
+            self.run_test_files_parallel(target_files)
+        else:
+            # Retries are added to the end of self.pending as files fail.
+            self.pending = list(target_files)
+            while self.pending and not self.global_timed_out:
+                self.run_test_file(self.pending.pop(0))
+
+        self.stop_fork_server()
+        self.stop_dashboard()
+        if watchdog is not None:
+            watchdog.stop()
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.print_heaviest_files()
+        if self.global_timed_out:
+            print(self.bad('\nGlobal timeout reached; {0} of {1} files ran.'
+                           .format(len(self.test_log['files']),
+                                   len(self.target_files))))
+        if self.run_id is not None:
+            self.get_results_db().finish_run(self.run_id)
+        if self.flaky:
+            self.test_log['flaky'] = list(self.flaky)
+        self.print_tally()
+        self.clean_spool_dir()
+        if self.profiler.enabled:
+            self.test_log['profile'] = self.get_profile()
+            self.print_profile(self.test_log['profile'])
+        self.finish()
+
+    def start_test_process(self, target_file, stdout=sub.PIPE):
+        """
+        Announces the target file and starts its test process. Its stderr is
+        merged into its stdout, which goes to the given pipe or file.
+        """
+        self.announce_test_file(target_file)
+        if self.fork_server is not None:
+            argv = [target_file] + self.split_args(self.command_suffixes)
+            with self.profiler.phase('spawn'):
+                try:
+                    return self.fork_server.run(target_file, argv, stdout)
+                except OSError as e:
+                    print(self.bad('Fork server: {0}'.format(e)))
+                    self.quit()
+
+        if self.shell:
+            args = self.build_command(target_file)
+        else:
+            args = self.build_argv(target_file)
+        with self.profiler.phase('spawn'):
+            try:
+                return sub.Popen(args, stdout=stdout, stderr=sub.STDOUT,
+                                 shell=self.shell, universal_newlines=True,
+                                 **NEW_SESSION)
+            except OSError as e:
+                print(self.bad('Couldn\'t run {0}: {1}'.format(
+                    self.build_command(target_file), e)))
+                self.quit()
+
+    def start_fork_server(self):
+        """
+        Starts the fork server if it's on, and says which modules it has
+        imported. It needs Python 3, and the threads engine.
+        """
+        self.fork_server = None
+        if not self.use_fork_server:
             return
-        elif c == 'v':
-            self.verbose = not self.verbose
-            print
-            self.print_test_scope()
-            self.prompt_user()
+        if self.engine == 'async':
+            print(self.warn('The fork server only works with the threads '
+                            'engine; starting each file normally.'))
             return
-        elif c in ['n', 'q']:
+        try:
+            from easyrunner_forkserver import ForkServer
+        except (ImportError, SyntaxError):
+            print(self.bad('The fork server needs Python 3.'))
             self.quit()
 
-        # Handle number input, including spans
-        numbers = set()
-        parts = [part.strip() for part in c.split(',')]
+        fork_server = ForkServer(
+            self.split_args([self.command] + list(self.command_prefixes)),
+            self.preload_modules
+        )
+        try:
+            fork_server.start()
+        except OSError as e:
+            print(self.bad(str(e)))
+            self.quit()
+        self.fork_server = fork_server
+        if fork_server.preloaded:
+            print(self.status('Fork server preloaded: ' +
+                              ', '.join(fork_server.preloaded)))
+        if fork_server.failed_modules:
+            print(self.warn('Fork server couldn\'t import: ' +
+                            ', '.join(fork_server.failed_modules)))
 
-        for part in parts:
-            if '-' in part:
-                span_parts = part.split('-')
-                start = int(span_parts[0])
-                end = int(span_parts[1])
-                for i in range(start, end + 1):
-                    numbers.add(i)
-                continue
+    def stop_fork_server(self):
+        if self.fork_server is not None:
+            self.fork_server.stop()
+
+    def get_test_results(self, target_file):
+        """
+        Returns the summary of a target file's unittest results, if it was
+        run by the fork server: a dict of how many tests ran, the ids of
+        those that failed or errored, and how many were skipped. Returns None
+        otherwise, or if the file never ran unittest.
+        """
+        if self.fork_server is None:
+            return None
+        return self.fork_server.results.get(target_file)
+
+    def discard_test_results(self, target_file):
+        """Drops a target file's unittest results once it's been logged."""
+        if self.fork_server is not None:
+            self.fork_server.results.pop(target_file, None)
+
+    def kill_process_group(self, p):
+        """
+        Terminates a test process's whole process group: the test runner and
+        whatever browsers it started. Anything still around after
+        kill_grace seconds gets killed outright.
+        """
+        if isinstance(p, RemoteWorker):
+            p.send({'op': 'kill'})
+            return
+        if not hasattr(os, 'killpg'):
             try:
-                num = int(part)
-                if num < 1 or num > len(self.target_files):
-                    print(self.bad((
-                        'That number is not in the list! Try again.\n')))
-                    return self.prompt_user()
-                    numbers.add(num)
-            except ValueError:
+                p.terminate()
+            except OSError:
                 pass
-
-        if len(numbers) > 0:
-            self.target_files = [self.target_files[i-1] for i in numbers]
-            self.print_test_scope()
-            self.prompt_user()
             return
 
-        self.save_state()
-        self.run_tests()
+        def signal_group(sig):
+            try:
+                os.killpg(p.pid, sig)
+            except OSError:
+                pass
+
+        signal_group(signal.SIGTERM)
+        killer = threading.Timer(
+            self.kill_grace, signal_group, args=(signal.SIGKILL,))
+        killer.daemon = True
+        killer.start()
+
+    def abort_processes(self, processes):
+        """
+        Kills the process groups of test processes on the way out, as
+        kill_process_group would, but waits out the grace period itself
+        before the SIGKILL: a timer thread wouldn't outlive the exit.
+        """
+        processes = [p for p in processes if p is not None]
+        for p in processes:
+            if isinstance(p, RemoteWorker) or not hasattr(os, 'killpg'):
+                self.kill_process_group(p)
+        processes = [p for p in processes if
+                     not isinstance(p, RemoteWorker) and hasattr(os, 'killpg')]
+
+        def signal_group(p, sig):
+            try:
+                os.killpg(p.pid, sig)
+                return True
+            except OSError:
+                return False
+
+        def group_alive(p):
+            # The leader counts until it's reaped, if it's ours to reap.
+            try:
+                os.waitpid(p.pid, os.WNOHANG)
+            except OSError:
+                pass
+            return signal_group(p, 0)
+
+        for p in processes:
+            signal_group(p, signal.SIGTERM)
+        deadline = time.time() + self.kill_grace
+        while time.time() < deadline and any(group_alive(p)
+                                             for p in processes):
+            time.sleep(0.05)
+        for p in processes:
+            signal_group(p, signal.SIGKILL)
+
+    def announce_test_file(self, target_file):
+        """
+        Notes the time a target file starts. In verbose mode this also
+        prints that it's starting, to head its output; otherwise the
+        dashboard shows what's running.
+        """
+        if self.verbose:
+            print('\n' + self.warn("[RUNNING]" +
+                  self.get_path_rel_to_command_path(target_file)))
+            for t in self.batches.get(target_file, []):
+                print('\t' + self.get_path_rel_to_command_path(t))
+        self.started_at[target_file] = time.time()
+
+    def open_spool(self, target_file):
+        """Opens the spool file that will collect a target file's output."""
+        spool = OutputSpool(self.spool_dir, target_file)
+        self.spools[target_file] = spool
+        return spool
+
+    def run_test_file(self, target_file):
+        """Runs tests in the target file."""
+        p = None
+        try:
+            spool = self.open_spool(target_file)
+            if self.verbose is True or self.parse_output_lines:
+                p = self.start_test_process(target_file)
+                self.running[target_file] = p
+                for line in iter(p.stdout.readline, ""):
+                    spool.write(line)
+                    if self.verbose:
+                        print(line.rstrip())
+                    outcome = self.feed_output_line(target_file, line)
+                    if outcome:
+                        self.report_early_outcome(target_file, outcome)
+                self.exit_codes[target_file] = p.wait()
+            else:
+                p = self.start_test_process(target_file, spool.file)
+                self.running[target_file] = p
+                self.exit_codes[target_file] = p.wait()
+
+            del self.running[target_file]
+            self.handle_output(target_file, spool.tail())
+
+        except KeyboardInterrupt:
+            if p:
+                print(self.warn('\nAborting...'))
+                print('Terminating current process...')
+                self.abort_processes([p])
+                print('... done.')
+                self.quit()
+
+    def run_test_files_parallel(self, target_files):
+        """
+        Runs the target files as concurrent child processes, never more than
+        self.jobs at once.
+
+        Only this (main) thread starts processes, prints, and touches the test
+        log. Each child writes straight to its spool file and gets a helper
+        thread that just waits for it to exit and reports back through a
+        queue, so results are tallied one at a time in whatever order they
+        finish. (If the runner parses output line by line, the helper thread
+        reads the output and parses it on the way to the spool instead.)
+        """
+        # Retries are added to the end of self.pending as files fail.
+        pending = self.pending = list(target_files)
+        finished = queue.Queue()
+
+        try:
+            while pending or self.running:
+                if self.global_timed_out:
+                    del pending[:]
+                while pending and len(self.running) < self.jobs:
+                    target_file = pending.pop(0)
+                    spool = self.open_spool(target_file)
+                    if self.parse_output_lines:
+                        p = self.start_test_process(target_file)
+                        wait = self.read_test_process
+                    else:
+                        p = self.start_test_process(target_file, spool.file)
+                        wait = self.wait_test_process
+                    self.running[target_file] = p
+                    waiter = threading.Thread(
+                        target=wait,
+                        args=(target_file, p, finished)
+                    )
+                    waiter.daemon = True
+                    waiter.start()
+
+                # Block with a timeout so that ^C still gets through.
+                try:
+                    target_file, outcome = finished.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                if outcome is not None:
+                    self.report_early_outcome(target_file, outcome)
+                    continue
+
+                self.exit_codes[target_file] = self.running.pop(
+                    target_file).returncode
+                spool = self.spools[target_file]
+                if self.verbose:
+                    print('\n' + self.status('[OUTPUT] ' +
+                          self.get_path_rel_to_command_path(target_file)))
+                    spool.copy_to(sys.stdout)
+                self.handle_output(target_file, spool.tail())
+
+        except KeyboardInterrupt:
+            print(self.warn('\nAborting...'))
+            print('Terminating {0} running processes...'.format(
+                len(self.running)))
+            self.abort_processes(list(self.running.values()))
+            print('... done.')
+            self.quit()
+
+    def run_test_files_async(self, target_files):
+        """
+        Runs the target files on the asyncio engine (see easyrunner_async),
+        which reads every child's stdout and stderr at once from a single
+        event loop. This needs Python 3.
+        """
+        try:
+            from easyrunner_async import AsyncEngine
+        except (ImportError, SyntaxError):
+            print(self.bad('The async engine needs Python 3.7 or later.'))
+            self.quit()
+        AsyncEngine(self).run(target_files)
+
+    def run_test_files_remote(self, target_files):
+        """
+        Hands the target files out to workers (see run_remote_worker) over
+        TCP, one at a time as each finishes its last, so faster hosts end up
+        running more of them. Workers can join at any point. If one goes
+        away in the middle of a file, the file goes back at the front of the
+        queue for another. Once the global timeout has passed, workers get
+        kill_grace plus worker_grace seconds to send back what they were
+        running; after that they're cut off and their files time out.
 
-    def prompt_resume_state(self):
-        """Prompts the user to resume prior state."""
+        As with the threaded engine, only this thread touches the test log;
+        the Coordinator's threads just pass on what the workers say.
+        """
         try:
-            print
-            c = raw_input(
-                self.status("Hit anything but 'q' to re-run last batch: ")
-            )
-        except KeyboardInterrupt:
+            coordinator = Coordinator(self.serve_address)
+        except socket.error as e:
+            print(self.bad('Couldn\'t listen on {0}:{1}: {2}'.format(
+                self.serve_address[0], self.serve_address[1], e)))
             self.quit()
-        c = c.lower()
-        if c in ['q', 'n']:
+        coordinator.start()
+        print(self.status('Waiting for workers on {0}:{1}...'.format(
+            coordinator.address[0], coordinator.address[1])))
+
+        # Retries are added to the end of self.pending as files fail.
+        pending = self.pending = list(target_files)
+        idle = []
+        give_up_at = None
+        try:
+            while pending or self.running:
+                if self.global_timed_out:
+                    del pending[:]
+                    if give_up_at is None:
+                        give_up_at = (time.time() + self.kill_grace +
+                                      self.worker_grace)
+                    elif time.time() > give_up_at:
+                        self.drop_running_workers()
+                        break
+                while pending and idle:
+                    worker = idle.pop(0)
+                    target_file = pending.pop(0)
+                    self.announce_test_file(target_file)
+                    self.running[target_file] = worker
+                    worker.target_file = target_file
+                    worker.send({
+                        'op': 'run',
+                        'file': self.get_path_rel_to_command_path(target_file)
+                    })
+
+                # Block with a timeout so that ^C still gets through.
+                try:
+                    kind, worker, message = coordinator.events.get(
+                        timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                if kind == 'joined':
+                    if message.get('title') != self.title:
+                        print(self.warn('[WORKER] {0} is a {1}; ignoring it.'
+                                        .format(worker.name,
+                                                message.get('title'))))
+                        worker.close()
+                        continue
+                    print(self.status('[WORKER] {0} joined'.format(
+                        worker.name)))
+                    idle.append(worker)
+                elif kind == 'result':
+                    target_file = worker.target_file
+                    worker.target_file = None
+                    idle.append(worker)
+                    if target_file is not None:
+                        self.running.pop(target_file, None)
+                        self.handle_remote_result(
+                            target_file, message, worker)
+                elif kind == 'left':
+                    if worker in idle:
+                        idle.remove(worker)
+                    target_file = worker.target_file
+                    worker.target_file = None
+                    print(self.warn('[WORKER] {0} left'.format(worker.name)))
+                    if target_file is not None:
+                        self.running.pop(target_file, None)
+                        self.started_at.pop(target_file, None)
+                        self.timed_out.discard(target_file)
+                        pending.insert(0, target_file)
+                        print(self.warn('\tRequeued ' +
+                              self.get_path_rel_to_command_path(target_file)))
+
+        except KeyboardInterrupt:
+            print(self.warn('\nAborting...'))
+            coordinator.stop()
             self.quit()
-        self.run_tests()
+        coordinator.stop()
 
-    def get_state_save_path(self):
-        """Gets the path at which to save the pickled state."""
-        filename = '.{0}_state'.format(
-            ('_'.join(self.title.split())).lower()
-        )
-        script_path = os.path.split(os.path.realpath(__file__))[0]
-        return os.path.join(script_path, filename)
+    def drop_running_workers(self):
+        """
+        Cuts off the workers that haven't sent back the files they were
+        running, and logs those files as timed out.
+        """
+        for target_file, worker in list(self.running.items()):
+            print(self.warn('[WORKER] {0} didn\'t answer; cutting it off'
+                            .format(worker.name)))
+            worker.target_file = None
+            worker.close()
+            del self.running[target_file]
+            started = self.started_at.pop(target_file, None)
+            duration = None
+            if started is not None:
+                duration = time.time() - started
+            if target_file in self.split_of:
+                self.log_part_result(target_file, 'timed out', '', duration)
+            else:
+                self.log_file_result(target_file, 'timed out', '', duration)
 
-    def load_state(self):
-        """Tries to fetch the pickled state from the save file."""
+    def handle_remote_result(self, target_file, message, worker):
+        """Logs and records the result a worker sent back for a file."""
+        started = self.started_at.pop(target_file, None)
+        duration = message.get('duration')
+        if duration is None and started is not None:
+            duration = time.time() - started
+        if duration is not None:
+            self.profiler.add('child', duration)
+        outcome = message.get('outcome')
+        # The coordinator's watchdog had the worker kill it.
+        if target_file in self.timed_out:
+            outcome = 'timed out'
+        output = message.get('output', '')
+        if self.verbose:
+            print('\n' + self.status('[OUTPUT] ' +
+                  self.get_path_rel_to_command_path(target_file)))
+            if isinstance(output, list):
+                print('\n'.join(output))
+            else:
+                sys.stdout.write(output)
+        if target_file in self.split_of:
+            if outcome != 'passed':
+                print(self.warn('\tFull output of {0} kept on worker {1}'
+                                .format(self.get_path_rel_to_command_path(
+                                    target_file), worker.name)))
+            self.log_part_result(target_file, outcome, output, duration,
+                                 message.get('exit_code'))
+            return
+        self.exit_codes[target_file] = message.get('exit_code')
+        if self.log_file_result(target_file, outcome, output, duration,
+                                message.get('resources')):
+            print(self.warn('\tFull output kept on worker ' + worker.name))
+
+    def run_remote_worker(self):
+        """
+        Runs target files for a coordinator (see run_test_files_remote) until
+        it says it's done or goes away: one at a time, each with
+        run_test_file as usual, sending back its outcome, duration and the
+        tail of its output. Paths come relative to the coordinator's command
+        path and are run from this runner's, so checkouts can live in
+        different places on different hosts.
+        """
+        conn = self.connect_to_coordinator()
+        inbox = queue.Queue()
+        reader = threading.Thread(
+            target=self.read_coordinator, args=(conn, inbox))
+        reader.daemon = True
+        reader.start()
+
+        # The coordinator does any retrying.
+        self.retries = 0
+        conn.send({
+            'op': 'hello',
+            'name': '{0}:{1}'.format(socket.gethostname(), os.getpid()),
+            'title': self.title
+        })
         try:
-            with open(self.get_state_save_path()) as f:
-                return pickle.load(f)
-        except IOError:
-            return False
+            while True:
+                # Block with a timeout so that ^C still gets through.
+                try:
+                    message = inbox.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if message is None:
+                    break
 
-    def save_state(self):
-        """Saves the runner's state."""
-        state = {
-            'files': self.target_files,
-            'verbose': self.verbose
-        }
-        child_state = self.get_state()
-        for key in child_state:
-            state[key] = child_state[key]
-        pickle.dump(state, file(self.get_state_save_path(), "w"))
+                target_file = os.path.join(self.command_path, message['file'])
+                self.unlog_file(target_file)
+                if target_file not in self.target_files:
+                    self.target_files.append(target_file)
+                started = time.time()
+                self.run_test_file(target_file)
 
-    def get_state(self):
+                if target_file in self.timed_out:
+                    outcome = 'timed out'
+                elif target_file in self.test_log['failed_tests']:
+                    outcome = 'failed'
+                else:
+                    outcome = 'passed'
+                conn.send({
+                    'op': 'result',
+                    'file': message['file'],
+                    'outcome': outcome,
+                    'output': self.test_log['files'].get(target_file, ''),
+                    'duration': time.time() - started,
+                    'exit_code': self.exit_codes.pop(target_file, None),
+                    'resources': self.test_log.get(
+                        'resources', {}).get(target_file)
+                })
+        except KeyboardInterrupt:
+            conn.close()
+            self.quit()
+        conn.close()
+
+    def connect_to_coordinator(self):
         """
-        Override me and return a dict of stuff to save in the pickled state.
+        Connects to the coordinator, waiting up to worker_connect_timeout
+        seconds for it to start listening.
         """
-        return {}
+        host, port = self.worker_address
+        print(self.status('Connecting to the coordinator at {0}:{1}...'.format(
+            host, port)))
+        deadline = time.time() + self.worker_connect_timeout
+        while True:
+            try:
+                return MessageSocket(socket.create_connection((host, port)))
+            except socket.error as e:
+                if time.time() > deadline:
+                    print(self.bad('Couldn\'t reach the coordinator: {0}'
+                                   .format(e)))
+                    self.quit()
+                time.sleep(0.5)
 
-    def apply_state(self, state_obj):
+    def read_coordinator(self, conn, inbox):
         """
-        Override me to rehydrate the pickled state dict.
+        Reads what the coordinator sends a worker: files to run go to the
+        inbox, and kills (for files past their timeout) are done right
+        away. A None in the inbox means there's nothing more to run.
         """
-        pass
+        done = False
+        for message in conn.messages():
+            if message.get('op') == 'run':
+                inbox.put(message)
+            elif message.get('op') == 'kill':
+                for p in list(self.running.values()):
+                    self.kill_process_group(p)
+            elif message.get('op') == 'done':
+                done = True
+                break
+        if not done:
+            # Nobody's waiting for whatever is running now.
+            for p in list(self.running.values()):
+                self.kill_process_group(p)
+        inbox.put(None)
 
-    def run_tests(self):
-        """Run all target test files."""
-        if self.command_path:
-            os.chdir(self.command_path)
+    def handle_output_line(self, target_file, line, stream, elapsed):
+        """
+        Handles one line of output from a target file as it comes in. The
+        stream is 'stdout' or 'stderr', and elapsed is the number of seconds
+        since the file started. Only the async engine calls this; it always
+        has the line parsed.
+        """
+        self.spools[target_file].write(line)
+        outcome = self.feed_output_line(target_file, line)
+        if outcome:
+            self.report_early_outcome(target_file, outcome)
+        if not self.verbose:
+            return
 
-        self.start_time = datetime.datetime.now()
-        for t in self.target_files:
-            self.run_test_file(t)
-        self.finish()
+        text = line.rstrip()
+        if self.jobs > 1:
+            text = '{0} {1}'.format(
+                self.status('[{0} +{1:.1f}s]'.format(
+                    os.path.basename(target_file), elapsed)),
+                text
+            )
+        if stream == 'stderr':
+            text = self.warn(text)
+        print(text)
 
-    def run_test_file(self, target_file):
-        """Runs tests in the target file."""
-        cmd = self.build_command(target_file)
+    def wait_test_process(self, target_file, p, finished):
+        """Waits on a test process and queues it up as finished."""
+        p.wait()
+        finished.put((target_file, None))
+
+    def read_test_process(self, target_file, p, finished):
+        """
+        Reads a test process's output into its spool, parsing each line on
+        the way, and queues it up as finished once it exits. An outcome
+        that's known before then is queued up as soon as it's known.
+        """
+        spool = self.spools[target_file]
+        for line in iter(p.stdout.readline, ""):
+            spool.write(line)
+            outcome = self.feed_output_line(target_file, line)
+            if outcome:
+                finished.put((target_file, outcome))
+        p.wait()
+        finished.put((target_file, None))
 
-        print('\n' + self.warn("[RUNNING]" +
-              self.get_path_rel_to_command_path(target_file)))
+    def feed_output_line(self, target_file, line):
+        """
+        Passes a line of output to parse_output_line along with the target
+        file's parse state. Returns the file's outcome if this line is the one
+        that settled it.
+        """
+        state = self.output_states.setdefault(target_file, {})
+        known = state.get('outcome')
+        with self.profiler.phase('parsing'):
+            self.parse_output_line(target_file, line, state)
+        if known is None:
+            return state.get('outcome')
+        return None
 
-        try:
-            p = sub.Popen(cmd, stdout=sub.PIPE, stderr=sub.PIPE, shell=True)
-            output = ''
-            if self.verbose is True:
-                for line in iter(p.stdout.readline, ""):
-                    output += line
-                    print(line.rstrip())
-            else:
-                out, err = p.communicate()
-                output = err + out
+    def parse_output_line(self, target_file, line, state):
+        """
+        Override me (and set parse_output_lines) to parse output as it comes
+        in, rather than all at once in update_log. State is a dict that's
+        kept for each target file until update_log has run; keep it small.
+        Set state['outcome'] to 'passed' or 'failed' as soon as the output
+        gives it away.
+        """
+        pass
 
-            self.handle_output(target_file, output)
+    def get_output_state(self, target_file):
+        """Returns the parse state built up from a target file's output."""
+        return self.output_states.get(target_file, {})
 
-        except KeyboardInterrupt:
-            if p:
-                print(self.warn('\nAborting...'))
-                print('Terminating current process...')
-                p.terminate()
-                print('... done.')
-                self.quit()
+    def report_early_outcome(self, target_file, outcome):
+        """
+        Reports a failure that's known while the process is still exiting
+        (tearing down browsers and whatnot), on the dashboard. The tally, and
+        the file's line in the output, still wait for the exit.
+        """
+        if outcome == 'failed':
+            self.early_failures.append(target_file)
+            if self.dashboard is not None:
+                self.dashboard.update()
+
+    def build_argv(self, target_file):
+        """
+        Builds the argument list that runs the test file, or all the files in
+        a batch. The command, prefixes and suffixes are split up the way a
+        shell would split them, so quoting in them still works; the file
+        paths are passed as they are.
+        """
+        return (
+            self.split_args([self.command]) +
+            self.split_args(self.command_prefixes) +
+            self.batches.get(target_file, [target_file]) +
+            self.split_args(self.command_suffixes)
+        )
 
     def build_command(self, target_file):
-        """Builds the command string to run the test file."""
+        """
+        Builds the command string to run the test file, or all the files in
+        a batch. Only runners with shell set are run through a shell; for
+        the others this is just for showing.
+        """
+        if not self.shell:
+            return ' '.join(shell_quote(a) for a in self.build_argv(
+                target_file))
         prefixes = ' '.join(self.command_prefixes)
         suffixes = ' '.join(self.command_suffixes)
+        target_files = ' '.join(self.batches.get(target_file, [target_file]))
         return '{0} {1}'.format(
             self.command,
-            ' '.join([prefixes, target_file, suffixes])
+            ' '.join([prefixes, target_files, suffixes])
         )
 
+    def split_args(self, parts):
+        """Splits command parts into arguments, like a shell would."""
+        args = []
+        for part in parts:
+            args.extend(shlex.split(part))
+        return args
+
     def handle_output(self, target_file, output):
-        """Handles test output."""
+        """
+        Handles test output. This only gets the tail of the output; the full
+        thing stays in the file's spool, which is kept if the file failed.
+        """
+        if target_file in self.batches:
+            return self.handle_batch_output(target_file)
+        if target_file in self.split_of:
+            return self.handle_part_output(target_file, output)
+
+        duration = None
+        started = self.started_at.pop(target_file, None)
+        if started is not None:
+            duration = time.time() - started
+            self.record_duration(target_file, duration)
+            self.profiler.add('child', duration)
+
         self.test_log['files'][target_file] = output
-        self.update_log(target_file, output)
-        self.print_tally()
+        resources = None
+        if self.sampler is not None:
+            resources = self.sampler.finish(target_file)
+            if resources is not None:
+                self.test_log.setdefault('resources', {})[target_file] = \
+                    resources
+        if target_file in self.timed_out:
+            self.log_failure(target_file)
+        else:
+            with self.profiler.phase('parsing'):
+                self.update_log(target_file, output)
+        self.discard_test_results(target_file)
+        self.trim_logged_output(target_file, output)
+        self.output_states.pop(target_file, None)
+        failed = target_file in self.test_log['failed_tests']
+        with self.profiler.phase('recording'):
+            self.record_result(target_file, duration, resources)
+            retried = self.retry_failed(target_file, duration)
+            if not retried:
+                self.record_outcome(target_file)
+                self.note_flaky(target_file)
+
+        if not retried:
+            with self.profiler.phase('rendering'):
+                self.report_file_done(target_file, duration, resources)
+
+        spool = self.spools.pop(target_file, None)
+        if spool is not None:
+            if failed:
+                spool.close()
+                print(self.warn('\tFull output: ' + spool.path))
+            else:
+                spool.discard()
+
+    def handle_batch_output(self, batch):
+        """
+        Handles a finished batch: works out each of its files' outcome and
+        output from the batch's (see split_batch_output), and logs and
+        records them one file at a time. The batch's time is shared out
+        between its files in proportion to how long they're expected to
+        take.
+        """
+        target_files = self.batches.pop(batch)
+        duration = None
+        started = self.started_at.pop(batch, None)
+        if started is not None:
+            duration = time.time() - started
+            self.profiler.add('child', duration)
+        exit_code = self.exit_codes.pop(batch, None)
+        timed_out = batch in self.timed_out
+        state = self.output_states.pop(batch, None) or {}
+
+        if self.sampler is not None:
+            resources = self.sampler.finish(batch)
+            if resources is not None:
+                print(self.status(self.resources_str(resources)))
+
+        spool = self.spools.pop(batch)
+        with self.profiler.phase('parsing'):
+            outcomes = self.split_batch_output(
+                target_files, spool.lines(), exit_code, state.get('outcome'))
+
+        weights = [self.expected_duration(t, 1.0) for t in target_files]
+        failed = False
+        for target_file, weight in zip(target_files, weights):
+            passed, output = outcomes[target_file]
+            share = None
+            if duration is not None:
+                share = duration * weight / sum(weights)
+            if timed_out:
+                outcome = 'timed out'
+            elif passed:
+                outcome = 'passed'
+            else:
+                outcome = 'failed'
+            self.exit_codes[target_file] = exit_code
+            # Retries run on their own, not as part of a batch.
+            if self.log_file_result(target_file, outcome, output, share):
+                failed = True
+
+        if failed:
+            spool.close()
+            print(self.warn('\tFull output of {0}: {1}'.format(
+                batch, spool.path)))
+        else:
+            spool.discard()
+
+    def handle_part_output(self, part, output):
+        """
+        Handles a finished part of a split target file. Its outcome is
+        worked out as usual, then taken back out of the test log and kept
+        with its file's other parts (see log_part_result).
+        """
+        duration = None
+        started = self.started_at.pop(part, None)
+        if started is not None:
+            duration = time.time() - started
+            self.record_duration(part, duration)
+            self.profiler.add('child', duration)
+        if self.sampler is not None:
+            self.sampler.finish(part)
+
+        self.test_log['files'][part] = output
+        if part in self.timed_out:
+            outcome = 'timed out'
+            self.log_failure(part)
+        else:
+            with self.profiler.phase('parsing'):
+                self.update_log(part, output)
+            outcome = 'passed'
+            if part in self.test_log['failed_tests']:
+                outcome = 'failed'
+        output = self.test_log['files'][part]
+        self.unlog_file(part)
+        self.output_states.pop(part, None)
+
+        spool = self.spools.pop(part, None)
+        if spool is not None:
+            if outcome == 'passed':
+                spool.discard()
+            else:
+                spool.close()
+                print(self.warn('\tFull output of {0}: {1}'.format(
+                    self.get_path_rel_to_command_path(part), spool.path)))
+        self.log_part_result(part, outcome, output, duration,
+                             self.exit_codes.pop(part, None))
+
+    def log_part_result(self, part, outcome, output, duration=None,
+                        exit_code=None):
+        """
+        Keeps a finished part's outcome until the rest of its file's parts
+        are done, then logs and records the file as a whole (see
+        log_file_result): timed out or failed if any part was, taking as
+        long as its parts together, with their output put together by
+        join_part_outputs. Returns whether the file failed, once it's
+        logged.
+        """
+        target_file = self.split_of.pop(part)
+        self.timed_out.discard(part)
+        results = self.part_results.setdefault(target_file, {})
+        results[part] = (outcome, output, duration, exit_code)
+        parts = self.splits[target_file]
+        if len(results) < len(parts):
+            return False
+
+        del self.part_results[target_file]
+        outcomes = [results[p][0] for p in parts]
+        if 'timed out' in outcomes:
+            outcome = 'timed out'
+        elif all(o == 'passed' for o in outcomes):
+            outcome = 'passed'
+        else:
+            outcome = 'failed'
+        outputs = [results[p][1] for p in parts]
+        durations = [results[p][2] for p in parts
+                     if results[p][2] is not None]
+        exit_codes = [results[p][3] for p in parts]
+        self.exit_codes[target_file] = next(
+            (c for c in exit_codes if c), exit_codes[0])
+        return self.log_file_result(
+            target_file,
+            outcome,
+            self.join_part_outputs(target_file, outputs),
+            sum(durations) if durations else None
+        )
+
+    def trim_logged_output(self, target_file, output):
+        """
+        Keeps the test log from growing with the run. If update_log left a
+        file's raw output in the log, it's dropped once the file has passed,
+        or cut down to its last excerpt_lines lines if it failed.
+        """
+        if self.test_log['files'].get(target_file) is not output:
+            return
+        excerpt = ''
+        if target_file in self.test_log['failed_tests']:
+            excerpt = ''.join(output.splitlines(True)[-self.excerpt_lines:])
+        self.test_log['files'][target_file] = excerpt
+
+    def log_file_result(self, target_file, outcome, output, duration=None,
+                        resources=None):
+        """
+        Logs and records a target file's outcome ('passed', 'failed' or
+        'timed out') when it's known without parsing the file's own output:
+        for a file in a batch, or one run by a worker. Returns whether the
+        file failed, even if it's been queued to run again.
+        """
+        if duration is not None:
+            self.record_duration(target_file, duration)
+        self.test_log['files'][target_file] = output
+        if resources is not None:
+            self.test_log.setdefault('resources', {})[target_file] = \
+                resources
+        if outcome == 'timed out':
+            self.timed_out.add(target_file)
+            self.log_failure(target_file)
+        elif outcome == 'passed':
+            self.log_pass()
+        else:
+            self.log_failure(target_file)
+        self.trim_logged_output(target_file, output)
+        with self.profiler.phase('recording'):
+            self.record_result(target_file, duration, resources)
+            if self.retry_failed(target_file, duration):
+                return True
+            self.record_outcome(target_file)
+            self.note_flaky(target_file)
+        with self.profiler.phase('rendering'):
+            self.report_file_done(target_file, duration, resources)
+        return outcome != 'passed'
+
+    def split_batch_output(self, target_files, lines, exit_code,
+                           outcome=None):
+        """
+        Works out what happened to each file in a batch from the batch's
+        output lines and exit code. Returns a dict of (passed, output) for
+        each file, where output is whatever of the batch's output is about
+        that file.
+
+        By default a line is about the files it names, by full path or path
+        relative to the command path (tracebacks and failure reports
+        usually do). If the runner parses output (see parse_output_line),
+        each file's lines are parsed on their own, and a file whose outcome
+        they settle gets that outcome; outcome is the one parsed from the
+        batch's output as a whole. Otherwise, if the batch passed (by its
+        exit code and outcome), so did the file; if not, the files named in
+        its output failed, or all of them if none were named. Override me if
+        the test command's output says more precisely which files passed.
+        """
+        names = {}
+        for t in target_files:
+            names[t] = t
+            names[self.get_path_rel_to_command_path(t)] = t
+        # Longest first, so a path isn't taken for one it's a prefix of.
+        pattern = re.compile('|'.join(
+            re.escape(n) for n in sorted(names, key=len, reverse=True)))
+
+        output = dict((t, []) for t in target_files)
+        for line in lines:
+            for t in set(names[n] for n in pattern.findall(line)):
+                output[t].append(line)
+
+        parsed = {}
+        if self.parse_output_lines:
+            for t in target_files:
+                state = {}
+                for line in output[t]:
+                    self.parse_output_line(t, line, state)
+                if state.get('outcome') is not None:
+                    parsed[t] = state['outcome'] == 'passed'
+
+        named = set(t for t in target_files if output[t])
+        if exit_code == 0 and outcome != 'failed':
+            failed = set()
+        elif named:
+            failed = named
+        else:
+            failed = set(target_files)
+        return dict(
+            (t, (parsed.get(t, t not in failed), ''.join(output[t])))
+            for t in target_files
+        )
+
+    def get_profile(self):
+        """
+        Returns the --profile breakdown of the run so far as a dict (see
+        PhaseProfiler.get_profile).
+        """
+        wall_seconds = 0.0
+        if self.run_started is not None:
+            wall_seconds = time.time() - self.run_started
+        return self.profiler.get_profile(wall_seconds, self.jobs)
+
+    def print_profile(self, profile):
+        """Prints how long each phase of the run took."""
+        print(self.header('\nProfile'))
+        for name, label in self.profiler.phases:
+            phase = profile['phases'][name]
+            print('\t{0:<20} {1:>10.3f}s  ({2} calls)'.format(
+                label, phase['seconds'], phase['count']))
+        print(self.status(
+            '\tWall time {0:.3f}s with {1} job(s); runner overhead '
+            '{2:.3f}s ({3:.1%})'.format(
+                profile['wall_seconds'], profile['jobs'],
+                profile['overhead_seconds'], profile['overhead_fraction'])))
+
+    def clean_spool_dir(self):
+        """Removes the spool directory unless failed output was kept in it."""
+        if self.spool_dir is None:
+            return
+        try:
+            os.rmdir(self.spool_dir)
+        except OSError:
+            print(self.warn(
+                '\nOutput of failed files kept in ' + self.spool_dir))
 
     def update_log(self, target_file, output):
         """Override me to update the test log."""
@@ -430,6 +4047,117 @@ class EasyRunner(object):
             ' '.join(['' for i in range(length - dashes)])
         )
 
+    def start_dashboard(self, process_count):
+        """
+        Puts up the live dashboard if stdout is a terminal (or use_dashboard
+        says so) and there's more than one process to run.
+        """
+        self.dashboard = None
+        self.early_failures = []
+        use_dashboard = self.use_dashboard
+        if use_dashboard is None:
+            use_dashboard = Dashboard.available() and process_count > 1
+        if use_dashboard:
+            self.dashboard = Dashboard(self)
+            self.dashboard.start()
+
+    def stop_dashboard(self):
+        if self.dashboard is not None:
+            self.dashboard.stop()
+            self.dashboard = None
+
+    def report_file_done(self, target_file, duration=None, resources=None):
+        """
+        Prints a single line for a finished target file: its outcome, how
+        long it took, and how far along the run is. The full tally waits
+        for the end of the run (the dashboard keeps it up to date meanwhile).
+        """
+        if target_file in self.timed_out:
+            outcome = self.bad('[TIMED OUT]')
+        elif target_file in self.test_log['failed_tests']:
+            outcome = self.bad('[FAILED]   ')
+        elif target_file in self.cached:
+            outcome = self.good('[CACHED]   ')
+        elif target_file in self.flaky:
+            outcome = self.warn('[FLAKY]    ')
+        else:
+            outcome = self.good('[PASSED]   ')
+        parts = [outcome, self.get_path_rel_to_command_path(target_file)]
+        if duration is not None:
+            parts.append(self.status('{0:.1f}s'.format(duration)))
+        if resources is not None:
+            parts.append(self.status(self.resources_str(resources)))
+        parts.append('({0}/{1})'.format(
+            len(self.test_log['files']), len(self.target_files)))
+        print(' '.join(parts))
+        if self.dashboard is not None:
+            self.dashboard.update()
+
+    def dashboard_lines(self):
+        """Returns the lines the dashboard shows, top to bottom."""
+        done = len(self.test_log['files'])
+        total = len(self.target_files)
+        fail_str = self.bad('{0} failed'.format(self.test_log['failures']))
+        if len(self.timed_out) > 0:
+            fail_str += self.bad(' ({0} timed out)'.format(
+                len(self.timed_out)))
+        lines = ['{0}: {1} | {2}  [{3}] [{4}]'.format(
+            self.header('Test File Tally'),
+            self.good('{0} passed'.format(self.test_log['passes'])),
+            fail_str,
+            self.status(self.time_passed()),
+            self.status('{0}/{1} tests run | {2} running'.format(
+                done, total, len(self.running))),
+        )]
+        if total > 0:
+            lines.append('{0} {1}'.format(
+                self.status('ETA ' + self.eta_str()),
+                self.progress_str(max(done, 1), total)))
+
+        now = time.time()
+        running = sorted(
+            (self.started_at.get(t, now), t) for t in list(self.running))
+        for started, t in running[:max(self.jobs, 1)]:
+            lines.append('  {0} {1} {2}'.format(
+                self.warn('[RUNNING]'),
+                self.get_path_rel_to_command_path(t),
+                self.status('{0:.0f}s'.format(now - started))))
+
+        failures = list(self.test_log['failed_tests'])
+        failures += [t for t in self.early_failures if t not in failures and
+                     t in self.running]
+        if failures:
+            lines.append(self.warn('Latest failures:'))
+            for t in failures[-Dashboard.recent_failures:]:
+                lines.append('  ' + self.bad(
+                    self.get_path_rel_to_command_path(t)))
+        return lines
+
+    def eta_str(self):
+        """
+        Estimates how long the rest of the run will take: the expected time
+        of what's left (see expected_duration) spread over the jobs, or the
+        pace so far for files without any history.
+        """
+        done = len(self.test_log['files'])
+        remaining = [t for t in self.target_files
+                     if t not in self.test_log['files']]
+        if not remaining:
+            return '0:00:00'
+        elapsed = time.time() - self.run_started
+        pace = elapsed / done if done else None
+        work = 0.0
+        for t in remaining:
+            expected = self.expected_duration(t, pace)
+            if expected is None:
+                return '--:--:--'
+            if t in self.started_at:
+                expected = max(0.0, expected -
+                               (time.time() - self.started_at[t]))
+            work += expected
+        seconds = work / min(self.jobs, len(remaining))
+        return str(datetime.timedelta(seconds=int(seconds)))
+
     def print_tally(self):
         """Prints tally of failed tests, time passed, tests left, etc."""
         pass_str = self.good('{0} passed'.format(self.test_log['passes']))
@@ -441,6 +4169,16 @@ class EasyRunner(object):
         f_count_str = self.status('{0}/{1} tests run'.format(
             tests_run_count,
             total_count))
+        if self.jobs > 1:
+            f_count_str += self.status(' | {0} running'.format(
+                len(self.running)))
+        if len(self.timed_out) > 0:
+            fail_str += self.bad(' ({0} timed out)'.format(
+                len(self.timed_out)))
+        if len(self.cached) > 0:
+            pass_str += self.good(' ({0} cached)'.format(len(self.cached)))
+        if len(self.flaky) > 0:
+            pass_str += self.warn(' ({0} flaky)'.format(len(self.flaky)))
 
         print('\n{0}: {1} | {2}  [{3}] [{4}]'.format(
             self.header('Test File Tally'),
@@ -453,6 +4191,10 @@ class EasyRunner(object):
         if total_count > 1:
             print(self.progress_str(tests_run_count, total_count))
 
+        if len(self.flaky) > 0:
+            print(self.warn('Passed on a retry:\n{0}'.format(
+                '\n'.join(self.flaky))))
+
         if len(self.test_log['failed_tests']) > 0:
             print(self.warn('Failures:\n{0}'.format(
                 '\n'.join(self.test_log['failed_tests'])))
@@ -488,47 +4230,63 @@ class EasyRunner(object):
 
         if len(self.search_paths) == 0:
             self.search_paths.add(self.command_path)
+
+        index = DiscoveryIndex(
+            self.get_index_save_path(),
+            exclude_globs=self.exclude_globs,
+            threads=self.walk_threads
+        )
+        if self.use_index:
+            index.load()
+
         targets = []
         for path in self.search_paths:
-            for root, subfolders, files in os.walk(path):
-                count = 0
-                for f in files:
-                    total_file_count += 1
-                    file_path = os.path.join(root, f)
-                    if self.evaluate_candidate_file(file_path):
-                        targets.append(file_path)
-                        count += 1
+            for root, subfolders, files in index.walk(path):
+                total_file_count += len(files)
+                matches = self.filter_candidate_files(
+                    [os.path.join(root, f) for f in files]
+                )
+                targets.extend(matches)
+                count = len(matches)
 
                 root_path_str = '\t' + root
                 if count == 0:
-                    print(root_path_str)
+                    if not self.quiet_search:
+                        print(root_path_str)
                 else:
                     print(self.status(root_path_str + ' [{0}]'.format(count)))
+
+        if self.use_index:
+            index.save()
         return targets
 
+    def get_matcher(self):
+        """
+        Returns the compiled matcher for the current search parameters,
+        rebuilding it if they've changed since it was last built.
+        """
+        key = (
+            frozenset(self.file_required_res),
+            frozenset(self.file_optional_res),
+            self.use_all_files
+        )
+        if self.__dict__.get('_matcher_key') != key:
+            self._matcher_key = key
+            self._matcher = PatternMatcher(
+                self.file_required_res,
+                self.file_optional_res,
+                self.use_all_files
+            )
+        return self._matcher
+
     def evaluate_candidate_file(self, file_path):
         """Returns True if test file matches filter params."""
-        # Check if it fails any of the required patterns
-        for r in self.file_required_res:
-            if not r.search(file_path):
-                return False
-
-        # If all required patterns match and the --all flag has been passed,
-        # return True
-        if self.use_all_files:
-            return True
-
-        if len(self.file_optional_res) == 0:
-            return True
-
-        # Make sure it matches at least one optional pattern.
-        # (And handle the case when only required patterns are
-        # provided.)
-        for r in self.file_optional_res:
-            if r.search(file_path) is not None:
-                return True
+        return self.get_matcher().match(file_path)
 
-        return False
+    def filter_candidate_files(self, file_paths):
+        """Returns the file paths that match the filter params."""
+        with self.profiler.phase('matching'):
+            return self.get_matcher().filter(file_paths)
 
     def validate(self):
         """Makes sure necessary paths exist."""
@@ -541,8 +4299,15 @@ class EasyRunner(object):
 
     def process_cli_args(self):
         """Processes each command-line argument."""
+        skip_next = False
         for a in self.cli_args[1:]:
+            # Values of options like `-j 4` are consumed by the option itself
+            # and shouldn't be treated as search patterns.
+            if skip_next:
+                skip_next = False
+                continue
             self.__process_cli_arg(a)
+            skip_next = a in self.cli_value_args
 
     def __process_cli_arg(self, arg):
         """Processes a particular command line argument."""
@@ -558,11 +4323,105 @@ class EasyRunner(object):
         elif arg == '--all':
             self.use_all_files = True
             self.config_parts.append(arg)
+        elif arg == '--no-index':
+            self.use_index = False
+        elif arg == '--profile':
+            self.profiler = PhaseProfiler(enabled=True)
+            self.config_parts.append(arg)
+        elif arg == '--resources':
+            self.sample_resources = True
+            self.config_parts.append(arg)
+        elif arg == '--failed':
+            self.rerun_failed = True
+            self.config_parts.append(arg)
+        elif arg == '--failures-first':
+            self.failures_first = True
+            self.config_parts.append(arg)
+        elif arg == '--timeout':
+            self.set_timeout(self.cli_args[idx + 1])
+            self.config_parts.append('timeout: {0}s'.format(self.timeout))
+        elif arg == '--global-timeout':
+            self.set_global_timeout(self.cli_args[idx + 1])
+            self.config_parts.append(
+                'global timeout: {0}s'.format(self.global_timeout))
+        elif arg == '--shard':
+            self.set_shard(self.cli_args[idx + 1])
+            self.config_parts.append('shard {0}/{1}'.format(*self.shard))
+        elif arg == '--shard-timings':
+            self.shard_timings_file = self.cli_args[idx + 1]
+        elif arg == '--save-timings':
+            self.save_timings = True
+        elif arg == '-x' or arg == '--exclude':
+            self.add_exclude_glob(self.cli_args[idx + 1])
+        elif arg == '--walk-threads':
+            self.set_walk_threads(self.cli_args[idx + 1])
+        elif arg == '-q' or arg == '--quiet':
+            self.quiet_search = True
+        elif arg == '--batch':
+            self.set_batch_size(self.cli_args[idx + 1])
+            if self.batch_size is not None:
+                self.config_parts.append('batch: {0}'.format(self.batch_size))
+        elif arg == '--changed-since':
+            self.set_changed_since(self.cli_args[idx + 1])
+            if self.changed_since is not None:
+                self.config_parts.append(
+                    'changed since {0}'.format(self.changed_since))
+        elif arg == '--cache':
+            self.use_cache = True
+            self.config_parts.append(arg)
+        elif arg == '--cache-input':
+            self.use_cache = True
+            self.cache_inputs = self.cache_inputs + [self.cli_args[idx + 1]]
+            self.config_parts.append(
+                'cache input: {0}'.format(self.cli_args[idx + 1]))
+        elif arg == '--no-cache':
+            self.no_cache = True
+            self.config_parts.append(arg)
+        elif arg == '--retries':
+            self.set_retries(self.cli_args[idx + 1])
+            self.config_parts.append('retries: {0}'.format(self.retries))
+        elif arg == '--serve':
+            self.set_serve_address(self.cli_args[idx + 1])
+            self.config_parts.append(
+                'serving on {0}:{1}'.format(*self.serve_address))
+        elif arg == '--worker':
+            self.set_worker_address(self.cli_args[idx + 1])
+            self.config_parts.append(
+                'worker for {0}:{1}'.format(*self.worker_address))
+        elif arg == '--split':
+            self.set_split(True)
+            if self.split_files:
+                self.config_parts.append(arg)
+        elif arg == '--watch':
+            self.watch = True
+            self.config_parts.append(arg)
+        elif arg == '--fork-server':
+            self.set_fork_server(True)
+            if self.use_fork_server:
+                self.config_parts.append('fork server')
+        elif arg == '--preload':
+            self.set_fork_server(True, self.cli_args[idx + 1].split(','))
+            if self.use_fork_server:
+                self.config_parts.append(
+                    'preload: {0}'.format(self.cli_args[idx + 1]))
+        elif arg == '--engine':
+            self.set_engine(self.cli_args[idx + 1])
+            self.config_parts.append('engine: {0}'.format(self.engine))
         elif arg == '-v' or arg == '--verbose':
             self.set_verbose(True)
-        else:
+        elif arg == '-j' or arg == '--jobs':
+            self.set_jobs(self.cli_args[idx + 1])
+            self.config_parts.append('jobs: {0}'.format(self.jobs))
+        elif not self.is_runner_arg(arg):
             self.add_optional_pattern(self.cli_args[idx])
 
+    def is_runner_arg(self, arg):
+        """
+        Returns whether a command line argument is one the runner handles
+        itself, rather than a search pattern.
+        """
+        return arg in self.cli_runner_args
+
     def resume_state(self):
         """Tries to resume state from last execution of the test runnner."""
         state_obj = self.load_state()
@@ -571,11 +4430,43 @@ class EasyRunner(object):
             self.quit()
         self.target_files = state_obj.get('files')
         self.verbose = state_obj.get('verbose')
+        self.jobs = state_obj.get('jobs', 1)
+        self.engine = state_obj.get('engine', 'threads')
+        if state_obj.get('batch') is not None:
+            self.set_batch_size(state_obj['batch'])
+        if state_obj.get('fork_server'):
+            self.set_fork_server(True, state_obj.get('preload'))
+        self.watch = state_obj.get('watch', False)
+        self.use_cache = state_obj.get('cache', False)
+        self.cache_inputs = state_obj.get('cache_inputs', [])
+        self.retries = state_obj.get('retries', 0)
+        self.split_files = state_obj.get('split', False)
+        if state_obj.get('serve'):
+            self.serve_address = tuple(state_obj['serve'])
         if hasattr(self, 'apply_state'):
             self.apply_state(state_obj)
         self.print_test_scope()
         self.prompt_resume_state()
 
+    def resume_failed(self):
+        """
+        Selects the files that failed the last time they ran, narrowed down
+        by the search patterns if any were given.
+        """
+        self.load_history()
+        target_files = self.failed_files
+        if len(self.file_optional_res) > 0:
+            target_files = self.filter_candidate_files(target_files)
+        self.target_files = self.shard_target_files(
+            [t for t in target_files if os.path.isfile(t)])
+
+        if len(self.target_files) == 0:
+            print(self.good('No failures to rerun.'))
+            self.quit()
+
+        self.print_test_scope()
+        self.prompt_user()
+
     def print_log(self):
         """Prints the test tally."""
         if len(self.test_log) == 0:
@@ -620,19 +4511,98 @@ class EasyRunner(object):
 
     def quit(self):
         """Peace out."""
+        self.stop_dashboard()
         print('\nFare thee well.')
         sys.exit()
 
 
 class PythonUnittestRunner(EasyRunner):
+    forkable = True
+    traces_imports = True
+    parse_output_lines = True
+    ran_re = re.compile(r'^Ran (\d+) tests? in ')
+    summary_re = re.compile(r'^(OK|FAILED)(?: \((.*)\))?$')
+
     def __init__(self):
+        super(PythonUnittestRunner, self).__init__()
         self.set_title('Unittest Runner')
         self.set_command('python')
         self.add_required_pattern(r'\.py$')
 
+    def parse_output_line(self, target_file, line, state):
+        line = line.strip()
+        ran = self.ran_re.match(line)
+        if ran:
+            state['tests'] = int(ran.group(1))
+            return
+
+        # The summary comes after 'Ran N tests', e.g.
+        # 'FAILED (failures=1, errors=2, skipped=3)'.
+        summary = self.summary_re.match(line)
+        if summary is None or 'tests' not in state:
+            return
+        counts = {}
+        for part in (summary.group(2) or '').split(','):
+            name, _, count = part.partition('=')
+            if count.strip().isdigit():
+                counts[name.strip()] = int(count)
+        state['counts'] = counts
+        state['outcome'] = 'passed' if summary.group(1) == 'OK' else 'failed'
+
+    def get_test_counts(self, target_file):
+        """
+        Returns how many tests ran, failed, errored and were skipped in a
+        target file: from the fork server's results if it ran the file,
+        otherwise from the summary unittest printed. None if there's
+        neither.
+        """
+        results = self.get_test_results(target_file)
+        if results is not None:
+            return {
+                'tests': results['tests'],
+                'failures': len(results['failures']),
+                'errors': len(results['errors']),
+                'skipped': results['skipped']
+            }
+        state = self.get_output_state(target_file)
+        if 'counts' not in state:
+            return None
+        counts = state['counts']
+        return {
+            'tests': state['tests'],
+            'failures': counts.get('failures', 0),
+            'errors': counts.get('errors', 0),
+            'skipped': counts.get('skipped', 0)
+        }
+
+    def update_log(self, target_file, output):
+        """
+        Logs the file's unittest results. A file that didn't get as far as
+        unittest's summary passes or fails by its exit code.
+        """
+        counts = self.get_test_counts(target_file)
+        if counts is None:
+            failed = self.exit_codes.get(target_file) != 0
+        else:
+            self.test_log['files'][target_file] = [
+                '{0} tests'.format(counts['tests']),
+                '{0} failures'.format(counts['failures']),
+                '{0} errors'.format(counts['errors']),
+                '{0} skipped'.format(counts['skipped'])
+            ]
+            failed = counts['failures'] or counts['errors']
+        if failed:
+            self.log_failure(target_file)
+        else:
+            self.log_pass()
+
 
 class PythonNoseRunner(EasyRunner):
+    batchable = True
+    traces_imports = True
+
     def __init__(self):
+        super(PythonNoseRunner, self).__init__()
         self.set_title('Runny Nose')
         self.set_command('nosetests')
         self.add_required_pattern(r'\.py$')
@@ -643,6 +4613,12 @@ class BehatRunner(EasyRunner):
     config_file = None
     outcome_re = None
     tags = set()
+    parse_output_lines = True
+    splittable = True
+    scenario_re = re.compile(
+        r'(Scenario|Scenario Outline|Scenario Template|Example):')
+    cli_value_args = EasyRunner.cli_value_args | set(['--tags', '-c'])
+    cli_runner_args = EasyRunner.cli_runner_args | set(['--tags', '-c'])
 
     def __init__(self):
         super(BehatRunner, self).__init__()
@@ -659,22 +4635,121 @@ class BehatRunner(EasyRunner):
             'tags': self.tags
         }
 
+    def is_runner_arg(self, arg):
+        # @tag selects scenarios by tag (see __extract_tags).
+        return (super(BehatRunner, self).is_runner_arg(arg) or
+                arg[:1] == '@')
+
     def apply_state(self, state_obj):
-        self.tags = state_obj.get('tags')
+        self.tags = set(state_obj.get('tags') or [])
         self.add_tag_suffix()
 
+    def parse_output_line(self, feature_file, line, state):
+        stripped = self.strip_ansi(line)
+        outcome = self.outcome_re.search(stripped)
+        if outcome:
+            state.setdefault('outcome_lines', []).append(outcome.group(0))
+
+        passed = self.pass_re.search(stripped) is not None
+        if passed:
+            state['passed'] = True
+
+        # The scenario count is the first line of Behat's summary, so it
+        # settles the outcome before the step count and timing are printed.
+        if outcome and 'scenario' in outcome.group(0):
+            state['outcome'] = 'passed' if passed else 'failed'
+
     def update_log(self, feature_file, output):
-        outcome = self.outcome_re.findall(output)
+        state = self.get_output_state(feature_file)
+        outcome = state.get('outcome_lines', [])
         if len(outcome) > 0:
             self.test_log['files'][feature_file] = outcome
 
-        stripped = self.strip_ansi(output)
-        passed = self.pass_re.search(stripped)
-        if passed:
+        if state.get('passed'):
             self.log_pass()
         else:
             self.log_failure(feature_file)
 
+    def get_file_parts(self, feature_file):
+        """
+        Lists a feature file's scenarios as 'file.feature:LINE', which Behat
+        runs on their own. This reads the file rather than asking Behat. An
+        outline is one part, examples and all, and scenarios the tags rule
+        out are left out.
+        """
+        try:
+            with io.open(feature_file, encoding='utf-8',
+                         errors='replace') as f:
+                lines = f.readlines()
+        except IOError:
+            return [feature_file]
+
+        parts = []
+        feature_tags = set()
+        tags = set()
+        in_text = False
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            # Step arguments can say anything, keywords included.
+            if line.startswith('"""') or line.startswith('```'):
+                in_text = not in_text
+                continue
+            if in_text or not line or line.startswith('#'):
+                continue
+            if line.startswith('@'):
+                tags.update(t.lstrip('@') for t in line.split('#')[0].split())
+                continue
+            if line.startswith('Feature:'):
+                feature_tags = tags
+            elif self.scenario_re.match(line) and \
+                    self.tags_match(feature_tags | tags):
+                parts.append('{0}:{1}'.format(feature_file, number))
+            tags = set()
+
+        if len(parts) < 2:
+            return [feature_file]
+        return parts
+
+    def tags_match(self, tags):
+        """
+        Whether a scenario with the given tags gets run: it has one of the
+        selected tags, if any are, and none of the ~excluded ones.
+        """
+        wanted = set(t.lstrip('@') for t in self.tags if t[:1] != '~')
+        unwanted = set(t.lstrip('~@') for t in self.tags if t[:1] == '~')
+        if tags & unwanted:
+            return False
+        return len(wanted) == 0 or len(tags & wanted) > 0
+
+    def join_part_outputs(self, feature_file, outputs):
+        """
+        Adds up the scenario counts of a split feature's parts into one
+        summary line, like Behat's own. A part that died before Behat's
+        summary counts as a failed scenario.
+        """
+        total = 0
+        counts = {}
+        kinds = []
+        for output in outputs:
+            summaries = [line for line in output if 'scenario' in line] \
+                if isinstance(output, list) else []
+            if len(summaries) == 0:
+                summaries = ['1 scenario (1 failed)']
+            for summary in summaries:
+                total += int(re.match(r'\d+', summary).group(0))
+                for count, kind in re.findall(r'(\d+) (\w+)', summary):
+                    if kind.startswith('scenario'):
+                        continue
+                    if kind not in counts:
+                        kinds.append(kind)
+                        counts[kind] = 0
+                    counts[kind] += int(count)
+        return ['{0} scenario{1} ({2})'.format(
+            total,
+            '' if total == 1 else 's',
+            ', '.join('{0} {1}'.format(counts[k], k) for k in kinds)
+        )]
+
     def process_cli_args(self):
         super(BehatRunner, self).process_cli_args()
         self.__extract_tags()
@@ -683,7 +4758,7 @@ class BehatRunner(EasyRunner):
     def __extract_tags(self):
         args = self.cli_args
         if '--tags' in args:
-            for t in args[args.index('--tags')].split(','):
+            for t in args[args.index('--tags') + 1].split(','):
                 self.tags.add(t)
         for a in args:
             if a[:1] == '@':
@@ -0,0 +1,123 @@
+"""
+An asyncio-based engine for running test processes.
+
+This lives in its own module because it needs Python 3.7+, while easyrunner
+itself still runs on Python 2. EasyRunner imports it only for `--engine async`.
+"""
+import asyncio
+import time
+
+
+class AsyncEngine(object):
+    """
+    Runs a runner's target files as child processes on one event loop, up to
+    runner.jobs at a time (so one at a time for a sequential run).
+
+    Each child's stdout and stderr are read at the same time, line by line, so
+    a chatty stderr can never fill its pipe and stall the child, and the lines
+    reach runner.handle_output_line in the order they were written, tagged
+    with their stream and when they arrived.
+
+    Everything that touches the runner happens on the event loop's thread, so
+    the test log and tally see one result at a time, just like the threaded
+    engine.
+    """
+
+    # Lines longer than this are handed over in pieces.
+    line_limit = 1024 * 1024
+
+    def __init__(self, runner):
+        self.runner = runner
+        self.processes = {}
+        # What was still running when ^C cancelled it, to be killed once
+        # the event loop has wound down.
+        self.interrupted = []
+
+    def run(self, target_files):
+        """Runs the target files and returns once they've all finished."""
+        try:
+            # Retries are added to the end of runner.pending as files fail.
+            self.runner.pending = list(target_files)
+            asyncio.run(self.run_all(self.runner.pending))
+        except KeyboardInterrupt:
+            runner = self.runner
+            print(runner.warn('\nAborting...'))
+            print('Terminating {0} running processes...'.format(
+                len(self.interrupted)))
+            runner.abort_processes(self.interrupted)
+            print('... done.')
+            runner.quit()
+
+    async def run_all(self, pending):
+        workers = [
+            self.worker(pending)
+            for i in range(min(self.runner.jobs, len(pending)))
+        ]
+        await asyncio.gather(*workers)
+
+    async def worker(self, pending):
+        while pending and not self.runner.global_timed_out:
+            await self.run_test_file(pending.pop(0))
+
+    async def run_test_file(self, target_file):
+        runner = self.runner
+        runner.open_spool(target_file)
+        runner.announce_test_file(target_file)
+        started = time.time()
+
+        spawn_started = time.time()
+        options = {
+            'stdout': asyncio.subprocess.PIPE,
+            'stderr': asyncio.subprocess.PIPE,
+            'limit': self.line_limit,
+            'start_new_session': True
+        }
+        try:
+            if runner.shell:
+                p = await asyncio.create_subprocess_shell(
+                    runner.build_command(target_file), **options)
+            else:
+                p = await asyncio.create_subprocess_exec(
+                    *runner.build_argv(target_file), **options)
+        except OSError as e:
+            print(runner.bad('Couldn\'t run {0}: {1}'.format(
+                runner.build_command(target_file), e)))
+            runner.quit()
+        runner.profiler.add('spawn', time.time() - spawn_started)
+        self.processes[target_file] = p
+        runner.running[target_file] = p
+        try:
+            await asyncio.gather(
+                self.read_stream(target_file, p.stdout, 'stdout', started),
+                self.read_stream(target_file, p.stderr, 'stderr', started)
+            )
+            runner.exit_codes[target_file] = await p.wait()
+        except asyncio.CancelledError:
+            # Its own session kept it from seeing the ^C.
+            self.interrupted.append(p)
+            raise
+        finally:
+            del self.processes[target_file]
+            runner.running.pop(target_file, None)
+
+        runner.handle_output(target_file, runner.spools[target_file].tail())
+
+    async def read_stream(self, target_file, stream, name, started):
+        while True:
+            try:
+                line = await stream.readuntil(b'\n')
+            except asyncio.IncompleteReadError as e:
+                # The last line, without a newline.
+                line = e.partial
+            except asyncio.LimitOverrunError as e:
+                # No newline within line_limit bytes. What's been read of the
+                # line is still buffered, so pass that on as a piece.
+                line = await stream.read(e.consumed)
+            if not line:
+                return
+            self.runner.handle_output_line(
+                target_file,
+                line.decode('utf-8', 'replace'),
+                name,
+                time.time() - started
+            )
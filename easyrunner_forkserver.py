@@ -0,0 +1,430 @@
+"""
+A fork server for running Python test files without starting a new
+interpreter for each one.
+
+The server is started once per run with the same interpreter the tests would
+use. It imports a set of (usually heavy) modules up front, then forks a child
+for each test file it's asked to run. The child runs the file the way
+`python <file>` would, as __main__, so whatever unittest.main() prints and
+exits with is unchanged; it also sends back a summary of the unittest results
+(tests run, failures, errors, skips). Every file still gets its own process,
+and its own process group, so files can't leak state into each other and can
+be killed like any other test process.
+
+Like easyrunner_async this needs Python 3, and EasyRunner imports it only for
+`--fork-server`. The client side (ForkServer) runs in the runner; the server
+side is this module run as a script:
+
+    python easyrunner_forkserver.py <socket fd> [module ...]
+"""
+import array
+import importlib
+import json
+import os
+import runpy
+import select
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import traceback
+
+# Big enough for any request or reply; results only list test names.
+MAX_MESSAGE = 1024 * 1024
+
+# Keeps message boundaries and reports the other end closing. macOS only has
+# datagrams, so the server also watches for its parent going away.
+SOCKET_TYPE = getattr(socket, 'SOCK_SEQPACKET', socket.SOCK_DGRAM)
+
+
+def send(sock, message, fds=()):
+    data = json.dumps(message).encode('utf-8')
+    if fds:
+        sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                               array.array('i', fds))])
+    else:
+        sock.send(data)
+
+
+def receive(sock):
+    """Returns the next message and any file descriptors sent with it."""
+    fds = array.array('i')
+    data, ancdata, flags, address = sock.recvmsg(
+        MAX_MESSAGE, socket.CMSG_SPACE(4 * fds.itemsize))
+    for level, kind, payload in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(payload[:len(payload) - len(payload) % fds.itemsize])
+    if not data:
+        return None, list(fds)
+    return json.loads(data.decode('utf-8')), list(fds)
+
+
+class ForkedProcess(object):
+    """
+    Stands in for a subprocess.Popen of a test file run by the fork server.
+    The process isn't the runner's own child, so its exit is reported by the
+    server rather than waited on.
+    """
+
+    def __init__(self, target_file, stdout=None):
+        self.target_file = target_file
+        self.stdout = stdout
+        self.pid = None
+        self.returncode = None
+        self.error = None
+        self.started = threading.Event()
+        self.exited = threading.Event()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        # Waiting in slices keeps ^C working on the main thread.
+        while not self.exited.wait(1):
+            pass
+        return self.returncode
+
+
+class ForkServer(object):
+    """
+    The runner's end of the fork server: starts the server, asks it to run
+    test files and hands back a ForkedProcess for each.
+    """
+
+    # How long to wait for the server to import its modules, and then for
+    # each fork.
+    start_timeout = 120
+    fork_timeout = 30
+
+    def __init__(self, command, preload_modules=()):
+        # The interpreter and its options, as an argument list.
+        self.command = list(command)
+        self.preload_modules = list(preload_modules)
+        self.processes = {}
+        self.results = {}
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.preloaded = []
+        self.failed_modules = []
+        self.server = None
+        self.sock = None
+
+    def start(self):
+        """Starts the server and waits for it to finish importing."""
+        self.sock, theirs = socket.socketpair(socket.AF_UNIX, SOCKET_TYPE)
+        argv = self.command + [
+            os.path.abspath(__file__),
+            str(theirs.fileno())
+        ] + self.preload_modules
+        self.server = subprocess.Popen(argv, pass_fds=[theirs.fileno()])
+        theirs.close()
+
+        reader = threading.Thread(target=self.read_replies)
+        reader.daemon = True
+        reader.start()
+        if not self.ready.wait(self.start_timeout) or \
+                self.server.poll() is not None:
+            self.stop()
+            raise OSError('The fork server failed to start.')
+
+    def stop(self):
+        """Shuts the server down, along with anything still running."""
+        if self.sock is not None:
+            try:
+                send(self.sock, {'op': 'stop'})
+            except OSError:
+                pass
+            self.sock.close()
+            self.sock = None
+        if self.server is not None:
+            self.server.wait()
+            self.server = None
+
+    def run(self, target_file, argv, stdout=subprocess.PIPE):
+        """
+        Has the server fork a child to run the target file with the given
+        argv, writing its stdout and stderr to the stdout file (or a pipe,
+        which becomes the process's stdout). Returns a ForkedProcess once the
+        child has started.
+        """
+        if stdout == subprocess.PIPE:
+            read_fd, write_fd = os.pipe()
+            p = ForkedProcess(target_file, os.fdopen(
+                read_fd, 'r', encoding='utf-8', errors='replace'))
+        else:
+            write_fd = stdout.fileno()
+            p = ForkedProcess(target_file)
+
+        with self.lock:
+            self.next_id += 1
+            request_id = self.next_id
+            self.processes[request_id] = p
+        try:
+            send(self.sock, {
+                'op': 'run',
+                'id': request_id,
+                'path': target_file,
+                'argv': argv
+            }, [write_fd])
+        finally:
+            if stdout == subprocess.PIPE:
+                os.close(write_fd)
+
+        if not p.started.wait(self.fork_timeout) or p.error:
+            with self.lock:
+                self.processes.pop(request_id, None)
+            raise OSError(p.error or 'The fork server stopped responding.')
+        return p
+
+    def read_replies(self):
+        while True:
+            try:
+                message, fds = receive(self.sock)
+            except (OSError, AttributeError, ValueError):
+                message = None
+            if message is None:
+                break
+            if 'ready' in message:
+                self.preloaded = message['preloaded']
+                self.failed_modules = message['failed']
+                self.ready.set()
+                continue
+            with self.lock:
+                p = self.processes.get(message['id'])
+            if p is None:
+                continue
+            if 'error' in message:
+                p.error = message['error']
+                p.started.set()
+            elif 'pid' in message:
+                p.pid = message['pid']
+                p.started.set()
+            elif 'exit' in message:
+                with self.lock:
+                    self.processes.pop(message['id'], None)
+                if message.get('result') is not None:
+                    self.results[p.target_file] = message['result']
+                p.returncode = message['exit']
+                p.exited.set()
+
+        # The server is gone; nothing else is going to finish.
+        with self.lock:
+            orphans = list(self.processes.values())
+            self.processes.clear()
+        for p in orphans:
+            if p.error is None and p.pid is None:
+                p.error = 'The fork server exited.'
+            p.returncode = -1
+            p.started.set()
+            p.exited.set()
+
+
+class Child(object):
+    def __init__(self, request_id, result_fd):
+        self.request_id = request_id
+        self.result_fd = result_fd
+        self.result_data = []
+        self.returncode = None
+
+
+def preload(modules):
+    loaded = []
+    failed = []
+    for name in modules:
+        try:
+            importlib.import_module(name)
+            loaded.append(name)
+        except Exception:
+            failed.append(name)
+    return loaded, failed
+
+
+def serve(sock, modules):
+    """Imports the modules, then forks a child for each request."""
+    loaded, failed = preload(modules)
+    parent = os.getppid()
+
+    # SIGCHLD wakes up the select() below by writing to this pipe.
+    wakeup_read, wakeup_write = os.pipe()
+    os.set_blocking(wakeup_write, False)
+    signal.set_wakeup_fd(wakeup_write)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    send(sock, {'ready': True, 'preloaded': loaded, 'failed': failed})
+
+    children = {}
+    results = {}
+    while True:
+        try:
+            readable = select.select(
+                [sock, wakeup_read] + list(results), [], [], 1)[0]
+        except InterruptedError:
+            continue
+        if os.getppid() != parent:
+            break
+        if wakeup_read in readable:
+            os.read(wakeup_read, 4096)
+
+        if sock in readable:
+            message, fds = receive(sock)
+            if message is None or message.get('op') == 'stop':
+                break
+            child = fork_child(sock, message, fds[0], [
+                wakeup_read, wakeup_write] + list(results))
+            for fd in fds:
+                os.close(fd)
+            if child is not None:
+                pid, child = child
+                children[pid] = child
+                results[child.result_fd] = child
+
+        for fd in [fd for fd in readable if fd in results]:
+            data = os.read(fd, 65536)
+            if data:
+                results[fd].result_data.append(data)
+            else:
+                os.close(fd)
+                results.pop(fd).result_fd = None
+
+        reap(children)
+        for pid, child in list(children.items()):
+            if child.returncode is None or child.result_fd is not None:
+                continue
+            del children[pid]
+            result = None
+            if child.result_data:
+                try:
+                    result = json.loads(
+                        b''.join(child.result_data).decode('utf-8'))
+                except ValueError:
+                    pass
+            send(sock, {
+                'id': child.request_id,
+                'exit': child.returncode,
+                'result': result
+            })
+
+    for pid in children:
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def reap(children):
+    while children:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+        if pid in children:
+            if os.WIFSIGNALED(status):
+                children[pid].returncode = -os.WTERMSIG(status)
+            else:
+                children[pid].returncode = os.WEXITSTATUS(status)
+
+
+def fork_child(sock, message, output_fd, inherited_fds):
+    """Forks a child for a run request; returns (pid, Child), or None."""
+    try:
+        result_read, result_write = os.pipe()
+        ready_read, ready_write = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+    except OSError as e:
+        send(sock, {'id': message['id'], 'error': str(e)})
+        return None
+
+    if pid == 0:
+        try:
+            # A process group of its own, like any other test process. This
+            # has to happen before the pid is sent, or a kill sent straight
+            # away could miss the child.
+            os.setsid()
+            os.close(ready_read)
+            os.close(ready_write)
+            sock.close()
+            os.close(result_read)
+            for fd in inherited_fds:
+                os.close(fd)
+            run_child(message, output_fd, result_write)
+        finally:
+            os._exit(1)
+
+    os.close(result_write)
+    # The child closes its end once it's in its own group (or it's died).
+    os.close(ready_write)
+    os.read(ready_read, 1)
+    os.close(ready_read)
+    send(sock, {'id': message['id'], 'pid': pid})
+    return pid, Child(message['id'], result_read)
+
+
+def run_child(message, output_fd, result_fd):
+    """
+    Runs a test file in a forked child and exits. This never returns.
+    """
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    os.dup2(output_fd, 1)
+    os.dup2(output_fd, 2)
+    os.close(output_fd)
+
+    path = message['path']
+    sys.argv = list(message['argv'])
+    sys.path[0] = os.path.dirname(os.path.abspath(path))
+
+    import unittest
+    results = []
+    run = unittest.TextTestRunner.run
+
+    def recording_run(self, test):
+        result = run(self, test)
+        results.append(result)
+        return result
+    unittest.TextTestRunner.run = recording_run
+
+    code = 0
+    try:
+        runpy.run_path(path, run_name='__main__')
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+
+    summary = None
+    if results:
+        summary = {
+            'tests': sum(r.testsRun for r in results),
+            'failures': [t.id() for r in results for t, tb in r.failures],
+            'errors': [t.id() for r in results for t, tb in r.errors],
+            'skipped': sum(len(r.skipped) for r in results),
+            'unexpected_successes': sum(
+                len(r.unexpectedSuccesses) for r in results)
+        }
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        with os.fdopen(result_fd, 'wb') as f:
+            f.write(json.dumps(summary).encode('utf-8'))
+    finally:
+        os._exit(code)
+
+
+if __name__ == '__main__':
+    # Preloaded modules are imported from where the tests run, not from
+    # here. Each child then puts its own file's folder first, like python.
+    sys.path[0] = os.getcwd()
+    serve(socket.socket(fileno=int(sys.argv[1])), sys.argv[2:])
@@ -5,6 +5,7 @@ from easyrunner import PythonUnittestRunner
 
 
 class ExampleTestRunner(PythonUnittestRunner):
+    parse_output_lines = True
 
     def __init__(self):
         super(ExampleTestRunner, self).__init__()
@@ -14,8 +15,18 @@ class ExampleTestRunner(PythonUnittestRunner):
         )
         self.set_command_path(search_path)
 
+    def parse_output_line(self, target_file, line, state):
+        line = line.strip()
+        if not line:
+            return
+        state['last_line'] = line
+        if line == "OK":
+            state['outcome'] = 'passed'
+        elif line.startswith("FAILED"):
+            state['outcome'] = 'failed'
+
     def update_log(self, target_file, output):
-        last_line = output.strip().splitlines()[-1].strip()
+        last_line = self.get_output_state(target_file).get('last_line')
         if last_line == "OK":
             self.log_pass()
         else:
@@ -1,4 +1,16 @@
 import easyrunner
+import io
+import json
+import os
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 from mock import patch
 from nose import tools as nt
@@ -23,6 +35,10 @@ def return_true(*args):
     return True
 
 
+def time_ago(seconds):
+    return time.time() - seconds
+
+
 class EasyRunnerTests(unittest.TestCase):
     def setUp(self):
         pass
@@ -38,8 +54,26 @@ class EasyRunnerTests(unittest.TestCase):
             '[------------------------------------->                                     ]'
         )
 
+    def test_runners_keep_their_own_run_state(self):
+        one = easyrunner.EasyRunner()
+        two = easyrunner.EasyRunner()
+        one.announce_test_file('a_test.py')
+        one.report_early_outcome('a_test.py', 'failed')
+        nt.assert_equal(two.started_at, {})
+        nt.assert_equal(two.early_failures, [])
+        nt.assert_is_not(one.profiler, two.profiler)
+
+    def test_runners_keep_their_own_exclusions(self):
+        one = easyrunner.EasyRunner()
+        one.add_exclude_glob('build')
+        nt.assert_true('build' in one.exclude_globs)
+        nt.assert_false('build' in easyrunner.EasyRunner().exclude_globs)
+        nt.assert_false('build' in easyrunner.EasyRunner.exclude_globs)
+
     @patch('os.path.exists', return_true)
-    @patch('os.walk', mock_os_walk)
+    @patch.object(easyrunner.DiscoveryIndex, 'walk',
+                  lambda self, path: mock_os_walk(path))
+    @patch.object(easyrunner.EasyRunner, 'use_index', False)
     def test_find_target_files(self):
         runner = easyrunner.EasyRunner()
         runner.add_required_pattern(r'\.py$')
@@ -57,3 +91,1602 @@ class EasyRunnerTests(unittest.TestCase):
             runner.find_target_files()
         )
 
+
+class EchoRunner(easyrunner.EasyRunner):
+    """Runs `echo` against each target file and passes anything that ran."""
+
+    def __init__(self, state_dir=None):
+        super(EchoRunner, self).__init__()
+        self.set_command('echo')
+        self.state_dir = state_dir or tempfile.mkdtemp()
+        self.test_log = {
+            'files': {},
+            'passes': 0,
+            'failures': 0,
+            'failed_tests': []
+        }
+
+    def get_state_save_path(self):
+        return os.path.join(self.state_dir, '.echo_runner_state')
+
+    def update_log(self, target_file, output):
+        if target_file in output:
+            self.log_pass()
+        else:
+            self.log_failure(target_file)
+
+
+class ParallelRunTests(unittest.TestCase):
+    def tearDown(self):
+        shutil.rmtree(self.runner.state_dir, ignore_errors=True)
+
+    @patch('multiprocessing.cpu_count', lambda: 6)
+    def test_set_jobs(self):
+        runner = self.runner = EchoRunner()
+        runner.set_jobs('3')
+        nt.assert_equal(runner.jobs, 3)
+        runner.set_jobs('auto')
+        nt.assert_equal(runner.jobs, 6)
+        runner.set_jobs(0)
+        nt.assert_equal(runner.jobs, 1)
+
+    def test_run_test_files_parallel(self):
+        runner = self.runner = EchoRunner()
+        runner.set_jobs(3)
+        runner.target_files = ['file_{0}'.format(i) for i in range(7)]
+        runner.run_tests()
+
+        nt.assert_equal(runner.test_log['passes'], 7)
+        nt.assert_equal(runner.test_log['failures'], 0)
+        nt.assert_equal(
+            sorted(runner.test_log['files']),
+            sorted(runner.target_files)
+        )
+        nt.assert_equal(runner.running, {})
+
+
+class SchedulingTests(unittest.TestCase):
+    def setUp(self):
+        self.runner = EchoRunner()
+
+    def tearDown(self):
+        shutil.rmtree(self.runner.state_dir, ignore_errors=True)
+
+    def test_schedule_longest_first(self):
+        self.runner.durations = {'a': 1.0, 'b': 30.0, 'c': 5.0, 'd': 2.0}
+        nt.assert_equal(
+            self.runner.schedule_target_files(['a', 'new', 'b', 'c', 'd']),
+            ['b', 'new', 'c', 'd', 'a']
+        )
+
+    def test_schedule_without_history_keeps_order(self):
+        self.runner.durations = {}
+        nt.assert_equal(
+            self.runner.schedule_target_files(['c', 'a', 'b']),
+            ['c', 'a', 'b']
+        )
+
+    def test_durations_are_recorded(self):
+        self.runner.set_jobs(2)
+        self.runner.target_files = ['one', 'two']
+        self.runner.run_tests()
+
+        durations = self.runner.get_results_db().durations()
+        nt.assert_equal(sorted(durations), ['one', 'two'])
+
+        self.runner.record_duration('one', durations['one'] + 4)
+        nt.assert_equal(self.runner.durations['one'], durations['one'] + 2)
+
+
+class DiscoveryIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.tree = tempfile.mkdtemp()
+        self.index_path = os.path.join(tempfile.mkdtemp(), '.index')
+        for d in ['a', 'a/deep', 'b']:
+            os.mkdir(os.path.join(self.tree, d))
+        for f in ['a/one_test.py', 'a/deep/two_test.py', 'b/three.txt']:
+            open(os.path.join(self.tree, f), 'w').close()
+        self.backdate(self.tree)
+
+    def tearDown(self):
+        shutil.rmtree(self.tree, ignore_errors=True)
+        shutil.rmtree(os.path.dirname(self.index_path), ignore_errors=True)
+
+    def backdate(self, path):
+        """Makes directory mtimes old enough for the index to trust them."""
+        for root, subfolders, files in os.walk(path):
+            os.utime(root, (time_ago(60), time_ago(60)))
+
+    def all_files(self, index):
+        found = []
+        for root, subfolders, files in index.walk(self.tree):
+            found.extend(os.path.join(root, f) for f in files)
+        return sorted(found)
+
+    def test_walk_matches_os_walk(self):
+        expected = sorted(
+            os.path.join(root, f)
+            for root, subfolders, files in os.walk(self.tree)
+            for f in files
+        )
+        index = easyrunner.DiscoveryIndex(self.index_path)
+        nt.assert_equal(self.all_files(index), expected)
+
+        index.save()
+        index = easyrunner.DiscoveryIndex(self.index_path)
+        index.load()
+        with patch('easyrunner.scandir') as scandir:
+            nt.assert_equal(self.all_files(index), expected)
+            nt.assert_equal(scandir.call_count, 0)
+
+    def test_refresh_lists_only_changed_directories(self):
+        index = easyrunner.DiscoveryIndex(self.index_path)
+        self.all_files(index)
+
+        new_file = os.path.join(self.tree, 'a', 'deep', 'four_test.py')
+        open(new_file, 'w').close()
+
+        listed = []
+        real_scandir = easyrunner.scandir
+
+        def spy_scandir(path):
+            listed.append(path)
+            return real_scandir(path)
+
+        with patch('easyrunner.scandir', spy_scandir):
+            nt.assert_true(new_file in self.all_files(index))
+        nt.assert_equal(listed, [os.path.join(self.tree, 'a', 'deep')])
+
+    def test_excluded_folders_are_pruned(self):
+        os.mkdir(os.path.join(self.tree, 'node_modules'))
+        open(os.path.join(self.tree, 'node_modules', 'x_test.py'), 'w').close()
+        self.backdate(self.tree)
+
+        index = easyrunner.DiscoveryIndex(
+            self.index_path,
+            exclude_globs=['node_modules', 'a/deep'],
+            threads=3
+        )
+        nt.assert_equal(self.all_files(index), [
+            os.path.join(self.tree, 'a', 'one_test.py'),
+            os.path.join(self.tree, 'b', 'three.txt'),
+        ])
+        nt.assert_false(
+            os.path.join(self.tree, 'node_modules') in index.trees[self.tree]
+        )
+
+    def test_bad_walk_thread_count(self):
+        runner = EchoRunner()
+        runner.set_walk_threads('0')
+        nt.assert_equal(runner.walk_threads, 1)
+        with patch.object(runner, 'quit', side_effect=SystemExit):
+            nt.assert_raises(SystemExit, runner.set_walk_threads, 'x')
+        shutil.rmtree(runner.state_dir, ignore_errors=True)
+
+    def test_threaded_walk_is_top_down(self):
+        serial = easyrunner.DiscoveryIndex(self.index_path, threads=1)
+        threaded = easyrunner.DiscoveryIndex(self.index_path, threads=4)
+        nt.assert_equal(
+            list(serial.walk(self.tree)),
+            list(threaded.walk(self.tree))
+        )
+        roots = [root for root, subfolders, files in serial.walk(self.tree)]
+        nt.assert_equal(roots[0], self.tree)
+        nt.assert_true(
+            roots.index(os.path.join(self.tree, 'a')) <
+            roots.index(os.path.join(self.tree, 'a', 'deep'))
+        )
+
+
+class PatternMatcherTests(unittest.TestCase):
+    paths = [
+        '/src/features/admin/UserTable.feature',
+        '/src/features/admin/usertable.feature.orig',
+        '/src/tests/test_billing.py',
+        '/src/tests/test_BILLING_report.py',
+        '/src/tests/abab_test.py',
+        u'/src/tests/\u212aelvin_test.py',
+        '/src/README.txt',
+    ]
+
+    def legacy_matches(self, required, optional, use_all_files=False):
+        matches = []
+        for p in self.paths:
+            if not all(r.search(p) for r in required):
+                continue
+            if (use_all_files or len(optional) == 0 or
+                    any(r.search(p) for r in optional)):
+                matches.append(p)
+        return matches
+
+    def assert_same_as_legacy(self, required, optional, use_all_files=False):
+        required = [re.compile(p, re.I) for p in required]
+        optional = [re.compile(p, re.I) for p in optional]
+        matcher = easyrunner.PatternMatcher(required, optional, use_all_files)
+        expected = self.legacy_matches(required, optional, use_all_files)
+        nt.assert_equal(matcher.filter(self.paths), expected)
+        nt.assert_equal(
+            [p for p in self.paths if matcher.match(p)],
+            expected
+        )
+
+    def test_plain_text_patterns(self):
+        self.assert_same_as_legacy([r'\.py$'], ['billing', 'kelvin'])
+        self.assert_same_as_legacy(['feature'], ['usertable'])
+        self.assert_same_as_legacy([], ['readme', 'admin/user'])
+
+    def test_regex_patterns(self):
+        self.assert_same_as_legacy([r'\.feature$'], [r'user\w+', 'nothing'])
+        self.assert_same_as_legacy([r'^/src', r'test_'], [r'(ab)\1', 'x|y'])
+        self.assert_same_as_legacy([r'\.py$'], ['billing'], use_all_files=True)
+
+    def test_literal(self):
+        literal = easyrunner.PatternMatcher.literal
+        nt.assert_equal(literal(re.compile(r'\.py$')), '.py')
+        nt.assert_equal(literal(re.compile(r'.*Feature$')), 'feature')
+        nt.assert_equal(literal(re.compile(r'a|b')), None)
+
+
+class OutputSpoolTests(unittest.TestCase):
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+    def test_tail_is_bounded(self):
+        spool = easyrunner.OutputSpool(self.spool_dir, 'some/file.feature')
+        spool.tail_bytes = 100
+        for i in range(1000):
+            spool.write('line {0}\n'.format(i))
+        tail = spool.tail()
+        nt.assert_true(len(tail) <= 100)
+        nt.assert_true(tail.startswith('line '))
+        nt.assert_true(tail.endswith('line 999\n'))
+
+    def test_only_failed_output_is_kept(self):
+        runner = EchoRunner()
+        runner.set_jobs(2)
+        runner.target_files = ['passes', 'fails']
+        runner.update_log = lambda target_file, output: (
+            runner.log_failure(target_file) if target_file == 'fails'
+            else runner.log_pass()
+        )
+        try:
+            runner.run_tests()
+            logs = os.listdir(runner.spool_dir)
+            nt.assert_equal(len(logs), 1)
+            nt.assert_true(logs[0].startswith('fails.'))
+            with open(os.path.join(runner.spool_dir, logs[0])) as f:
+                nt.assert_equal(f.read(), 'fails\n')
+        finally:
+            shutil.rmtree(runner.state_dir, ignore_errors=True)
+            shutil.rmtree(runner.spool_dir, ignore_errors=True)
+
+    def test_log_keeps_only_an_excerpt_of_failures(self):
+        runner = EchoRunner()
+        runner.excerpt_lines = 3
+        runner.set_command(
+            'sh -c \'seq 1000; case "$0" in fails) exit 1;; esac\'')
+        runner.target_files = ['passes', 'fails']
+        runner.update_log = lambda target_file, output: (
+            runner.log_failure(target_file) if target_file == 'fails'
+            else runner.log_pass()
+        )
+        try:
+            runner.run_tests()
+            nt.assert_equal(runner.test_log['files'],
+                            {'passes': '', 'fails': '998\n999\n1000\n'})
+        finally:
+            shutil.rmtree(runner.state_dir, ignore_errors=True)
+            shutil.rmtree(runner.spool_dir, ignore_errors=True)
+
+
+class AsyncEngineTests(unittest.TestCase):
+    def setUp(self):
+        self.runner = EchoRunner()
+        self.runner.set_engine('async')
+        self.runner.lines = []
+        real_handle_output_line = self.runner.handle_output_line
+
+        def handle_output_line(target_file, line, stream, elapsed):
+            self.runner.lines.append((target_file, stream, line))
+            real_handle_output_line(target_file, line, stream, elapsed)
+        self.runner.handle_output_line = handle_output_line
+
+    def tearDown(self):
+        shutil.rmtree(self.runner.state_dir, ignore_errors=True)
+
+    def test_reads_stdout_and_stderr(self):
+        # Enough stderr to fill a pipe if nobody were reading it.
+        self.runner.set_command(
+            'python -c "import sys; sys.stderr.write(\'x\' * 200000 + '
+            '\'\\\\n\'); sys.stderr.flush(); print(sys.argv[1])"'
+        )
+        self.runner.set_jobs(2)
+        self.runner.target_files = ['one', 'two', 'three']
+        self.runner.run_tests()
+
+        nt.assert_equal(self.runner.test_log['passes'], 3)
+        streams = set((t, stream) for t, stream, line in self.runner.lines)
+        for target_file in self.runner.target_files:
+            nt.assert_true((target_file, 'stdout') in streams)
+            nt.assert_true((target_file, 'stderr') in streams)
+        nt.assert_equal(self.runner.running, {})
+
+    def test_long_lines_come_in_pieces(self):
+        import easyrunner_async
+        self.runner.set_command(
+            'python -c "import sys; print(\'x\' * 5000 + sys.argv[1])"')
+        self.runner.target_files = ['one']
+        with patch.object(easyrunner_async.AsyncEngine, 'line_limit', 1024):
+            self.runner.run_tests()
+
+        pieces = [line for t, stream, line in self.runner.lines
+                  if stream == 'stdout']
+        nt.assert_true(len(pieces) > 1)
+        nt.assert_equal(''.join(pieces), 'x' * 5000 + 'one\n')
+        nt.assert_equal(self.runner.test_log['passes'], 1)
+
+
+class OutputParsingTests(unittest.TestCase):
+    summary = [
+        '\033[32m  Scenario: Something passes\033[0m\n',
+        '3 scenarios (\033[32m2 passed\033[0m, \033[31m1 failed\033[0m)\n',
+        '12 steps (\033[32m11 passed\033[0m, \033[31m1 failed\033[0m)\n',
+        '0m4.21s\n',
+    ]
+
+    def setUp(self):
+        self.runner = easyrunner.BehatRunner.__new__(easyrunner.BehatRunner)
+        self.runner.outcome_re = re.compile(r'\d+\Wscenarios?\W\(.+\)')
+        self.runner.pass_re = re.compile(r'[1-9]+ passed\)')
+        self.runner.output_states = {}
+        self.runner.profiler = easyrunner.PhaseProfiler()
+        self.runner.test_log = {
+            'files': {},
+            'passes': 0,
+            'failures': 0,
+            'failed_tests': []
+        }
+
+    def test_behat_outcome_is_known_at_summary_line(self):
+        outcomes = [
+            self.runner.feed_output_line('x.feature', line)
+            for line in self.summary
+        ]
+        nt.assert_equal(outcomes, [None, 'failed', None, None])
+
+        self.runner.update_log('x.feature', '')
+        nt.assert_equal(self.runner.test_log['failed_tests'], ['x.feature'])
+        nt.assert_equal(
+            self.runner.test_log['files']['x.feature'],
+            ['3 scenarios (2 passed, 1 failed)']
+        )
+
+    def test_behat_pass(self):
+        for line in ['1 scenario (1 passed)\n', '4 steps (4 passed)\n']:
+            self.runner.feed_output_line('y.feature', line)
+        nt.assert_equal(
+            self.runner.get_output_state('y.feature')['outcome'], 'passed')
+        self.runner.update_log('y.feature', '')
+        nt.assert_equal(self.runner.test_log['passes'], 1)
+
+
+class FailedRerunTests(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.runner = self.make_runner()
+
+    def tearDown(self):
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+
+    def make_runner(self, failing=()):
+        runner = EchoRunner(self.state_dir)
+        runner.update_log = lambda target_file, output: (
+            runner.log_failure(target_file) if target_file in failing
+            else runner.log_pass()
+        )
+        return runner
+
+    def test_failed_files_follow_latest_outcome(self):
+        runner = self.make_runner(failing=['b', 'c'])
+        runner.target_files = ['a', 'b', 'c']
+        runner.save_state()
+        runner.run_tests()
+        nt.assert_equal(runner.get_results_db().failed_files(), ['b', 'c'])
+
+        # Rerunning only 'c', which now passes, leaves 'b' failed.
+        runner = self.make_runner()
+        runner.target_files = ['c']
+        runner.save_state()
+        runner.run_tests()
+        results_db = runner.get_results_db()
+        nt.assert_equal(results_db.failed_files(), ['b'])
+        nt.assert_equal(sorted(results_db.durations()), ['a', 'b', 'c'])
+        nt.assert_equal(runner.load_state()['files'], ['c'])
+
+    def test_failed_with_a_runner_flag(self):
+        failed = [os.path.join(self.state_dir, name)
+                  for name in ('a_test.py', 'b_test.py')]
+        for path in failed:
+            open(path, 'w').close()
+        self.runner.history_loaded = True
+        self.runner.failed_files = failed
+        self.runner.set_cli_args(['easyrunner.py', '--nose', '--failed'])
+        with patch.object(self.runner, 'prompt_user'):
+            self.runner.resume_failed()
+        nt.assert_equal(self.runner.target_files, failed)
+
+        # Patterns that were typed still narrow the failures down.
+        runner = self.make_runner()
+        runner.history_loaded = True
+        runner.failed_files = failed
+        runner.set_cli_args(['easyrunner.py', '--nose', '--failed', 'b_'])
+        with patch.object(runner, 'prompt_user'):
+            runner.resume_failed()
+        nt.assert_equal(runner.target_files, failed[1:])
+
+    def test_put_failures_first(self):
+        self.runner.history_loaded = True
+        self.runner.failed_files = ['d', 'b']
+        nt.assert_equal(
+            self.runner.put_failures_first(['a', 'b', 'c', 'd']),
+            ['b', 'd', 'a', 'c']
+        )
+
+    def test_failures_run_first(self):
+        self.runner.history_loaded = True
+        self.runner.failed_files = ['z']
+        self.runner.failures_first = True
+        self.runner.target_files = ['x', 'y', 'z']
+        started = []
+        self.runner.announce_test_file = started.append
+        self.runner.run_tests()
+        nt.assert_equal(started, ['z', 'x', 'y'])
+
+
+class ResultsDBTests(unittest.TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.db_dir, 'results.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.db_dir, ignore_errors=True)
+
+    def test_results_are_appended(self):
+        results_db = easyrunner.ResultsDB(self.path, 'Some Runner')
+        for outcome, duration, exit_code in [
+                ('passed', 2.0, 0), ('failed', 4.0, 1), ('passed', 6.0, 0)]:
+            run_id = results_db.start_run(jobs=1)
+            results_db.record_result(
+                run_id, 'a.feature', outcome, duration, exit_code)
+            results_db.finish_run(run_id)
+
+        history = results_db.file_history('a.feature')
+        nt.assert_equal(
+            [(h['outcome'], h['exit_code']) for h in history],
+            [('passed', 0), ('failed', 1), ('passed', 0)]
+        )
+        nt.assert_equal(results_db.durations(), {'a.feature': 4.5})
+        nt.assert_equal(results_db.failed_files(), [])
+
+    def test_runners_and_connections_share_the_file(self):
+        # Create the schema up front, as the first run would.
+        easyrunner.ResultsDB(self.path, 'Runner 0').close()
+
+        def write(worker):
+            results_db = easyrunner.ResultsDB(
+                self.path, 'Runner {0}'.format(worker % 2))
+            run_id = results_db.start_run(jobs=4)
+            for i in range(25):
+                results_db.record_result(
+                    run_id, 'file_{0}'.format(i), 'failed', 1.0, 1)
+
+        threads = [
+            easyrunner.threading.Thread(target=write, args=(i,))
+            for i in range(4)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        reader = easyrunner.ResultsDB(self.path, 'Runner 0')
+        nt.assert_equal(len(reader.failed_files()), 25)
+        nt.assert_equal(len(reader.file_history('file_3')), 2)
+        count = reader.conn.execute('SELECT COUNT(*) FROM results').fetchone()
+        nt.assert_equal(count[0], 100)
+
+    def test_state_round_trip(self):
+        results_db = easyrunner.ResultsDB(self.path, 'Behat Runner')
+        nt.assert_equal(results_db.load_state(), None)
+        results_db.save_state({'files': ['x'], 'tags': set(['b', 'a'])})
+        nt.assert_equal(
+            results_db.load_state(), {'files': ['x'], 'tags': ['a', 'b']})
+
+
+class ShardingTests(unittest.TestCase):
+    def setUp(self):
+        self.runner = EchoRunner()
+        self.runner.set_command_path(self.runner.state_dir)
+        self.runner.history_loaded = True
+        self.runner.durations = {
+            'a': 50.0, 'b': 40.0, 'c': 30.0, 'd': 20.0, 'e': 10.0, 'f': 10.0
+        }
+        self.target_files = ['a', 'b', 'c', 'd', 'e', 'f', 'new_1', 'new_2']
+        self.runner.save_shard_timings(self.target_files)
+
+    def tearDown(self):
+        shutil.rmtree(self.runner.state_dir, ignore_errors=True)
+
+    def shards(self, count, target_files, runners=None):
+        shards = []
+        for i in range(1, count + 1):
+            runner = runners[i - 1] if runners else self.runner
+            runner.set_shard('{0}/{1}'.format(i, count))
+            shards.append(runner.shard_target_files(target_files))
+        return shards
+
+    def test_shards_cover_every_file_once(self):
+        shards = self.shards(3, self.target_files)
+        covered = [t for shard in shards for t in shard]
+        nt.assert_equal(sorted(covered), sorted(self.target_files))
+
+    def test_shards_are_balanced_by_duration(self):
+        # New files count as the median known duration, 30s.
+        loads = [
+            sum(self.runner.expected_duration(t, 30.0) for t in shard)
+            for shard in self.shards(2, self.target_files)
+        ]
+        nt.assert_equal(loads, [110.0, 110.0])
+
+    def test_nodes_with_different_histories_agree(self):
+        nodes = []
+        for durations in [{'a': 1.0, 'f': 90.0}, {'b': 70.0, 'new_1': 5.0}]:
+            node = EchoRunner(self.runner.state_dir)
+            node.set_command_path(self.runner.state_dir)
+            node.history_loaded = True
+            node.durations = durations
+            nodes.append(node)
+        covered = [t for shard in self.shards(2, self.target_files, nodes)
+                   for t in shard]
+        nt.assert_equal(sorted(covered), sorted(self.target_files))
+
+    def test_split_by_count_without_timings(self):
+        os.remove(self.runner.get_shard_timings_path())
+        nt.assert_equal(
+            [len(shard) for shard in self.shards(3, self.target_files)],
+            [3, 3, 2])
+
+    def test_split_ignores_discovery_order(self):
+        reordered = list(reversed(self.target_files))
+        nt.assert_equal(
+            [sorted(shard) for shard in self.shards(3, self.target_files)],
+            [sorted(shard) for shard in self.shards(3, reordered)]
+        )
+
+    def test_bad_shard(self):
+        with patch.object(self.runner, 'quit', side_effect=SystemExit):
+            for shard in ['0/3', '4/3', 'x', '1/0']:
+                nt.assert_raises(SystemExit, self.runner.set_shard, shard)
+
+
+class TimeoutTests(unittest.TestCase):
+    def setUp(self):
+        self.runner = EchoRunner()
+        # The backgrounded sleep stands in for a browser the test started.
+        self.runner.set_command("sh -c 'sleep 30 & sleep 30; echo $1' sh")
+        self.runner.kill_grace = 0.5
+
+    def tearDown(self):
+        shutil.rmtree(self.runner.state_dir, ignore_errors=True)
+
+    def test_timed_out_files_are_killed_and_logged(self):
+        self.runner.set_timeout(0.5)
+        self.runner.set_jobs(2)
+        self.runner.target_files = ['slow_1', 'slow_2']
+
+        started = time.time()
+        self.runner.run_tests()
+        nt.assert_true(time.time() - started < 10)
+
+        nt.assert_equal(self.runner.timed_out, set(['slow_1', 'slow_2']))
+        nt.assert_equal(self.runner.test_log['failures'], 2)
+        history = self.runner.get_results_db().file_history('slow_1')
+        nt.assert_equal(history[0]['outcome'], 'timed out')
+
+    def test_global_timeout_skips_the_rest(self):
+        self.runner.set_global_timeout(0.5)
+        self.runner.target_files = ['slow_1', 'slow_2', 'slow_3']
+        self.runner.run_tests()
+
+        nt.assert_equal(list(self.runner.test_log['files']), ['slow_1'])
+        nt.assert_equal(self.runner.timed_out, set(['slow_1']))
+
+
+class AbortTests(unittest.TestCase):
+    # Runs an EchoRunner: state dir, command, engine, then the targets.
+    runner_script = """
+import sys, tests
+runner = tests.EchoRunner(sys.argv[1])
+runner.set_command(sys.argv[2])
+runner.set_engine(sys.argv[3])
+runner.set_jobs(2)
+runner.kill_grace = 0.5
+runner.target_files = sys.argv[4:]
+runner.run_tests()
+"""
+    # Notes its process group, and shrugs off SIGTERM, as does its sleep.
+    command = 'sh -c \'trap "" TERM; echo $$ > "$0.pid"; sleep 30\''
+
+    def setUp(self):
+        self.tree = tempfile.mkdtemp()
+        self.targets = [os.path.join(self.tree, 'file_{0}'.format(i))
+                        for i in range(2)]
+        self.groups = []
+
+    def tearDown(self):
+        for group in self.groups:
+            try:
+                os.killpg(group, signal.SIGKILL)
+            except OSError:
+                pass
+        shutil.rmtree(self.tree, ignore_errors=True)
+
+    def group_alive(self, group):
+        try:
+            os.killpg(group, 0)
+            return True
+        except OSError:
+            return False
+
+    def wait_for(self, condition, seconds=10):
+        deadline = time.time() + seconds
+        while not condition() and time.time() < deadline:
+            time.sleep(0.05)
+        return condition()
+
+    def check_abort(self, engine):
+        with open(os.devnull, 'w') as devnull:
+            p = subprocess.Popen(
+                [sys.executable, '-c', self.runner_script, self.tree,
+                 self.command, engine] + self.targets,
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stdout=devnull
+            )
+        try:
+            pid_files = [t + '.pid' for t in self.targets]
+            nt.assert_true(self.wait_for(
+                lambda: all(os.path.exists(f) and os.path.getsize(f)
+                            for f in pid_files)))
+            for f in pid_files:
+                with open(f) as pid_file:
+                    self.groups.append(int(pid_file.read()))
+
+            p.send_signal(signal.SIGINT)
+            nt.assert_true(self.wait_for(lambda: p.poll() is not None))
+        finally:
+            if p.poll() is None:
+                p.kill()
+                p.wait()
+        for group in self.groups:
+            nt.assert_true(self.wait_for(
+                lambda: not self.group_alive(group), 2))
+
+    def test_abort_kills_stubborn_children(self):
+        self.check_abort('threads')
+
+    def test_abort_kills_async_children(self):
+        self.check_abort('async')
+
+
+class ResourceSamplerTests(unittest.TestCase):
+    def setUp(self):
+        self.runner = EchoRunner()
+
+    def tearDown(self):
+        shutil.rmtree(self.runner.state_dir, ignore_errors=True)
+
+    @unittest.skipUnless(easyrunner.ResourceSampler.available(), 'no /proc')
+    def test_samples_the_process_group(self):
+        # The memory is held by a grandchild of the test process.
+        self.runner.set_command(
+            'python -c "import time, subprocess; subprocess.call([\'python\','
+            ' \'-c\', \'x = bytearray(64 * 1024 * 1024); import time; '
+            'time.sleep(1.5)\'])"'
+        )
+        self.runner.sample_resources = True
+        self.runner.target_files = ['hungry']
+        with patch.object(easyrunner.ResourceSampler, 'interval', 0.1):
+            self.runner.run_tests()
+
+        resources = self.runner.test_log['resources']['hungry']
+        nt.assert_true(resources['peak_rss'] > 64 * 1024 * 1024)
+        nt.assert_true(resources['cpu_seconds'] >= 0)
+        heaviest = self.runner.get_results_db().heaviest_files()
+        nt.assert_equal(heaviest[0][0], 'hungry')
+        nt.assert_equal(heaviest[0][1], resources['peak_rss'])
+
+    def test_old_databases_get_the_new_columns(self):
+        path = os.path.join(self.runner.state_dir, 'old.db')
+        conn = easyrunner.sqlite3.connect(path)
+        conn.execute(
+            'CREATE TABLE results (id INTEGER PRIMARY KEY, run_id INTEGER, '
+            'runner TEXT, target TEXT, outcome TEXT, duration REAL, '
+            'exit_code INTEGER, finished REAL)')
+        conn.commit()
+        conn.close()
+
+        results_db = easyrunner.ResultsDB(path, 'Runner')
+        results_db.record_result(1, 'a', 'passed', 1.0, 0, {'peak_rss': 10})
+        nt.assert_equal(results_db.heaviest_files(), [('a', 10, None)])
+
+
+class ProfilerTests(unittest.TestCase):
+    def setUp(self):
+        self.runner = EchoRunner()
+
+    def tearDown(self):
+        shutil.rmtree(self.runner.state_dir, ignore_errors=True)
+
+    def test_disabled_by_default(self):
+        nt.assert_false(self.runner.profiler.enabled)
+        with self.runner.profiler.phase('spawn'):
+            pass
+        nt.assert_equal(self.runner.profiler.seconds, {})
+
+    def test_profiles_each_phase(self):
+        self.runner.cli_args = ['runner', '--profile']
+        self.runner.process_cli_args()
+        self.runner.target_files = ['a', 'b']
+        self.runner.run_tests()
+
+        profile = self.runner.test_log['profile']
+        phases = profile['phases']
+        nt.assert_equal(phases['spawn']['count'], 2)
+        nt.assert_equal(phases['child']['count'], 2)
+        nt.assert_equal(phases['recording']['count'], 2)
+        nt.assert_equal(phases['rendering']['count'], 2)
+        nt.assert_true(profile['wall_seconds'] >= profile['overhead_seconds'])
+        nt.assert_true(0 <= profile['overhead_fraction'] <= 1)
+
+
+class BatchTests(unittest.TestCase):
+    def setUp(self):
+        self.runner = EchoRunner()
+        self.runner.batchable = True
+        self.runner.history_loaded = True
+
+    def tearDown(self):
+        shutil.rmtree(self.runner.state_dir, ignore_errors=True)
+
+    def test_fixed_size_batches(self):
+        self.runner.set_batch_size('2')
+        nt.assert_equal(
+            self.runner.make_batches(['a', 'b', 'c']),
+            ['batch 1 (2 files)', 'c']
+        )
+        nt.assert_equal(self.runner.batches, {'batch 1 (2 files)': ['a', 'b']})
+        nt.assert_true('a b' in self.runner.build_command('batch 1 (2 files)'))
+
+    def test_auto_batches_by_expected_duration(self):
+        self.runner.set_batch_size('auto')
+        self.runner.durations = {'a': 20.0, 'b': 20.0, 'c': 5.0, 'd': 5.0}
+        nt.assert_equal(
+            self.runner.make_batches(['a', 'b', 'c', 'd']),
+            ['a', 'batch 1 (3 files)']
+        )
+
+        # Batches get smaller so that every job has something to do.
+        self.runner.set_jobs(5)
+        nt.assert_equal(
+            self.runner.make_batches(['a', 'b', 'c', 'd']),
+            ['a', 'b', 'batch 1 (2 files)']
+        )
+
+    def test_unbatchable_runners_ignore_it(self):
+        self.runner.batchable = False
+        self.runner.set_batch_size('5')
+        nt.assert_equal(self.runner.batch_size, None)
+
+    def test_failures_are_split_out_per_file(self):
+        # Fails the batch, naming its second file.
+        self.runner.set_command("sh -c 'echo failed: $2; exit 1' sh")
+        self.runner.set_batch_size(3)
+        self.runner.target_files = ['alpha', 'beta', 'gamma']
+        self.runner.run_tests()
+
+        nt.assert_equal(self.runner.test_log['passes'], 2)
+        nt.assert_equal(self.runner.test_log['failed_tests'], ['beta'])
+        nt.assert_equal(self.runner.test_log['files']['beta'],
+                        'failed: beta\n')
+        nt.assert_equal(set(self.runner.durations),
+                        set(['alpha', 'beta', 'gamma']))
+        history = self.runner.get_results_db().file_history('beta')
+        nt.assert_equal(history[0]['outcome'], 'failed')
+        nt.assert_equal(history[0]['exit_code'], 1)
+
+    def test_parsed_failures_count_despite_exit_code(self):
+        # Exits 0 but reports its second file as failing.
+        runner = self.runner
+        runner.parse_output_lines = True
+        runner.parse_output_line = lambda t, line, state: state.update(
+            outcome='failed' if 'FAIL' in line else 'passed')
+        runner.set_command(
+            "sh -c 'echo ok: $1; echo FAIL: $2; echo ok: $3' sh")
+        runner.set_batch_size(3)
+        runner.target_files = ['alpha', 'beta', 'gamma']
+        runner.run_tests()
+
+        nt.assert_equal(runner.test_log['passes'], 2)
+        nt.assert_equal(runner.test_log['failed_tests'], ['beta'])
+        nt.assert_equal(runner.test_log['files']['beta'], 'FAIL: beta\n')
+
+
+class ForkServerTests(unittest.TestCase):
+    passing = '\n'.join([
+        'import sys, unittest',
+        'class T(unittest.TestCase):',
+        '    def test_preloaded(self):',
+        '        self.assertTrue("heavy" in sys.modules)',
+        'if __name__ == "__main__":',
+        '    unittest.main()',
+        ''
+    ])
+    failing = passing.replace('assertTrue', 'assertFalse')
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tree = tempfile.mkdtemp()
+        for name, source in [('heavy.py', 'loaded = True\n'),
+                             ('pass_test.py', self.passing),
+                             ('fail_test.py', self.failing)]:
+            with open(os.path.join(self.tree, name), 'w') as f:
+                f.write(source)
+
+        state_dir = self.state_dir = tempfile.mkdtemp()
+
+        class ForkRunner(easyrunner.PythonUnittestRunner):
+            def get_state_save_path(self):
+                return os.path.join(state_dir, '.fork_runner_state')
+
+        self.runner = ForkRunner()
+        self.runner.set_command(sys.executable)
+        self.runner.set_command_path(self.tree)
+        self.runner.history_loaded = True
+        self.runner.test_log = {
+            'files': {}, 'passes': 0, 'failures': 0, 'failed_tests': []}
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tree, ignore_errors=True)
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+
+    @unittest.skipUnless(sys.version_info >= (3, 3) and
+                         hasattr(socket, 'AF_UNIX'), 'needs Python 3')
+    def test_runs_each_file_in_a_forked_child(self):
+        self.runner.set_fork_server(True, ['heavy'])
+        self.runner.target_files = [
+            os.path.join(self.tree, 'pass_test.py'),
+            os.path.join(self.tree, 'fail_test.py')
+        ]
+        self.runner.run_tests()
+
+        nt.assert_equal(self.runner.test_log['passes'], 1)
+        nt.assert_equal(self.runner.test_log['failed_tests'],
+                        [self.runner.target_files[1]])
+        nt.assert_equal(
+            self.runner.test_log['files'][self.runner.target_files[1]],
+            ['1 tests', '1 failures', '0 errors', '0 skipped'])
+        history = self.runner.get_results_db().file_history(
+            self.runner.target_files[1])
+        nt.assert_equal(history[0]['exit_code'], 1)
+
+    def test_results_are_the_same_without_it(self):
+        # Without the fork server, heavy isn't imported, so these flip.
+        self.runner.target_files = [
+            os.path.join(self.tree, 'fail_test.py'),
+            os.path.join(self.tree, 'pass_test.py')
+        ]
+        self.runner.run_tests()
+
+        nt.assert_equal(self.runner.test_log['passes'], 1)
+        nt.assert_equal(self.runner.test_log['failed_tests'],
+                        [self.runner.target_files[1]])
+        nt.assert_equal(
+            self.runner.test_log['files'][self.runner.target_files[1]],
+            ['1 tests', '1 failures', '0 errors', '0 skipped'])
+        nt.assert_equal(
+            self.runner.test_log['files'][self.runner.target_files[0]],
+            ['1 tests', '0 failures', '0 errors', '0 skipped'])
+
+    @unittest.skipUnless(sys.version_info >= (3, 3) and
+                         hasattr(socket, 'AF_UNIX'), 'needs Python 3')
+    def test_results_are_dropped_once_logged(self):
+        # As by a runner with its own update_log.
+        self.runner.update_log = lambda target_file, output: \
+            self.runner.log_pass()
+        self.runner.set_fork_server(True, ['heavy'])
+        self.runner.target_files = [
+            os.path.join(self.tree, 'pass_test.py'),
+            os.path.join(self.tree, 'fail_test.py')
+        ]
+        self.runner.run_tests()
+
+        nt.assert_equal(self.runner.test_log['passes'], 2)
+        nt.assert_equal(self.runner.fork_server.results, {})
+
+    @unittest.skipUnless(sys.version_info >= (3, 3) and
+                         hasattr(socket, 'AF_UNIX'), 'needs Python 3')
+    def test_children_can_be_killed_straight_away(self):
+        from easyrunner_forkserver import ForkServer
+        sleeper = os.path.join(self.tree, 'sleep_test.py')
+        with open(sleeper, 'w') as f:
+            f.write('import time\ntime.sleep(30)\n')
+
+        server = ForkServer([sys.executable])
+        server.start()
+        try:
+            for _ in range(5):
+                with open(os.devnull, 'w') as devnull:
+                    p = server.run(sleeper, [sleeper], devnull)
+                # The child has its own group by the time its pid is known.
+                os.killpg(p.pid, signal.SIGKILL)
+                nt.assert_true(p.exited.wait(10))
+                nt.assert_equal(p.returncode, -signal.SIGKILL)
+        finally:
+            server.stop()
+
+    def test_other_runners_cant_use_it(self):
+        runner = EchoRunner()
+        runner.set_fork_server(True)
+        nt.assert_false(runner.use_fork_server)
+        shutil.rmtree(runner.state_dir, ignore_errors=True)
+
+
+class DirectExecTests(unittest.TestCase):
+    def setUp(self):
+        self.runner = EchoRunner()
+        self.runner.command_prefixes = set()
+        self.runner.command_suffixes = set()
+
+    def tearDown(self):
+        shutil.rmtree(self.runner.state_dir, ignore_errors=True)
+
+    def test_builds_an_argument_list(self):
+        self.runner.add_prefix('--config "my config.yml"')
+        self.runner.add_suffix('--ansi')
+        nt.assert_equal(
+            self.runner.build_argv('/src/my tests/a_test.py'),
+            ['echo', '--config', 'my config.yml', '/src/my tests/a_test.py',
+             '--ansi']
+        )
+        nt.assert_equal(
+            self.runner.build_command('/src/my tests/a_test.py'),
+            "echo --config 'my config.yml' '/src/my tests/a_test.py' --ansi"
+        )
+
+    def test_paths_are_passed_untouched(self):
+        self.runner.target_files = ['my tests/a $HOME *.py']
+        self.runner.run_tests()
+        nt.assert_equal(self.runner.test_log['passes'], 1)
+
+    def test_shell_runners_still_get_a_shell(self):
+        self.runner.shell = True
+        self.runner.set_command('true && echo')
+        self.runner.target_files = ['a_test.py']
+        self.runner.run_tests()
+        nt.assert_equal(self.runner.test_log['passes'], 1)
+
+
+class WatchTests(unittest.TestCase):
+    def setUp(self):
+        self.tree = tempfile.mkdtemp()
+        self.runner = EchoRunner()
+        self.runner.file_required_res = set()
+        self.runner.file_optional_res = set()
+        self.runner.add_required_pattern(r'_test\.py$')
+
+    def tearDown(self):
+        shutil.rmtree(self.tree, ignore_errors=True)
+        shutil.rmtree(self.runner.state_dir, ignore_errors=True)
+
+    def write(self, name, text):
+        path = os.path.join(self.tree, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def check_watcher(self, watcher):
+        self.write('node_modules/x_test.py', 'ignored')
+        path = self.write('new/a_test.py', 'a')
+        changed = watcher.wait(0.1)
+        watcher.close()
+        nt.assert_true(path in changed)
+        nt.assert_false(
+            os.path.join(self.tree, 'node_modules', 'x_test.py') in changed)
+
+    def test_polling_watcher(self):
+        watcher = easyrunner.PollingWatcher([self.tree], ['node_modules'])
+        with patch.object(easyrunner.PollingWatcher, 'interval', 0.05):
+            self.check_watcher(watcher)
+
+    @unittest.skipUnless(easyrunner.InotifyWatcher.available(), 'no inotify')
+    def test_inotify_watcher(self):
+        os.mkdir(os.path.join(self.tree, 'node_modules'))
+        self.check_watcher(
+            easyrunner.InotifyWatcher([self.tree], ['node_modules']))
+
+    def test_only_real_changes_are_rerun(self):
+        same = self.write('same_test.py', 'same')
+        edited = self.write('edited_test.py', 'before')
+        digests = dict((p, self.runner.file_digest(p)) for p in [same, edited])
+
+        self.write('edited_test.py', 'after')
+        new = self.write('new_test.py', 'new')
+        helper = self.write('helper.py', 'not a test')
+        nt.assert_equal(
+            self.runner.changed_target_files(
+                set([same, edited, new, helper]), digests),
+            [edited, new]
+        )
+
+        # After an overflow every known file is checked.
+        self.write('same_test.py', 'changed after all')
+        nt.assert_equal(self.runner.changed_target_files(None, digests),
+                        [same])
+
+
+class ImportGraphTests(unittest.TestCase):
+    files = {
+        'pkg/__init__.py': '',
+        'pkg/core.py': 'import json\n',
+        'pkg/util.py': 'from . import core\n',
+        'pkg/other.py': 'import os\n',
+        'pkg/sub/__init__.py': '',
+        'pkg/sub/deep.py': 'from ..util import helper\n',
+        'tests/test_util.py': 'from pkg import util\n',
+        'tests/test_deep.py': 'import pkg.sub.deep\n',
+        'tests/test_other.py': 'from pkg.other import thing\n',
+        'tests/test_local.py': 'import helpers\n',
+        'tests/helpers.py': 'def f(:\n',
+    }
+
+    def setUp(self):
+        self.tree = tempfile.mkdtemp()
+        for name, source in self.files.items():
+            path = self.path(name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(source)
+        self.graph = easyrunner.ImportGraph(self.path('.imports'))
+        self.targets = [self.path('tests/test_' + name + '.py')
+                        for name in ['util', 'deep', 'other', 'local']]
+
+    def tearDown(self):
+        shutil.rmtree(self.tree, ignore_errors=True)
+
+    def path(self, name):
+        return os.path.join(self.tree, name)
+
+    def impacted(self, *changed):
+        return self.graph.impacted(
+            self.targets, [self.path(c) for c in changed], [self.tree])
+
+    def test_follows_imports_transitively(self):
+        nt.assert_equal(self.impacted('pkg/core.py'), self.targets[:2])
+        nt.assert_equal(self.impacted('pkg/other.py'), [self.targets[2]])
+        nt.assert_equal(self.impacted('pkg/__init__.py'), self.targets[:3])
+        # Unparseable files are still part of the graph.
+        nt.assert_equal(self.impacted('tests/helpers.py'), [self.targets[3]])
+        nt.assert_equal(self.impacted('tests/test_other.py'),
+                        [self.targets[2]])
+        nt.assert_equal(self.impacted('README.md'), [])
+
+    def test_deleted_modules_still_count(self):
+        os.remove(self.path('pkg/other.py'))
+        nt.assert_equal(self.impacted('pkg/other.py'), [self.targets[2]])
+
+    def test_imports_are_cached(self):
+        self.impacted('pkg/core.py')
+        self.graph.save()
+
+        graph = easyrunner.ImportGraph(self.path('.imports'))
+        graph.load()
+        with patch.object(easyrunner.ast, 'parse') as parse:
+            graph.imports(self.targets[0])
+        nt.assert_false(parse.called)
+
+    def test_changed_files_come_from_git(self):
+        def git(*args):
+            easyrunner.sub.check_output(
+                ['git', '-c', 'user.name=t', '-c', 'user.email=t@t'] +
+                list(args), cwd=self.tree)
+        git('init', '-q')
+        git('add', '.')
+        git('commit', '-q', '-m', 'base')
+        with open(self.path('pkg/core.py'), 'a') as f:
+            f.write('import re\n')
+        with open(self.path('pkg/new.py'), 'w') as f:
+            f.write('')
+
+        runner = EchoRunner()
+        runner.set_command_path(self.path('pkg'))
+        nt.assert_equal(
+            sorted(runner.get_changed_files('HEAD')),
+            [os.path.realpath(self.path('pkg/core.py')),
+             os.path.realpath(self.path('pkg/new.py'))]
+        )
+        shutil.rmtree(runner.state_dir, ignore_errors=True)
+
+
+class ResultCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tree = tempfile.mkdtemp()
+        self.state_dir = tempfile.mkdtemp()
+        self.targets = [self.write(name, name)
+                        for name in ['a_test.py', 'b_test.py']]
+        self.write('config.yml', 'one')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tree, ignore_errors=True)
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+
+    def write(self, name, text):
+        path = os.path.join(self.tree, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def run_cached(self, no_cache=False):
+        runner = EchoRunner(self.state_dir)
+        runner.set_command_path(self.tree)
+        runner.use_cache = True
+        runner.no_cache = no_cache
+        runner.cache_inputs = ['*.yml']
+        runner.target_files = list(self.targets)
+        runner.run_tests()
+        return runner
+
+    def test_skips_unchanged_passes(self):
+        nt.assert_equal(self.run_cached().cached, set())
+        runner = self.run_cached()
+        nt.assert_equal(runner.cached, set(self.targets))
+        nt.assert_equal(runner.test_log['passes'], 2)
+        nt.assert_equal(runner.test_log['files'][self.targets[0]],
+                        ['cached'])
+
+        self.write('a_test.py', 'edited')
+        nt.assert_equal(self.run_cached().cached, set([self.targets[1]]))
+
+        self.write('config.yml', 'two')
+        nt.assert_equal(self.run_cached().cached, set())
+        nt.assert_equal(self.run_cached(no_cache=True).cached, set())
+        nt.assert_equal(self.run_cached().cached, set(self.targets))
+
+    def test_keys_are_the_same_in_every_process(self):
+        script = (
+            'import sys, tests\n'
+            'runner = tests.EchoRunner(sys.argv[1])\n'
+            'for suffix in ["--ansi", "--tags smoke", "--strict"]:\n'
+            '    runner.add_suffix(suffix)\n'
+            'print(runner.get_cache_key(sys.argv[2], ""))\n'
+        )
+        keys = set()
+        for seed in range(6):
+            env = dict(os.environ, PYTHONHASHSEED=str(seed))
+            keys.add(subprocess.check_output(
+                [sys.executable, '-c', script, self.state_dir,
+                 self.targets[0]],
+                cwd=os.path.dirname(os.path.abspath(__file__)), env=env
+            ))
+        nt.assert_equal(len(keys), 1)
+
+    def test_failures_are_not_cached(self):
+        runner = EchoRunner(self.state_dir)
+        runner.use_cache = True
+        runner.set_command('false')
+        runner.target_files = list(self.targets)
+        runner.run_tests()
+        nt.assert_equal(self.run_cached().cached, set())
+
+    def test_evicts_least_recently_used(self):
+        results_db = easyrunner.ResultsDB(
+            os.path.join(self.state_dir, 'cache.db'), 'Runner')
+        results_db.cache_pass('a', 'a_test.py', 2)
+        results_db.cache_pass('b', 'b_test.py', 2)
+        results_db.cached_passes(['a'])
+        results_db.cache_pass('c', 'c_test.py', 2)
+        nt.assert_equal(results_db.cached_passes(['a', 'b', 'c']),
+                        set(['a', 'c']))
+
+
+class RetryTests(unittest.TestCase):
+    def setUp(self):
+        self.tree = tempfile.mkdtemp()
+        self.runner = EchoRunner()
+        # Fails the first time it's run against each file.
+        self.runner.set_command(
+            'sh -c \'[ -e "$0.ran" ] && echo "$0"; touch "$0.ran"\'')
+        self.runner.set_retries(2)
+        self.targets = [os.path.join(self.tree, 'file_{0}'.format(i))
+                        for i in range(3)]
+        self.runner.target_files = list(self.targets)
+
+    def tearDown(self):
+        shutil.rmtree(self.tree, ignore_errors=True)
+        shutil.rmtree(self.runner.state_dir, ignore_errors=True)
+
+    def check_flaky_run(self):
+        self.runner.run_tests()
+        nt.assert_equal(self.runner.test_log['passes'], 3)
+        nt.assert_equal(self.runner.test_log['failures'], 0)
+        nt.assert_equal(sorted(self.runner.test_log['flaky']), self.targets)
+
+        results_db = self.runner.get_results_db()
+        history = results_db.file_history(self.targets[0])
+        nt.assert_equal(
+            [(h['attempt'], h['outcome']) for h in history],
+            [(2, 'passed'), (1, 'failed')]
+        )
+        nt.assert_equal(results_db.failed_files(), [])
+        nt.assert_equal(results_db.flake_rates(),
+                        dict((t, 1.0) for t in self.targets))
+
+    def test_sequential_retries(self):
+        self.check_flaky_run()
+
+    def test_parallel_retries(self):
+        self.runner.set_jobs(2)
+        self.check_flaky_run()
+
+    def test_retries_run_out(self):
+        self.runner.set_command('false')
+        self.runner.target_files = self.targets[:1]
+        self.runner.run_tests()
+        nt.assert_equal(self.runner.test_log['failures'], 1)
+        nt.assert_equal(self.runner.test_log['failed_tests'], self.targets[:1])
+        nt.assert_equal(self.runner.flaky, [])
+
+        results_db = self.runner.get_results_db()
+        history = results_db.file_history(self.targets[0])
+        nt.assert_equal([h['attempt'] for h in history], [3, 2, 1])
+        stats = results_db.conn.execute(
+            'SELECT runs, failures, flakes FROM file_stats').fetchone()
+        nt.assert_equal(stats, (1, 1, 0))
+
+    def test_put_flaky_first(self):
+        self.runner.flake_rates = {'c': 0.5, 'd': 0.1}
+        nt.assert_equal(
+            self.runner.put_flaky_first(['a', 'b', 'c', 'd']),
+            ['c', 'd', 'a', 'b']
+        )
+
+
+class DistributedTests(unittest.TestCase):
+    # Runs an EchoRunner as a worker: state dir, command, command path and
+    # the coordinator's address.
+    worker_script = """
+import sys, tests
+runner = tests.EchoRunner(sys.argv[1])
+runner.set_command(sys.argv[2])
+runner.set_command_path(sys.argv[3])
+runner.set_cli_args(['worker', '--worker', sys.argv[4]])
+runner.process_cli_args()
+runner.run()
+"""
+    # Fails bad_ files, and the first time it's run on a slow_ file, hangs
+    # after noting which worker picked it up.
+    command = (
+        'sh -c \'case "$0" in *bad_*) exit 1;; *slow_*) [ -e "$0.claimed" ] '
+        '|| { echo $PPID $$ > "$0.claimed"; sleep 30; };; esac; echo "$0"\''
+    )
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tree = tempfile.mkdtemp()
+        self.state_dirs = []
+        self.workers = []
+
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        self.address = '127.0.0.1:{0}'.format(probe.getsockname()[1])
+        probe.close()
+
+        self.runner = EchoRunner()
+        self.runner.set_command_path(self.tree)
+        self.runner.set_serve_address(self.address)
+        self.runner.set_global_timeout(30)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        for worker in self.workers:
+            if worker.poll() is None:
+                worker.kill()
+            worker.wait()
+        for path in [self.tree, self.runner.state_dir] + self.state_dirs:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def start_worker(self):
+        state_dir = tempfile.mkdtemp()
+        self.state_dirs.append(state_dir)
+        with open(os.devnull, 'w') as devnull:
+            self.workers.append(subprocess.Popen(
+                [sys.executable, '-c', self.worker_script, state_dir,
+                 self.command, self.tree, self.address],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stdout=devnull
+            ))
+
+    def targets(self, *names):
+        return [os.path.join(self.tree, name) for name in names]
+
+    def run_tests(self, seconds=60):
+        # A coordinator that never finishes should fail the test, not hang
+        # the suite.
+        coordinator = threading.Thread(target=self.runner.run_tests)
+        coordinator.daemon = True
+        coordinator.start()
+        coordinator.join(seconds)
+        nt.assert_false(coordinator.is_alive())
+
+    def test_workers_share_the_files(self):
+        self.start_worker()
+        self.start_worker()
+        self.runner.target_files = self.targets(
+            'file_1', 'file_2', 'file_3', 'bad_file', 'file_4')
+        self.run_tests()
+
+        nt.assert_equal(self.runner.test_log['passes'], 4)
+        nt.assert_equal(self.runner.test_log['failed_tests'],
+                        self.targets('bad_file'))
+        # Passes keep no output in the log.
+        nt.assert_equal(
+            self.runner.test_log['files'][self.targets('file_1')[0]], '')
+        # The coordinator's connection belongs to its thread.
+        results_db = easyrunner.ResultsDB(
+            self.runner.get_results_db_path(), self.runner.title)
+        history = results_db.file_history(self.targets('bad_file')[0])
+        nt.assert_equal([(h['outcome'], h['exit_code']) for h in history],
+                        [('failed', 1)])
+        for worker in self.workers:
+            nt.assert_equal(worker.wait(), 0)
+
+    def test_files_of_lost_workers_are_requeued(self):
+        claimed = self.targets('slow_file')[0] + '.claimed'
+
+        def kill_claimant():
+            while True:
+                try:
+                    with open(claimed) as f:
+                        worker_pid, shell_pid = [
+                            int(pid) for pid in f.read().split()]
+                    break
+                except (IOError, ValueError):
+                    time.sleep(0.05)
+            os.kill(worker_pid, signal.SIGKILL)
+            os.killpg(shell_pid, signal.SIGKILL)
+        killer = threading.Thread(target=kill_claimant)
+        killer.daemon = True
+        killer.start()
+
+        self.start_worker()
+        self.start_worker()
+        self.runner.target_files = self.targets(
+            'slow_file', 'file_1', 'file_2', 'file_3')
+        started = time.time()
+        self.run_tests()
+
+        nt.assert_true(time.time() - started < 20)
+        nt.assert_equal(self.runner.test_log['passes'], 4)
+        nt.assert_equal(self.runner.test_log['failures'], 0)
+
+    def test_silent_workers_are_cut_off(self):
+        host, port = self.address.split(':')
+
+        def silent_worker():
+            while True:
+                try:
+                    sock = socket.create_connection((host, int(port)))
+                    break
+                except socket.error:
+                    time.sleep(0.05)
+            sock.sendall(json.dumps({
+                'op': 'hello', 'name': 'silent', 'title': self.runner.title
+            }).encode('utf-8') + b'\n')
+            # Takes a file and never answers, not even to the kill.
+            while sock.recv(4096):
+                pass
+            sock.close()
+        worker = threading.Thread(target=silent_worker)
+        worker.daemon = True
+        worker.start()
+
+        self.runner.set_global_timeout(0.5)
+        self.runner.kill_grace = 0.5
+        self.runner.worker_grace = 0.5
+        self.runner.target_files = self.targets('file_1', 'file_2')
+        self.run_tests(20)
+
+        nt.assert_equal(self.runner.running, {})
+        nt.assert_equal(self.runner.test_log['failed_tests'],
+                        self.targets('file_1'))
+        nt.assert_equal(self.runner.timed_out, set(self.targets('file_1')))
+
+
+class SplitEchoRunner(EchoRunner):
+    """An EchoRunner that runs each file in two parts."""
+    splittable = True
+
+    def get_file_parts(self, target_file):
+        return [target_file + ':1', target_file + ':2']
+
+
+class ScenarioSplitTests(unittest.TestCase):
+    feature = u"""@billing
+Feature: Invoices
+
+  Background:
+    Given I am logged in
+
+  Scenario: Paying an invoice
+    When I pay
+    \"\"\"
+    Scenario: not really
+    \"\"\"
+
+  @wip
+  Scenario: Refunds
+    When I ask for a refund
+
+  Scenario Outline: Totals
+    Then the total is <total>
+
+    Examples:
+      | total |
+      | 1     |
+"""
+
+    def setUp(self):
+        self.tree = tempfile.mkdtemp()
+        self.path = os.path.join(self.tree, 'invoices.feature')
+        with io.open(self.path, 'w') as f:
+            f.write(self.feature)
+        self.runner = easyrunner.BehatRunner.__new__(easyrunner.BehatRunner)
+        self.runner.tags = set()
+
+    def tearDown(self):
+        shutil.rmtree(self.tree, ignore_errors=True)
+
+    def test_feature_is_split_into_scenarios(self):
+        nt.assert_equal(
+            self.runner.get_file_parts(self.path),
+            [self.path + ':7', self.path + ':14', self.path + ':17']
+        )
+
+    def test_tags_pick_the_scenarios(self):
+        self.runner.tags = set(['~@wip'])
+        nt.assert_equal(self.runner.get_file_parts(self.path),
+                        [self.path + ':7', self.path + ':17'])
+        self.runner.tags = set(['wip'])
+        nt.assert_equal(self.runner.get_file_parts(self.path), [self.path])
+        self.runner.tags = set(['billing'])
+        nt.assert_equal(len(self.runner.get_file_parts(self.path)), 3)
+
+    def test_scenario_counts_are_added_up(self):
+        nt.assert_equal(
+            self.runner.join_part_outputs(self.path, [
+                ['1 scenario (1 passed)'],
+                ['2 scenarios (1 passed, 1 failed)'],
+                'PHP Fatal error'
+            ]),
+            ['4 scenarios (2 passed, 2 failed)']
+        )
+
+    def test_parts_are_logged_as_their_file(self):
+        runner = SplitEchoRunner(self.tree)
+        runner.set_split(True)
+        runner.set_jobs(3)
+        runner.set_command(
+            'sh -c \'case "$0" in *bad:2) exit 1;; esac; echo "$0"\'')
+        good, bad = [os.path.join(self.tree, name) for name in ['good', 'bad']]
+        runner.target_files = [good, bad]
+        runner.run_tests()
+
+        nt.assert_equal(runner.test_log['passes'], 1)
+        nt.assert_equal(runner.test_log['failed_tests'], [bad])
+        nt.assert_equal(sorted(runner.test_log['files']), [bad, good])
+        nt.assert_equal(runner.test_log['files'][good], '')
+        nt.assert_equal(runner.test_log['files'][bad], '{0}:1\n'.format(bad))
+        results_db = runner.get_results_db()
+        nt.assert_equal(sorted(results_db.durations()), [bad, good])
+        nt.assert_equal([h['outcome'] for h in results_db.file_history(bad)],
+                        ['failed'])
+
+
+class DashboardTests(unittest.TestCase):
+    def setUp(self):
+        self.runner = EchoRunner()
+        self.runner.history_loaded = True
+        self.runner.target_files = ['a', 'b', 'c']
+
+    def tearDown(self):
+        shutil.rmtree(self.runner.state_dir, ignore_errors=True)
+
+    def run_captured(self):
+        out = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        with patch.object(sys, 'stdout', out):
+            self.runner.run_tests()
+        return out.getvalue()
+
+    def test_one_line_per_file_without_a_terminal(self):
+        lines = self.run_captured().splitlines()
+        done = [l for l in lines if 'PASSED' in l]
+        nt.assert_equal(len(done), 3)
+        nt.assert_true(done[-1].endswith('(3/3)'))
+        nt.assert_equal(len([l for l in lines if 'Test File Tally' in l]), 1)
+        nt.assert_false(any('\033[J' in l for l in lines))
+
+    def test_redraws_in_place_on_a_terminal(self):
+        self.runner.use_dashboard = True
+        self.runner.set_command('sleep 0.3; echo')
+        self.runner.shell = True
+        with patch.object(easyrunner.Dashboard, 'interval', 0.05):
+            output = self.run_captured()
+        nt.assert_true('\033[J' in output)
+        nt.assert_true('ETA' in output)
+        nt.assert_true('[RUNNING]' in output)
+        nt.assert_equal(output.count('[PASSED]'), 3)
+
+    def test_lines_are_cut_to_fit(self):
+        dashboard = easyrunner.Dashboard(self.runner)
+        line = dashboard.fit('\033[92m' + 'x' * 100 + '\033[0m', 20)
+        nt.assert_equal(self.runner.strip_ansi(line), 'x' * 19)
+
+    def test_eta_from_history(self):
+        self.runner.durations = {'a': 60.0, 'b': 60.0, 'c': 60.0}
+        self.runner.run_started = time.time()
+        self.runner.test_log['files'] = {'a': ''}
+        self.runner.set_jobs(2)
+        nt.assert_equal(self.runner.eta_str(), '0:01:00')
+
+
+class BenchmarkTests(unittest.TestCase):
+    def run_main(self, argv):
+        import benchmark
+        ran = []
+        stubs = [
+            patch.object(benchmark, name, lambda *args, **kwargs:
+                         ran.append(args) or {})
+            for name in ('bench_matcher', 'bench_discovery', 'bench_dispatch')
+        ]
+        for stub in stubs:
+            stub.start()
+        try:
+            with patch('sys.stdout', io.StringIO()) as stdout:
+                benchmark.main(argv)
+        finally:
+            for stub in stubs:
+                stub.stop()
+        return ran, json.loads(stdout.getvalue())
+
+    def test_runs_everything_by_default(self):
+        for argv in [[], ['--files', '100']]:
+            ran, results = self.run_main(argv)
+            nt.assert_equal(len(ran), 3)
+            nt.assert_equal(
+                set(['matcher', 'discovery', 'dispatch']) - set(results),
+                set())
+
+    def test_runs_the_named_ones(self):
+        ran, results = self.run_main(['dispatch'])
+        nt.assert_equal(len(ran), 1)
+        nt.assert_true('dispatch' in results)
+        with patch('sys.stderr', io.StringIO()):
+            nt.assert_raises(SystemExit, self.run_main, ['bogus'])